@@ -114,7 +114,8 @@ class APIGateway:
         
         self.__auth_monitor = {'wait':query_interval,
                                'earliest':None,
-                               'timer':None}
+                               'timer':None,
+                               'lock':threading.Lock()}
         
         #
         # Query limiting -- userless access...
@@ -124,7 +125,8 @@ class APIGateway:
         
         self.__userless_monitor = {'wait':query_interval,
                                    'earliest':None,
-                                   'timer':None}
+                                   'timer':None,
+                                   'lock':threading.Lock()}
     
     def __rate_controller( self, monitor_dict ):
         """
@@ -144,6 +146,7 @@ class APIGateway:
          * earliest: the earliest time that the next query should be issued.
          * timer: a backround thread that monitors the time for this particular
                   delay.
+         * lock: held by the caller while the monitor is in use.
         """
         #
         # Cause main thread to wait until the desired time has elapsed.
@@ -192,13 +195,6 @@ class APIGateway:
         of the data are unaltered. All three foursquare top-level attributes
         are included; i.e., meta, notifications, response.
         """
-        #
-        # Cause rate delay...
-        if userless:
-            self.__rate_controller( self.__userless_monitor )
-        else:
-            self.__rate_controller( self.__auth_monitor )
-        
         #
         # Params sanitising -- erase any tokens and client creds...
         params = copy.copy( get_params )
@@ -207,18 +203,28 @@ class APIGateway:
                 del params[fld]
         
         #
-        # Build & issue request...
-        if userless:
-            (client_id,client_secret) = self.client_credentials[self.next_client_index]
-            params['client_id'] = client_id
-            params['client_secret'] = client_secret
-            self.next_client_index = \
-                ( self.next_client_index + 1 ) % len( self.client_credentials )
-        else:
-            token = self.auth_access_tokens[self.next_auth_access_token_index]
-            params['oauth_token'] = token
-            self.next_auth_access_token_index = \
-                ( self.next_auth_access_token_index + 1 ) % len( self.auth_access_tokens )
+        # Several threads may share the gateway: the rate delay and the choice
+        # of credentials are made under the monitor's lock, the request itself
+        # outside it.
+        monitor_dict = self.__userless_monitor if userless else self.__auth_monitor
+        with monitor_dict['lock']:
+            #
+            # Cause rate delay...
+            self.__rate_controller( monitor_dict )
+            
+            #
+            # Build & issue request...
+            if userless:
+                (client_id,client_secret) = self.client_credentials[self.next_client_index]
+                params['client_id'] = client_id
+                params['client_secret'] = client_secret
+                self.next_client_index = \
+                    ( self.next_client_index + 1 ) % len( self.client_credentials )
+            else:
+                token = self.auth_access_tokens[self.next_auth_access_token_index]
+                params['oauth_token'] = token
+                self.next_auth_access_token_index = \
+                    ( self.next_auth_access_token_index + 1 ) % len( self.auth_access_tokens )
         
         path_suffix = path_suffix.lstrip( '/' )
         
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Benchmark of the DBWrapper counting/filtering helpers against a large
+synthetic database, comparing the old load-everything-into-Python versions
+with the SQL versions.
+
+Usage: bench_queries.py [venues] [checkins]
+
+The database is built in a temporary directory and removed afterwards.
+"""
+from database import Base, Venue, Category
+import database_wrapper
+from database_wrapper import DBWrapper
+from sqlite3 import dbapi2 as sqlite
+from shapely.geometry import Point
+from geofence import CircleFence
+import tempfile
+import shutil
+import random
+import time
+import os
+import sys
+
+def build( db_file, num_venues, num_checkins ):
+    engine = database_wrapper.create_engine( 'sqlite:///' + db_file )
+    Base.metadata.create_all( engine )
+    engine.dispose()
+
+    con = sqlite.connect( db_file )
+    con.executemany( "INSERT INTO categories (id, foursq_id, name) VALUES (?, ?, ?)",
+                     ( ( i, 'cat%d' % i, 'Category %d' % i ) for i in range( 1, 201 ) ) )
+    con.executemany( "INSERT INTO locations (id, latitude, longitude) VALUES (?, ?, ?)",
+                     ( ( i, 51 + random.random(), -3 + random.random() ) for i in range( 1, num_venues + 1 ) ) )
+    con.executemany( "INSERT INTO venues (id, foursq_id, name, verified, city_code, location_id, category_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     ( ( i, 'ven%d' % i, 'Venue %d' % i, 0, random.choice( [ 'CDF', 'BRS', 'CAM' ] ), i, random.randint( 1, 200 ) )
+                       for i in range( 1, num_venues + 1 ) ) )
+    con.executemany( "INSERT INTO checkins (foursq_id, user_id, venue_id, created_at) VALUES (?, ?, ?, ?)",
+                     ( ( 'chk%d' % i, random.randint( 1, num_checkins / 10 + 1 ), random.randint( 1, num_venues ), 1300000000 + i )
+                       for i in xrange( num_checkins ) ) )
+    con.commit()
+    con.close()
+
+def timed( label, f ):
+    start = time.time()
+    result = f()
+    if isinstance( result, list ):
+        result = len( result )
+    print "%-40s %10.3fs  (%s)" % ( label, time.time() - start, result )
+
+def old_get_venues_in_polygon( session, polygon ):
+    v = []
+    for venue in session.query( Venue ).all():
+        location = venue.location
+        if polygon.contains( Point( location.latitude, location.longitude ) ):
+            v.append( venue )
+    return v
+
+def old_get_venues_by_category( session, category ):
+    v = []
+    for venue in session.query( Venue ).all():
+        if venue.category:
+            if venue.category.foursq_id == category.foursq_id:
+                v.append( venue )
+    return v
+
+if __name__ == "__main__":
+    args = sys.argv
+    num_venues = int( args[1] ) if len( args ) > 1 else 100000
+    num_checkins = int( args[2] ) if len( args ) > 2 else 3000000
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join( tmp_dir, 'bench.db' )
+        print 'Building database: %d venues, %d checkins' % ( num_venues, num_checkins )
+        build( db_file, num_venues, num_checkins )
+
+        database_wrapper.DATABASE = 'sqlite:///' + db_file
+        dbw = DBWrapper( warm_caches=False, ingest_address=None )
+        dbw.upgrade_tables()
+        session = dbw.session
+        category = session.query( Category ).first()
+
+        timed( 'old count_venues_in_database', lambda: len( session.query( Venue ).all() ) )
+        session.expunge_all()
+        timed( 'new count_venues_in_database', dbw.count_venues_in_database )
+        timed( 'new count_checkins_in_database', dbw.count_checkins_in_database )
+        timed( 'old get_venues_by_category', lambda: old_get_venues_by_category( session, category ) )
+        session.expunge_all()
+        timed( 'new get_venues_by_category', lambda: dbw.get_venues_by_category( category ) )
+        timed( 'new count_venues_with_checkins', dbw.count_venues_with_checkins )
+        timed( 'new count_venues_in_city', lambda: dbw.count_venues_in_city( 'CDF' ) )
+        polygon = Point( 51.5, -2.5 ).buffer( 0.05, resolution=20 )
+        timed( 'old venues in polygon', lambda: old_get_venues_in_polygon( session, polygon ) )
+        session.expunge_all()
+        timed( 'new get_venues_in_polygon', lambda: dbw.get_venues_in_polygon( polygon ) )
+        timed( 'new get_venues_within_radius (5km)', lambda: dbw.get_venues_within_radius( 51.5, -2.5, 5.0 ) )
+        timed( 'new get_venues_in_bbox', lambda: dbw.get_venues_in_bbox( 51.45, -2.55, 51.55, -2.45 ) )
+        working_set = dbw.get_venue_working_set( 'CDF' )
+        fence = CircleFence( 51.5, -2.5, 0.05 )
+        timed( 'geofence mask of CDF working set', lambda: working_set.set_fence( fence ) or int( working_set.inside.sum() ) )
+    finally:
+        shutil.rmtree( tmp_dir )
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Simulation of the checkin monitor's polling, comparing the old fixed-order
+walk over the venues with the PollScheduler.
+
+Venues get checkins as Poisson arrivals with heavy-tailed rates (most venues
+are quiet, a few are busy), each checkin is visible in herenow for WINDOW
+seconds, and the monitor can make `polls_per_hour` polls. The scheduler's
+priors come from simulated statistics of the week before. Reports the
+checkins captured and captured per poll for each strategy.
+
+Usage: bench_scheduler.py [venues] [polls_per_hour] [hours]
+"""
+from datetime import datetime
+from scheduler import PollScheduler
+import bisect
+import random
+import sys
+
+WINDOW = 2 * 3600
+START = 1300000000
+
+
+class SimulatedVenue( object ):
+    def __init__( self, id, rate ):
+        self.id = id
+        self.name = 'venue %d' % id
+        self.rate = rate                    # checkins per hour
+        # a week of statistics before the simulation starts
+        self.first_stat_date = datetime( 2011, 3, 6 )
+        self.last_stat_date = datetime( 2011, 3, 13 )
+        self.first_checkins = 0
+        self.last_checkins = poisson( rate * 168 )
+        self.arrivals = []
+
+def poisson( mean ):
+    # normal approximation; close enough for priors
+    return max( 0, int( round( random.gauss( mean, mean ** 0.5 ) ) ) )
+
+def build( num_venues, hours ):
+    venues = []
+    for i in range( num_venues ):
+        v = SimulatedVenue( i + 1, random.lognormvariate( -3.5, 1.8 ) )
+        t = START
+        while v.rate > 0:
+            t += random.expovariate( v.rate ) * 3600
+            if t >= START + hours * 3600:
+                break
+            v.arrivals.append( t )
+        venues.append( v )
+    return venues
+
+def captured( venue, poll_time, last_poll ):
+    """
+    Arrivals visible at poll_time and not seen by the previous poll.
+    """
+    since = poll_time - WINDOW if last_poll is None else max( poll_time - WINDOW, last_poll )
+    return venue.arrivals[bisect.bisect_right( venue.arrivals, since ):bisect.bisect_right( venue.arrivals, poll_time )]
+
+def fixed_order( venues, polls_per_hour, hours ):
+    gap = 3600.0 / polls_per_hour
+    polls = int( hours * polls_per_hour )
+    last = {}
+    total = 0
+    for k in range( polls ):
+        t = START + k * gap
+        v = venues[k % len( venues )]
+        total += len( captured( v, t, last.get( v.id ) ) )
+        last[v.id] = t
+    return polls, total
+
+def scheduled( venues, polls_per_hour, hours ):
+    gap = 3600.0 / polls_per_hour
+    scheduler = PollScheduler( polls_per_hour )
+    scheduler.update( venues, now=START )
+    end = START + hours * 3600
+    t = START
+    polls = 0
+    total = 0
+    next_update = START + 3600
+    while t < end:
+        if t >= next_update:
+            scheduler.allocate( t )
+            next_update += 3600
+        due, v = scheduler.next_venue()
+        if due > t:
+            t = due             # nothing due: the monitor sleeps
+            continue
+        found = captured( v, t, scheduler.venues[v.id].last_poll )
+        # the poll sees everything in herenow, including checkins seen before
+        visible = captured( v, t, None )
+        scheduler.record( v.id, visible, t )
+        total += len( found )
+        polls += 1
+        t += gap
+    return polls, total
+
+def report( label, polls, total, arrivals ):
+    print "%-12s %8d polls %8d checkins captured (%5.1f%% of %d)  %.4f per poll" % (
+            label, polls, total, 100.0 * total / arrivals, arrivals, float( total ) / polls )
+
+
+if __name__ == "__main__":
+    args = sys.argv
+    num_venues = int( args[1] ) if len( args ) > 1 else 5000
+    polls_per_hour = int( args[2] ) if len( args ) > 2 else 1000
+    hours = int( args[3] ) if len( args ) > 3 else 48
+
+    random.seed( 1 )
+    venues = build( num_venues, hours )
+    arrivals = sum( len( v.arrivals ) for v in venues )
+    polls, total = fixed_order( venues, polls_per_hour, hours )
+    report( 'fixed order', polls, total, arrivals )
+    polls, total = scheduled( venues, polls_per_hour, hours )
+    report( 'scheduled', polls, total, arrivals )
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Simulates a week of a checkin monitor against a temporary database, without
+touching the foursquare API, and reports the resident memory of the process
+once per simulated day.
+
+In the default mode the monitor works the way monitor_checkins.py does: a
+compact venue working set, and the session thrown away at the end of every
+cycle. RSS should stay flat after the first day. With --legacy it holds ORM
+venues and walks their checkins every cycle in one long-lived session, the way
+the monitor used to, for comparison.
+
+Usage: bench_session_memory.py [--legacy] [venues] [cycles_per_day]
+"""
+from database import Base, Venue
+import database_wrapper
+from database_wrapper import DBWrapper
+import tempfile
+import shutil
+import random
+import os
+import sys
+
+def rss_kb():
+    """
+    Current resident set size of this process, in KB (Linux only).
+    """
+    with open( '/proc/self/statm' ) as f:
+        pages = int( f.read().split()[1] )
+    return pages * os.sysconf( 'SC_PAGE_SIZE' ) / 1024
+
+def fake_venue( i ):
+    return { 'id': 'venue%d' % i, 'name': 'Venue %d' % i, 'verified': False,
+             'location': { 'lat': 51.4 + random.random() / 10, 'lng': -3.2 + random.random() / 10 },
+             'categories': [], 'stats': { 'checkinsCount': 0, 'usersCount': 0 } }
+
+def fake_checkin( n, created_at ):
+    return { 'id': 'checkin%d' % n, 'createdAt': created_at,
+             'user': { 'id': 'user%d' % random.randint( 0, 5000 ), 'firstName': 'First', 'lastName': 'Last',
+                       'gender': 'none', 'homeCity': 'Cardiff' } }
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    legacy = '--legacy' in args
+    args = [ a for a in args if a != '--legacy' ]
+    num_venues = int( args[0] ) if len( args ) > 0 else 300
+    cycles_per_day = int( args[1] ) if len( args ) > 1 else 48
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        database_wrapper.DATABASE = 'sqlite:///' + os.path.join( tmp_dir, 'sim.db' )
+        dbw = DBWrapper( warm_caches=False, ingest_address=None )
+        dbw.upgrade_tables()
+        for i in range( num_venues ):
+            v = dbw.add_venue_to_database( fake_venue( i ), 'CDF' )
+            dbw.add_statistics_to_database( v, { 'checkinsCount': 1, 'usersCount': 1 } )
+        dbw.end_cycle()
+
+        if legacy:
+            venues = dbw.get_venues_in_city( 'CDF' )
+        else:
+            working_set = dbw.get_venue_working_set( 'CDF' )
+
+        count = 0
+        clock = 1300000000
+        print '%-6s %-10s %-10s' % ( 'day', 'checkins', 'rss (KB)' )
+        for day in range( 8 ):
+            for cycle in range( cycles_per_day ):
+                clock += 86400 / cycles_per_day
+                if legacy:
+                    targets = [ v for v in venues if len( v.checkins ) >= 0 ]
+                else:
+                    working_set.refresh()
+                    targets = working_set.active() or list( working_set )
+                for venue in random.sample( targets, len( targets ) / 10 ):
+                    for k in range( random.randint( 1, 3 ) ):
+                        count += 1
+                        dbw.add_checkin_to_database( fake_checkin( count, clock ), venue )
+                if not legacy:
+                    dbw.end_cycle()
+            print '%-6d %-10d %-10d' % ( day, count, rss_kb() )
+    finally:
+        shutil.rmtree( tmp_dir )
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Benchmark of concurrent writers against one SQLite file, with and without
+the connection profile from sqlite_profile.py.
+
+Mimics the production setup: several processes (the city monitors, the
+statistics checker) each commit one small row at a time while also reading.
+Reports committed rows per second and the number of "database is locked"
+failures for each configuration.
+
+The 'nullpool' and 'pooled' runs go through the engine DBWrapper uses
+(database_wrapper.create_database_engine), checking a connection out of its
+pool for every transaction as a session does: 'nullpool' with SQLAlchemy's
+default pool for SQLite files, which connects (and runs the PRAGMAs) at every
+checkout, 'pooled' with the persistent pool.
+
+Usage: bench_sqlite_profile.py [writers] [rows_per_writer]
+"""
+from multiprocessing import Process, Queue
+from sqlite3 import dbapi2 as sqlite
+from sqlite_profile import get_profile, apply_profile
+from sqlalchemy.exc import OperationalError
+import database_wrapper
+import tempfile
+import shutil
+import time
+import os
+import sys
+
+SCHEMA = """CREATE TABLE checkins ( id INTEGER PRIMARY KEY, foursq_id VARCHAR,
+                                   user_id INTEGER, venue_id INTEGER, created_at BIGINT )"""
+
+def writer( db_file, profile, worker, rows, results ):
+    # the sqlite3 module waits 5 seconds for a lock by default; this is what
+    # the old engine used.
+    con = sqlite.connect( db_file, timeout=5.0 )
+    if profile is not None:
+        apply_profile( con, profile )
+    done = 0
+    locked = 0
+    for i in range( rows ):
+        try:
+            cur = con.cursor()
+            cur.execute( "SELECT id FROM checkins WHERE foursq_id=?", ( '%d-%d' % ( worker, i - 1 ), ) )
+            cur.fetchall()
+            cur.execute( "INSERT INTO checkins (foursq_id, user_id, venue_id, created_at) VALUES (?, ?, ?, ?)",
+                         ( '%d-%d' % ( worker, i ), i, worker, int( time.time() ) ) )
+            con.commit()
+            done += 1
+        except sqlite.OperationalError:
+            con.rollback()
+            locked += 1
+    con.close()
+    results.put( ( done, locked ) )
+
+def engine_writer( db_file, pool_size, worker, rows, results ):
+    engine = database_wrapper.create_database_engine( 'sqlite:///' + db_file, pool_size )
+    done = 0
+    locked = 0
+    for i in range( rows ):
+        con = engine.connect()
+        trans = con.begin()
+        try:
+            con.execute( "SELECT id FROM checkins WHERE foursq_id=?", ( '%d-%d' % ( worker, i - 1 ), ) ).fetchall()
+            con.execute( "INSERT INTO checkins (foursq_id, user_id, venue_id, created_at) VALUES (?, ?, ?, ?)",
+                         ( '%d-%d' % ( worker, i ), i, worker, int( time.time() ) ) )
+            trans.commit()
+            done += 1
+        except OperationalError:
+            trans.rollback()
+            locked += 1
+        con.close()
+    engine.dispose()
+    results.put( ( done, locked ) )
+
+def run( label, target, setting, writers, rows ):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join( tmp_dir, 'bench.db' )
+        con = sqlite.connect( db_file )
+        con.execute( SCHEMA )
+        con.commit()
+        con.close()
+
+        results = Queue()
+        procs = [ Process( target=target, args=( db_file, setting, w, rows, results ) ) for w in range( writers ) ]
+        start = time.time()
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        elapsed = time.time() - start
+
+        done = 0
+        locked = 0
+        for p in procs:
+            d, l = results.get()
+            done += d
+            locked += l
+        print "%-10s writers: %d  committed: %6d  locked errors: %4d  time: %7.2fs  rows/s: %8.1f" % (
+                label, writers, done, locked, elapsed, done / elapsed )
+    finally:
+        shutil.rmtree( tmp_dir )
+
+if __name__ == "__main__":
+    args = sys.argv
+    writers = int( args[1] ) if len( args ) > 1 else 5
+    rows = int( args[2] ) if len( args ) > 2 else 500
+
+    run( 'default', writer, None, writers, rows )
+    run( 'profile', writer, get_profile( ), writers, rows )
+    run( 'nullpool', engine_writer, None, writers, rows )
+    run( 'pooled', engine_writer, database_wrapper.SQLITE_POOL_SIZE, writers, rows )
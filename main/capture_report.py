@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Script to report how many checkins the monitor captures.
+
+Reads the capture_rates table (see CaptureRate): for every venue and day, the
+increase of the venue's checkinsCount according to its statistics (expected)
+and the checkins stored for it (captured). Only days fully covered by the
+venue's statistics are counted, unless --partial is given. Reports the
+capture rate (captured / expected) overall, per city and per day, and the
+venues with the most checkins missed.
+
+A capture rate above 1 means more checkins were stored than the statistics
+account for (e.g. checkinsCount lags behind herenow).
+
+Usage: capture_report.py dbfile [days] [--venues=N] [--partial] [--json]
+
+    days        only look at the last `days` days
+    --venues=N  list the N venues with the most missed checkins (default 20)
+    --partial   include the days only partly covered by statistics
+    --json      print the report as JSON
+"""
+
+from sqlalchemy import create_engine
+from datetime import datetime
+import json
+import time
+import sys
+import os.path
+
+DAY = 86400
+
+def rate( captured, expected ):
+    return float( captured ) / expected if expected else None
+
+def collect( conn, start=None, complete=True, top=20 ):
+    """
+    Computes the capture rates of the days from the one containing `start`
+    (epoch seconds; None for no limit).
+
+    Output  dict of the report, see format_text() for the fields
+    """
+    stmt = """SELECT v.city_code, r.day, SUM( r.expected ), SUM( r.captured ), COUNT(*)
+              FROM capture_rates r JOIN venues v ON v.id = r.venue_id WHERE r.day >= ?"""
+    params = [ start - start % DAY if start is not None else -2 ** 62 ]
+    if complete:
+        stmt += " AND r.covered >= %d" % DAY
+    cursor = conn.cursor()
+    cursor.execute( stmt + " GROUP BY 1, 2 ORDER BY 2, 1", params )
+
+    days = []
+    cities = {}
+    for city, day, expected, captured, venues in cursor:
+        city = city or None
+        days.append( { 'day': day, 'city': city, 'expected': expected, 'captured': captured, 'venue_days': venues,
+                       'rate': rate( captured, expected ) } )
+        c = cities.setdefault( city, { 'expected': 0.0, 'captured': 0, 'venue_days': 0 } )
+        c['expected'] += expected
+        c['captured'] += captured
+        c['venue_days'] += venues
+    for c in cities.values():
+        c['rate'] = rate( c['captured'], c['expected'] )
+
+    cursor.execute( """SELECT v.id, v.name, v.city_code, SUM( r.expected ), SUM( r.captured )
+                       FROM capture_rates r JOIN venues v ON v.id = r.venue_id WHERE r.day >= ?"""
+                    + ( " AND r.covered >= %d" % DAY if complete else "" )
+                    + " GROUP BY 1 ORDER BY SUM( r.expected ) - SUM( r.captured ) DESC LIMIT ?", params + [ top ] )
+    venues = [ { 'venue_id': venue_id, 'name': name, 'city': city, 'expected': expected, 'captured': captured,
+                 'missed': expected - captured, 'rate': rate( captured, expected ) }
+               for venue_id, name, city, expected, captured in cursor ]
+    cursor.close()
+
+    expected = sum( c['expected'] for c in cities.values() )
+    captured = sum( c['captured'] for c in cities.values() )
+    return {
+        'start': start,
+        'complete': complete,
+        'expected': expected,
+        'captured': captured,
+        'rate': rate( captured, expected ),
+        'cities': cities,
+        'days': days,
+        'venues': venues,
+    }
+
+def format_time( epoch ):
+    return datetime.utcfromtimestamp( epoch ).strftime( '%Y-%m-%d' )
+
+def format_rate( r ):
+    return '%7.1f%%' % ( 100 * r ) if r is not None else '%8s' % '-'
+
+def format_text( report, db_filename ):
+    """
+    Output  the report from collect() as text
+    """
+    lines = []
+    lines.append( '----' )
+    lines.append( "Checking database:          %s" % db_filename )
+    lines.append( "Looking at days since:      %s" % ( 'unrestricted' if report['start'] is None else format_time( report['start'] ) ) )
+    lines.append( "Days counted:               %s" % ( 'fully covered by statistics' if report['complete'] else 'all' ) )
+    lines.append( '----' )
+    lines.append( "Expected checkins:          %.0f" % report['expected'] )
+    lines.append( "Captured checkins:          %d" % report['captured'] )
+    lines.append( "Capture rate:              %s" % format_rate( report['rate'] ) )
+    lines.append( '----' )
+    lines.append( "%-8s %10s %10s %10s %8s" % ( 'city', 'venue-days', 'expected', 'captured', 'rate' ) )
+    for city, c in sorted( report['cities'].items() ):
+        lines.append( "%-8s %10d %10.0f %10d %s" % ( city, c['venue_days'], c['expected'], c['captured'], format_rate( c['rate'] ) ) )
+    lines.append( '----' )
+    lines.append( "%-12s %-8s %10s %10s %8s" % ( 'day', 'city', 'expected', 'captured', 'rate' ) )
+    for d in report['days']:
+        lines.append( "%-12s %-8s %10.0f %10d %s" % ( format_time( d['day'] ), d['city'], d['expected'], d['captured'], format_rate( d['rate'] ) ) )
+    lines.append( '----' )
+    lines.append( "Most missed checkins:" )
+    for v in report['venues']:
+        lines.append( "%-40s %-8s %10.0f %10d %s" % ( ( v['name'] or '' )[:40], v['city'], v['expected'], v['captured'], format_rate( v['rate'] ) ) )
+    lines.append( '----' )
+    return '\n'.join( lines )
+
+if __name__ == "__main__":
+    #
+    # Input & args
+    args = [ a for a in sys.argv if not a.startswith( '--' ) ]
+    flags = dict( ( a.split( '=' )[0], a.split( '=' )[1] if '=' in a else True ) for a in sys.argv if a.startswith( '--' ) )
+
+    if len(args) not in [2,3]:
+        print "Incorrect number of arguments"
+        print "Argument pattern: dbfile [days] [--venues=N] [--partial] [--json]"
+        exit(1)
+
+    db_filename = args[1]
+    if not os.path.isfile( db_filename ):
+        print "Invalid or nonexistent file: %s" % db_filename
+        exit(1)
+
+    db_URL = 'sqlite:///' + db_filename
+
+    if len(args) == 2:
+        # No history length specified; take everything
+        start = None
+    else:
+        start = int( time.time() - float( args[2] ) * DAY )
+
+    #
+    # Setup
+    engine = create_engine( db_URL )
+    connection = engine.raw_connection()
+
+    #
+    # Report
+    report = collect( connection, start, '--partial' not in flags, int( flags.get( '--venues', 20 ) ) )
+    if '--json' in flags:
+        print json.dumps( report, indent=2 )
+    else:
+        print format_text( report, db_filename )
+
+    #
+    # Finish
+    connection.close()
@@ -17,12 +17,27 @@
 import logging
 import _credentials
 from database_wrapper import DBWrapper
+from checkpoint import Checkpoint, start_run, finish_run
 from urllib2 import HTTPError, URLError
 from api import *
 from exceptions import Exception
-from datetime import datetime as now
 from setproctitle import setproctitle
 
+"""
+Check Stats script.
+
+Retrieves the statistics of every venue in the database, in venue id order. Venues are loaded 
+BATCH at a time, and the session is discarded after each batch so that the statistics loaded do 
+not pile up. The id of the last venue checked is checkpointed every CHECKPOINT_INTERVAL seconds (see checkpoint.py), so a crawl 
+restarted partway through carries on after it rather than from the first venue.
+"""
+
+# seconds between checkpoints
+CHECKPOINT_INTERVAL = 60
+
+# venues loaded per session
+BATCH = 1000
+
 def get_venue_details( id ):
     while True:
         response = ''
@@ -49,24 +64,36 @@ if __name__ == "__main__":
     api = APIWrapper( gateway )
 
 
-    venues = dbw.get_all_venues( )
-
     crawl_string = 'CHECK_STATS'
-    dbw.add_crawl_to_database( crawl_string, 'START', now.now( ) )
-    logging.info( u'STAT_CHK started crawl for statistics check' )
-    count_venues = 0
-    for venue in venues:
-        logging.info( u'STAT_CHK %s: retrieve details for venue: %s' % ( venue.city_code, venue.name ) )
-        response, success = get_venue_details( venue.foursq_id )
-        if success:
-            count_venues = count_venues + 1
-            v = response.get( 'response' )
-            v = v.get( 'venue' )
-            stats = v.get( 'stats' )
-            dbw.add_statistics_to_database( venue,stats )
-            logging.info( u'STAT_CHK %s: checkins found: %d' % ( venue.city_code, stats['checkinsCount'] ) )
-        else:
-            logging.info( u'STAT_CHK %s: Error for venue: %s, id: %s' % ( venue.city_code, venue.name, venue.foursq_id ) )
+    checkpoint = Checkpoint( 'check_stats', CHECKPOINT_INTERVAL )
+    state = start_run( dbw, crawl_string, checkpoint )
+    if 'last_venue_id' in state:
+        logging.info( u'STAT_CHK resumed crawl for statistics check after venue %d' % state['last_venue_id'] )
+    else:
+        logging.info( u'STAT_CHK started crawl for statistics check' )
+    count_venues = state.get( 'venues_checked', 0 )
+    while True:
+        # venues are loaded a batch at a time: end_cycle() detaches everything loaded before it
+        venues = dbw.get_all_venues( state.get( 'last_venue_id' ), BATCH )
+        if not venues:
+            break
+        for venue in venues:
+            logging.info( u'STAT_CHK %s: retrieve details for venue: %s' % ( venue.city_code, venue.name ) )
+            response, success = get_venue_details( venue.foursq_id )
+            if success:
+                count_venues = count_venues + 1
+                v = response.get( 'response' )
+                v = v.get( 'venue' )
+                stats = v.get( 'stats' )
+                dbw.add_statistics_to_database( venue,stats )
+                logging.info( u'STAT_CHK %s: checkins found: %d' % ( venue.city_code, stats['checkinsCount'] ) )
+            else:
+                logging.info( u'STAT_CHK %s: Error for venue: %s, id: %s' % ( venue.city_code, venue.name, venue.foursq_id ) )
+            state['last_venue_id'] = venue.id
+            state['venues_checked'] = count_venues
+            checkpoint.save( state )
+        # let go of the venues and statistics loaded so far
+        dbw.end_cycle( )
     logging.info( u'STAT_CHK venues checked: %d' % ( count_venues ) )
 
-    dbw.add_crawl_to_database( crawl_string, 'FINISH', now.now( ) )
+    finish_run( dbw, state, checkpoint )
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Checkpoints, so that a crawl restarted partway through (e.g. by supervisord
+after a crash) carries on where it stopped rather than from the beginning.
+
+A crawl keeps its progress in a small JSON file, written every `interval`
+seconds (and on demand). The file is replaced atomically: the new state is
+written to a temporary file which is then renamed over the old one, so a
+crash while saving leaves the previous checkpoint intact.
+
+Every run of a crawl has a run id, stored in the run_id column of its
+CrawlLog rows. start_run() logs 'START' with a new run id, or, if there is a
+checkpoint, 'RESUME' with the run id of the interrupted run; finish_run()
+logs 'FINISH' with the same run id and removes the checkpoint. A run's
+START and FINISH rows are therefore paired by run_id however many times it
+was resumed.
+
+Checkpoints are kept in _credentials.checkpoint_dir (default: the working
+directory).
+"""
+from datetime import datetime as now
+import _credentials
+import logging
+import json
+import time
+import uuid
+import os
+
+CHECKPOINT_DIR = getattr( _credentials, 'checkpoint_dir', '.' )
+
+
+class Checkpoint( object ):
+    """
+    The checkpoint file of one crawl. The state is a JSON-serialisable dict.
+    """
+    def __init__( self, name, interval=60, directory=None ):
+        self.path = os.path.join( directory or CHECKPOINT_DIR, '%s.checkpoint.json' % name )
+        self.interval = interval
+        self.saved_at = 0
+
+    def __repr__( self ):
+        return u"<Checkpoint('%s')>" % self.path
+
+    def load( self ):
+        """
+        Output  the saved state, or None if there is no (readable) checkpoint
+        """
+        try:
+            with open( self.path ) as f:
+                return json.load( f )
+        except IOError:
+            return None
+        except ValueError:
+            logging.error( u'CHKPT Ignoring unreadable checkpoint %s' % self.path )
+            return None
+
+    def save( self, state, force=False ):
+        """
+        Save `state`, unless the last save was less than `interval` seconds ago.
+
+        Output  True if the state was saved
+        """
+        if not force and time.time() - self.saved_at < self.interval:
+            return False
+        temp = self.path + '.tmp'
+        with open( temp, 'w' ) as f:
+            json.dump( state, f )
+            f.flush()
+            os.fsync( f.fileno() )
+        os.rename( temp, self.path )
+        self.saved_at = time.time()
+        return True
+
+    def clear( self ):
+        if os.path.exists( self.path ):
+            os.remove( self.path )
+
+
+def start_run( dbw, crawltype, checkpoint ):
+    """
+    Start a run of a crawl, or resume the one interrupted if `checkpoint` has
+    a saved state for `crawltype`, and log it in the crawl log.
+
+    Output  the state: the saved one, or a new dict with the 'crawltype' and 'run_id'
+    """
+    state = checkpoint.load()
+    if state is not None and state.get( 'crawltype' ) == crawltype and state.get( 'run_id' ):
+        logging.info( u'CHKPT %s resuming run %s' % ( crawltype, state['run_id'] ) )
+        dbw.add_crawl_to_database( crawltype, 'RESUME', now.now( ), run_id=state['run_id'] )
+        return state
+    state = { 'crawltype': crawltype, 'run_id': uuid.uuid4().hex }
+    dbw.add_crawl_to_database( crawltype, 'START', now.now( ), run_id=state['run_id'] )
+    checkpoint.save( state, force=True )
+    return state
+
+def finish_run( dbw, state, checkpoint ):
+    """
+    Log the end of a run started by start_run() and remove its checkpoint.
+    """
+    dbw.add_crawl_to_database( state['crawltype'], 'FINISH', now.now( ), run_id=state['run_id'] )
+    checkpoint.clear()
@@ -63,10 +63,12 @@ if __name__ == "__main__":
     api = APIWrapper( gateway )
     dbw = DBWrapper()
     
-    if True: #~
-        from database import Friendship
-        if not dbw._get_engine().has_table('friendships'):
-            dbw._get_engine().create(Friendship.__table__)
+    dbw.upgrade_tables()
+    
+    # legacy crawls must be in the edge store before a new crawl is added to it
+    migrated = dbw.migrate_friendships()
+    if migrated:
+        logging.info( 'migrated %s legacy friendship crawls.', migrated )
     
     #
     # Begin mining...
@@ -81,7 +83,8 @@ if __name__ == "__main__":
     logging.info( 'crawl id = %s', crawl_id )
     count_users = 0
     sum_degree = 0
-    friend_rows_added = 0
+    friendships_seen = 0
+    crawled_user_ids = []
     
     all_users = dbw.get_all_users_with_checkins() 
     for indx, user_obj in enumerate( all_users ):
@@ -99,6 +102,7 @@ if __name__ == "__main__":
         
         count_users += 1
         sum_degree += len( friends )
+        crawled_user_ids.append( user_obj.id )
         
         for friend_dict in friends:
             friend_4sq_id = friend_dict['id']
@@ -124,24 +128,19 @@ if __name__ == "__main__":
                 friend_obj = dbw.add_user_to_database( friend_dict )
                 logging.debug( 'added new user to database: %s', friend_obj )
             
-            # Add friendship in each direction (iff not already added in this run)
-            friendship = dbw.get_friendship_from_database( user_obj, friend_obj, crawl_id ) 
-            if len(friendship) == 0:
-                fship_obj = dbw.add_friendship_to_database( user_obj, friend_obj, crawl_id )
-                logging.debug( 'added new row to friendships: %s', fship_obj )
-                friend_rows_added += 1
-                
-            friendship = dbw.get_friendship_from_database( friend_obj, user_obj, crawl_id )
-            if len(friendship) == 0:
-                fship_obj = dbw.add_friendship_to_database( friend_obj, user_obj, crawl_id )
-                logging.debug( 'added new row to friendships: %s', fship_obj )
-                friend_rows_added += 1
+            # Record the friendship (stored once, whichever side it is found from)
+            edge = dbw.add_friendship_to_database( user_obj, friend_obj, crawl_id )
+            logging.debug( 'friendship seen: %s', edge )
+            friendships_seen += 1
         
+    removed = dbw.finish_friendship_crawl( crawl_id, crawled_user_ids )
     logging.info( 'finishing run' )
     logging.info( 'crawl id: %s', crawl_id )
     logging.info( 'users checked: %s', count_users )
     logging.info( 'sum of node degrees (inc. brands): %s', sum_degree )
-    logging.info( 'friendhip rows added: %s', friend_rows_added )
+    logging.info( 'friendships seen: %s', friendships_seen )
+    logging.info( 'friendships removed since last crawl: %s', removed )
+    dbw.log_cache_stats()
     logging.info( 'run finished' )
     
     
@@ -17,86 +17,220 @@
 
 """
 Script to grab some statistics about the data collected so far.
+
+By default the figures come from the activity_counters table (see
+ActivityCounter), which the crawlers keep up to date per city and per hour,
+so the report is instant however much data has been collected: checkins,
+new users, new venues and statistics rows, overall and per city, and a
+per-hour or per-day histogram. Windows are rounded down to whole hours.
+
+With --scan (or on a database without counters) the checkins in the window
+are counted instead, in one query over the (created_at, venue_id, user_id)
+index, which also gives the numbers of distinct venues and users.
+
+Usage: data_stats.py dbfile [hours] [--day] [--json] [--scan]
+
+    hours   only look at checkins from the last `hours` hours
+    --day   histogram buckets of a day rather than an hour
+    --json  print the statistics as JSON
+    --scan  count from the checkins table rather than the counters
 """
 
 from sqlalchemy import create_engine
-from datetime import datetime, timedelta
+from datetime import datetime
+from collections import defaultdict
+import json
+import time
 import sys
 import os.path
 
-def num_checkins_since( conn, since_date ):
+HOUR = 3600
+DAY = 86400
+
+def collect( conn, start=None, end=None, bucket=HOUR ):
     """
-    `since_date` is a Python datetime object.
+    Computes the statistics of the checkins with start <= created_at < end
+    (epoch seconds; None for no limit), in SQL.
+
+    `conn` is a DB-API connection (e.g. engine.raw_connection()).
+
+    Output  dict of statistics, see format_text() for the fields
     """
-    # SQLite datetime format:           2011-03-23 14:02:15
-    # Python datetime.isoformat(' '):   2011-03-23 14:02:15
-    date_str = since_date.isoformat( ' ' )
-    qry_str = """select count(*) 
-                 from checkins
-                 where datetime(created_at,'unixepoch') >= '%s' """ % (date_str)
-    result_set = connection.execute(qry_str)
-    return int( result_set.first()[0] )
+    where = "WHERE c.created_at >= ?"
+    params = [ start if start is not None else -2 ** 62 ]
+    if end is not None:
+        where += " AND c.created_at < ?"
+        params.append( end )
+    cursor = conn.cursor()
 
+    # the window is read once, into w (SQLite materializes a CTE used more than once), and
+    # each level is aggregated from that: distinct counts can't be added up across groups
+    cursor.execute( """WITH w AS (
+                           SELECT c.created_at - c.created_at % ? AS bucket, v.city_code AS city, c.venue_id AS venue_id,
+                                  c.user_id AS user_id, COUNT(*) AS n
+                           FROM checkins c LEFT JOIN venues v ON v.id = c.venue_id """ + where + """ GROUP BY 1, 2, 3, 4 )
+                       SELECT 'total', NULL, NULL, COALESCE( SUM( n ), 0 ), COUNT( DISTINCT venue_id ), COUNT( DISTINCT user_id ) FROM w
+                       UNION ALL
+                       SELECT 'city', city, NULL, SUM( n ), COUNT( DISTINCT venue_id ), COUNT( DISTINCT user_id ) FROM w GROUP BY city
+                       UNION ALL
+                       SELECT 'bucket', city, bucket, SUM( n ), NULL, NULL FROM w GROUP BY bucket, city""",
+                    [ bucket ] + params )
+    per_city = {}
+    histogram = []
+    for level, city, b, n, level_venues, level_users in cursor:
+        if level == 'total':
+            checkins, venues, users = n, level_venues, level_users
+        elif level == 'city':
+            per_city[city] = { 'checkins': n, 'venues': level_venues, 'users': level_users }
+        else:
+            histogram.append( { 'bucket': b, 'city': city, 'checkins': n } )
+    histogram.sort( key=lambda h: ( h['bucket'], h['city'] ) )
+    cursor.close()
 
-def num_visited_venues_since( conn, since_date ):
+    return {
+        'source': 'scan',
+        'start': start,
+        'end': end,
+        'bucket': bucket,
+        'checkins': checkins,
+        'venues': venues,
+        'users': users,
+        'checkins_per_venue': float( checkins ) / venues if venues else None,
+        'cities': per_city,
+        'histogram': histogram,
+    }
+
+def has_counters( conn ):
+    """
+    Output  True if the database has (non-empty) activity counters
+    """
+    cursor = conn.cursor()
+    cursor.execute( "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'activity_counters'" )
+    found = cursor.fetchone() is not None
+    if found:
+        cursor.execute( "SELECT 1 FROM activity_counters LIMIT 1" )
+        found = cursor.fetchone() is not None
+    cursor.close()
+    return found
+
+def collect_counters( conn, start=None, end=None, bucket=HOUR ):
     """
-    `since_date` is a Python datetime object.
+    Reads the statistics of the hours from start to end (epoch seconds; None
+    for no limit) from the activity counters.
+
+    Output  dict of statistics, see format_text() for the fields
     """
-    date_str = since_date.isoformat( ' ' )
-    qry_str = """select count( distinct(venue_id) ) 
-                 from checkins
-                 where datetime(created_at,'unixepoch') >= '%s' """ % (date_str)
-    result_set = connection.execute(qry_str)
-    return int( result_set.first()[0] )
+    stmt = "SELECT city_code, hour, checkins, new_users, new_venues, statistics FROM activity_counters WHERE hour >= ?"
+    params = [ start - start % HOUR if start is not None else -2 ** 62 ]
+    if end is not None:
+        stmt += " AND hour < ?"
+        params.append( end )
+    cursor = conn.cursor()
+    cursor.execute( stmt, params )
+
+    totals = { 'checkins': 0, 'new_users': 0, 'new_venues': 0, 'statistics': 0 }
+    per_city = {}
+    histogram = defaultdict( int )  # ( bucket start, city ) -> checkins
+    for city, hour, checkins, new_users, new_venues, statistics in cursor:
+        city = city or None
+        c = per_city.setdefault( city, { 'checkins': 0, 'new_users': 0, 'new_venues': 0, 'statistics': 0 } )
+        for name, n in ( ( 'checkins', checkins ), ( 'new_users', new_users ), ( 'new_venues', new_venues ), ( 'statistics', statistics ) ):
+            c[name] += n
+            totals[name] += n
+        if checkins:
+            histogram[( hour - hour % bucket, city )] += checkins
+    cursor.close()
 
+    stats = {
+        'source': 'counters',
+        'start': start,
+        'end': end,
+        'bucket': bucket,
+        'cities': per_city,
+        'histogram': [ { 'bucket': b, 'city': city, 'checkins': n } for ( b, city ), n in sorted( histogram.items() ) ],
+    }
+    stats.update( totals )
+    return stats
+
+def format_time( epoch ):
+    return datetime.utcfromtimestamp( epoch ).isoformat( ' ' )
+
+def format_text( stats, db_filename ):
+    """
+    Output  the statistics from collect() or collect_counters() as a report
+    """
+    if stats['source'] == 'counters':
+        columns = [ ( 'checkins', 'Number of checkins' ), ( 'new_users', 'Number of new users' ),
+                    ( 'new_venues', 'Number of new venues' ), ( 'statistics', 'Number of statistics' ) ]
+    else:
+        columns = [ ( 'checkins', 'Number of checkins' ), ( 'venues', 'Number of visited venues' ),
+                    ( 'users', 'Number of users' ) ]
+    lines = []
+    lines.append( '----' )
+    lines.append( "Checking database:          %s" % db_filename )
+    lines.append( "Counted from:               %s" % ( 'activity counters' if stats['source'] == 'counters' else 'checkins table' ) )
+    lines.append( "Looking at checkins since:  %s" % ( 'unrestricted' if stats['start'] is None else format_time( stats['start'] ) ) )
+    lines.append( '----' )
+    for name, label in columns:
+        lines.append( "%-28s%d" % ( label + ':', stats[name] ) )
+    if 'checkins_per_venue' in stats:
+        lines.append( "Checkins per venue:         %f" % ( stats['checkins_per_venue'] or float( 'NaN' ) ) )
+    lines.append( '----' )
+    lines.append( "%-8s" % 'city' + ''.join( " %10s" % name for name, label in columns ) )
+    for city, c in sorted( stats['cities'].items() ):
+        lines.append( "%-8s" % city + ''.join( " %10d" % c[name] for name, label in columns ) )
+    lines.append( '----' )
+    cities = sorted( stats['cities'] )
+    lines.append( "%-20s" % ( 'per day' if stats['bucket'] == DAY else 'per hour' ) + ''.join( " %8s" % c for c in cities ) )
+    rows = {}
+    for h in stats['histogram']:
+        rows.setdefault( h['bucket'], {} )[h['city']] = h['checkins']
+    for b in sorted( rows ):
+        lines.append( "%-20s" % format_time( b ) + ''.join( " %8d" % rows[b].get( c, 0 ) for c in cities ) )
+    lines.append( '----' )
+    return '\n'.join( lines )
 
 if __name__ == "__main__":
     #
     # Input & args
-    args = sys.argv
+    args = [ a for a in sys.argv if not a.startswith( '--' ) ]
+    flags = [ a for a in sys.argv if a.startswith( '--' ) ]
 
     if len(args) not in [2,3]:
         print "Incorrect number of arguments"
-        print "Argument pattern: dbfile [hours]"
+        print "Argument pattern: dbfile [hours] [--day] [--json] [--scan]"
         exit(1)
-    
-    db_filename = sys.argv[1]
+
+    db_filename = args[1]
     if not os.path.isfile( db_filename ):
         print "Invalid or nonexistent file: %s" % db_filename
         exit(1)
 
-    db_URL = 'sqlite:///' + sys.argv[1]    
-    
+    db_URL = 'sqlite:///' + db_filename
+
     if len(args) == 2:
         # No history length specified; take everything
-        since_date = datetime.min
+        start = None
     else:
-        history_length = timedelta( hours=float(args[2]) )
-        since_date = datetime.now() - history_length
-    
+        start = int( time.time() - float( args[2] ) * HOUR )
+    bucket = DAY if '--day' in flags else HOUR
+
     #
     # Setup
     engine = create_engine( db_URL )
-    connection = engine.connect()
+    connection = engine.raw_connection()
 
     #
     # Info
-    num_checkins = num_checkins_since( connection, since_date )    
-    num_venues = num_visited_venues_since( connection, since_date )
-    checkins_per_venue = (float(num_checkins)/float(num_venues)) if num_venues else float('NaN')
-    
-    since_text = 'unrestricted' if (since_date is datetime.min) else since_date.isoformat(' ')
-    
-    print '----'
-    print "Checking database:          %s" % db_filename
-    print "Looking at checkins since:  %s" % since_text
-    print '----'
-    print "Number of checkins:         %d" % num_checkins
-    print "Number of visited venues:   %d" % num_venues
-    print "Checkins per venue:         %f" % checkins_per_venue
-    print '----'
-    
+    if '--scan' not in flags and has_counters( connection ):
+        stats = collect_counters( connection, start, None, bucket )
+    else:
+        stats = collect( connection, start, None, bucket )
+    if '--json' in flags:
+        print json.dumps( stats, indent=2 )
+    else:
+        print format_text( stats, db_filename )
+
     #
     # Finish
     connection.close()
-
@@ -18,10 +18,11 @@
 """
 This is a basic database schema for the cs4sq project. Not very sophisticated, but it'll do.
 """
-from sqlalchemy import Table, Column, Integer, String, Float, Boolean, DateTime, ForeignKey
+from sqlalchemy import Table, Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.types import BIGINT
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, object_session
+import geokey
 
 Base = declarative_base()
 
@@ -32,7 +33,7 @@ class Category( Base ):
     __tablename__ = 'categories'
 
     id = Column( Integer, primary_key=True )
-    foursq_id = Column( String )
+    foursq_id = Column( String, index=True )
     name = Column( String )
 
     def __init__( self, name, foursq_id ):
@@ -40,37 +41,58 @@ class Category( Base ):
         self.foursq_id = foursq_id
 
 class CrawlLog( Base ):
+    """
+    A crawl's 'START', 'RESUME' (after a restart, see checkpoint.py) and
+    'FINISH'. The rows of one run of a crawl share its `run_id`.
+    """
     __tablename__ = 'crawllog'
+    __table_args__ = ( Index( 'ix_crawllog_type_date', 'crawltype', 'date' ), )
 
     id = Column( Integer, primary_key=True )
     crawltype = Column( String )
     flag = Column( String )
     date = Column( DateTime )
+    run_id = Column( String, index=True )
 
-    def __init__( self, crawltype, flag, date ):
+    def __init__( self, crawltype, flag, date, run_id=None ):
         self.crawltype = crawltype
         self.flag = flag
         self.date = date
+        self.run_id = run_id
 
     def __repr__( self ):
         return u"<Crawl('%s', '%s', '%s')>" % ( self.crawltype, self.flag, self.date )
 
 class Location( Base ):
+    """
+    Locations are matched on `geokey`, the latitude and longitude quantised
+    and interleaved into one integer (see geokey.py), rather than on the
+    float columns.
+    """
     __tablename__ = 'locations'
+    __table_args__ = ( Index( 'ix_locations_geokey', 'geokey', unique=True ), )
 
     id = Column( Integer, primary_key=True )
     latitude = Column( Float )
     longitude = Column( Float )
+    geokey = Column( BIGINT, nullable=True )
 
     def __init__( self, latitude, longitude ):
         self.latitude = latitude
         self.longitude = longitude
+        self.geokey = geokey.encode( latitude, longitude )
 
     def __repr__( self ):
         return u"<Location('%f', '%f')>" % ( self.latitude, self.longitude )
 
 class Statistic( Base ):
+    """
+    Statistics are stored only when they change. `date` is when the values were
+    first seen and `confirmed_at` the last time they were seen unchanged; the
+    values held from `date` until the next row for the venue.
+    """
     __tablename__ = 'statistics'
+    __table_args__ = ( Index( 'ix_statistics_venue_date', 'venue_id', 'date' ), )
 
     id = Column( Integer, primary_key=True ) 
     venue_id = Column( Integer, ForeignKey( 'venues.id' ) )
@@ -78,9 +100,11 @@ class Statistic( Base ):
     date = Column( DateTime )
     checkins = Column( Integer )
     users = Column( Integer )
+    confirmed_at = Column( DateTime, nullable=True )
 
     def __init__( self, venue_id, date, checkins, users ):
         self.date = date
+        self.confirmed_at = date
         self.venue_id = venue_id
         self.checkins = checkins
         self.users = users
@@ -88,39 +112,178 @@ class Statistic( Base ):
     def __repr__( self ):
         return u"<Statistics('%s', '%d', '%d')>" % ( self.date, self.checkins, self.users )
 
+class StatisticRollup( Base ):
+    """
+    Old statistics, downsampled into fixed time buckets (see statistics_rollup.py).
+    Each row summarises the statistics of one venue seen in the bucket starting at
+    `bucket_start` of length given by `tier` ('hourly', 'daily', 'weekly'): the first,
+    last and maximum values, when the first and last were seen, and how many raw 
+    statistics rows went into it.
+    """
+    __tablename__ = 'statistic_rollups'
+    __table_args__ = ( Index( 'ix_statistic_rollups_venue_tier_bucket', 'venue_id', 'tier', 'bucket_start', unique=True ), )
+
+    id = Column( Integer, primary_key=True )
+    venue_id = Column( Integer, ForeignKey( 'venues.id' ) )
+    tier = Column( String )
+    bucket_start = Column( DateTime )
+    first_date = Column( DateTime )
+    last_date = Column( DateTime )
+    first_checkins = Column( Integer )
+    last_checkins = Column( Integer )
+    max_checkins = Column( Integer )
+    first_users = Column( Integer )
+    last_users = Column( Integer )
+    max_users = Column( Integer )
+    samples = Column( Integer )
+
+    def __init__( self, venue_id, tier, bucket_start ):
+        self.venue_id = venue_id
+        self.tier = tier
+        self.bucket_start = bucket_start
+        self.samples = 0
+
+    def __repr__( self ):
+        return u"<StatisticRollup('%s', '%s', '%d', '%d')>" % ( self.tier, self.bucket_start, self.last_checkins, self.last_users )
+
+class ActivityCounter( Base ):
+    """
+    Running totals of what the crawlers have stored, per city and per hour
+    (`hour` is the epoch second the hour starts at), so that progress can be
+    reported without scanning the raw tables:
+        `checkins`: checkins stored, by created_at
+        `new_users`: users whose first stored checkin falls in the hour
+        `new_venues`: venues whose first stored checkin falls in the hour
+        `statistics`: statistics rows stored, by date
+    Kept up to date by the DBWrapper in the same transaction as the rows they
+    count; DBWrapper.rebuild_activity_counters() recomputes them.
+    """
+    __tablename__ = 'activity_counters'
+
+    city_code = Column( String, primary_key=True )
+    hour = Column( BIGINT, primary_key=True )
+    checkins = Column( Integer, default=0 )
+    new_users = Column( Integer, default=0 )
+    new_venues = Column( Integer, default=0 )
+    statistics = Column( Integer, default=0 )
+
+    def __repr__( self ):
+        return u"<ActivityCounter('%s', '%d', '%d', '%d')>" % ( self.city_code, self.hour, self.checkins, self.statistics )
+
+class CaptureRate( Base ):
+    """
+    How many of a venue's checkins were captured, per venue and per day (`day`
+    is the epoch second the UTC day starts at):
+        `expected`: the increase of the venue's checkinsCount over the day; an
+            increase between two statistics is spread evenly over the time
+            between them (their dates, in local time, converted to UTC)
+        `covered`: seconds of the day between two statistics of the venue, i.e.
+            the part of the day `expected` is known for
+        `captured`: checkins stored for the venue, by created_at
+    On a fully covered day (`covered` of 86400) captured / expected is the
+    share of the venue's checkins that the monitor captured. Kept up to date by
+    the DBWrapper as statistics and checkins are added, like the activity
+    counters; DBWrapper.rebuild_capture_rates() recomputes them.
+    """
+    __tablename__ = 'capture_rates'
+    __table_args__ = ( Index( 'ix_capture_rates_day', 'day' ), )
+
+    venue_id = Column( Integer, primary_key=True )
+    day = Column( BIGINT, primary_key=True )
+    expected = Column( Float, default=0.0 )
+    covered = Column( Integer, default=0 )
+    captured = Column( Integer, default=0 )
+
+    def __repr__( self ):
+        return u"<CaptureRate('%d', '%d', '%f', '%d')>" % ( self.venue_id, self.day, self.expected, self.captured )
+
 class Venue( Base ):
+    """
+    As well as the venue details, each venue carries a denormalised summary of
+    its activity so that the monitors don't have to walk the statistics and
+    checkins of every venue:
+        `first_checkins`, `first_stat_date`: the first statistics recorded
+        `last_checkins`, `last_users`: the most recent statistics recorded, 
+            `last_statistic_id` the row they are stored in and `last_stat_date`
+            when they were last seen
+        `last_checkin_at`: created_at of the most recent checkin captured
+        `active`: set once a checkin has been captured, or the checkinsCount
+            has been seen to increase between two statistics
+    These are kept up to date by the DBWrapper when statistics and checkins
+    are added, and can be rebuilt with DBWrapper.rebuild_venue_activity().
+    """
     __tablename__ = 'venues'
+    __table_args__ = ( Index( 'ix_venues_city_active', 'city_code', 'active' ), )
 
     id = Column( Integer, primary_key=True )
-    foursq_id = Column( String )
+    foursq_id = Column( String, index=True )
     name = Column( String )
     verified = Column( Boolean )
     city_code = Column ( String )
     location_id = Column( Integer, ForeignKey( 'locations.id' ) )
     location = relationship("Location", backref=backref('venues'), cascade="all, save-update")
-    category_id = Column( Integer, ForeignKey('categories.id') )
+    category_id = Column( Integer, ForeignKey('categories.id'), index=True )
     category = relationship("Category", backref=backref('venues'), cascade="all, save-update")
     mayor_id = Column( Integer, ForeignKey( 'users.id' ) )
     mayor = relationship("User", backref=backref('mayorships'), cascade="all, save-update")
 
+    first_checkins = Column( Integer, nullable=True )
+    first_stat_date = Column( DateTime, nullable=True )
+    last_checkins = Column( Integer, nullable=True )
+    last_users = Column( Integer, nullable=True )
+    last_stat_date = Column( DateTime, nullable=True )
+    last_statistic_id = Column( Integer, nullable=True )
+    last_checkin_at = Column( BIGINT, nullable=True )
+    active = Column( Boolean, default=False )
+
     def __init__( self, foursq_id, name, verified, location_id, city_code ):
         self.foursq_id = foursq_id
         self.name = name
         self.verified = verified
         self.location_id = location_id
         self.city_code = city_code
+        self.active = False
 
     def __repr__( self ):
         return u"<Venue('%s', '%s', '%s')>" % (self.name, self.foursq_id, self.location)
 
-    def get_latest_statistic():
-        return statistics[0]
+    def get_latest_statistic( self ):
+        """
+        The most recent Statistic for this venue, loaded by id rather than through the 
+        (date ordered) statistics collection. None if no statistics have been recorded.
+        """
+        if self.last_statistic_id is None:
+            return None
+        return object_session( self ).query( Statistic ).get( self.last_statistic_id )
+
+class VenueChange( Base ):
+    """
+    The latest change to each venue: `seq` increases with every insert into the
+    venues table and every update of a venue's name, city, location or active
+    flag, and is set by triggers on that table (see DBWrapper.upgrade_tables),
+    so every writer is covered. The activity summaries, updated with every
+    statistic and checkin, are not logged. Long-running readers remember the
+    highest seq they have seen and ask for the venues changed since.
+
+    `old_city_code` and `city_code` are the venue's city before and after the
+    change, so each city's readers only read the changes to their venues,
+    including those moved away.
+    """
+    __tablename__ = 'venue_changes'
+
+    venue_id = Column( Integer, primary_key=True )
+    seq = Column( Integer, index=True )
+    old_city_code = Column( String )
+    city_code = Column( String )
+
+    def __repr__( self ):
+        return u"<VenueChange('%d', '%d')>" % ( self.venue_id, self.seq )
     
 class User( Base ):
     __tablename__ = 'users'
 
     id = Column( Integer, primary_key=True )
-    foursq_id = Column( String )
+    foursq_id = Column( String, index=True )
     first_name = Column( String )
     last_name = Column( String )
     gender = Column( String )
@@ -139,12 +302,14 @@ class User( Base ):
 
 class Checkin( Base ):
     __tablename__ = 'checkins'
+    # covers the time-window scans in data_stats.py
+    __table_args__ = ( Index( 'ix_checkins_created_venue_user', 'created_at', 'venue_id', 'user_id' ), )
 
     id = Column( Integer, primary_key=True )
-    foursq_id = Column( String )
-    user_id = Column( Integer, ForeignKey( 'users.id') )
+    foursq_id = Column( String, index=True )
+    user_id = Column( Integer, ForeignKey( 'users.id'), index=True )
     user = relationship("User", backref=backref('checkins'), cascade="all, save-update")
-    venue_id = Column( Integer, ForeignKey( 'venues.id' ) )
+    venue_id = Column( Integer, ForeignKey( 'venues.id' ), index=True )
     venue = relationship("Venue", backref=backref('checkins'), cascade="all, save-update")
     created_at = Column( BIGINT )
 
@@ -157,6 +322,10 @@ class Checkin( Base ):
 
 class Friendship( Base ):
     """
+    Legacy storage of friendships, superseded by FriendshipEdge and
+    FriendshipDelta. Kept so that old databases can be migrated with
+    DBWrapper.migrate_friendships().
+    
     Although 4sq friendships are symmetric, we choose to store both 
     directions of the friendship as separate rows. Thus, the table will 
     have two row pers 4sq friendship. This simplifies querying.
@@ -177,6 +346,7 @@ class Friendship( Base ):
     """
     
     __tablename__ = 'friendships'
+    __table_args__ = ( Index( 'ix_friendships_users_crawl', 'userA_id', 'userB_id', 'crawl_id' ), )
     
     id = Column( Integer, primary_key=True )
     
@@ -204,5 +374,64 @@ class Friendship( Base ):
 
     def __repr__( self ):
         return u"<Friendship('%d, '%d', '%s','%s')>" % ( self.userA_id, self.userB_id, self.date_crawled, self.crawl_id )
+
+class FriendshipEdge( Base ):
+    """
+    One row per undirected friendship ever seen, with the user ids stored in
+    canonical order (`user_low_id` < `user_high_id`). Replaces the `friendships`
+    table, which stores every friendship twice for every crawl.
+    
+    Which crawls an edge was present in is recorded by its FriendshipDeltas.
+    `present` and `last_seen_crawl_id` describe the latest crawl, and are used
+    to find the edges removed when a crawl finishes.
+    """
+    __tablename__ = 'friendship_edges'
+    __table_args__ = ( Index( 'ix_friendship_edges_users', 'user_low_id', 'user_high_id', unique=True ), )
+    
+    id = Column( Integer, primary_key=True )
+    user_low_id = Column( Integer, ForeignKey( 'users.id' ) )
+    user_high_id = Column( Integer, ForeignKey( 'users.id' ) )
+    first_crawl_id = Column( Integer )
+    last_seen_crawl_id = Column( Integer )
+    present = Column( Boolean, default=False )
+    
+    def __init__( self, userA_id, userB_id, crawl_id ):
+        self.user_low_id = min( userA_id, userB_id )
+        self.user_high_id = max( userA_id, userB_id )
+        self.first_crawl_id = crawl_id
+        self.last_seen_crawl_id = crawl_id
+        self.present = False
+    
+    def __repr__( self ):
+        return u"<FriendshipEdge('%d', '%d', '%s', '%s')>" % ( self.user_low_id, self.user_high_id, self.first_crawl_id, self.present )
+
+class FriendshipDelta( Base ):
+    """
+    A change to the friendship graph found by a crawl: `op` is 'A' when the
+    edge appears (or reappears) in crawl `crawl_id` and 'R' when an edge
+    present in the previous crawl was not found. The snapshot of a crawl is
+    the set of edges whose latest delta up to that crawl is an 'A'.
+    """
+    __tablename__ = 'friendship_deltas'
+    __table_args__ = ( Index( 'ix_friendship_deltas_crawl', 'crawl_id' ),
+                       Index( 'ix_friendship_deltas_edge_crawl', 'edge_id', 'crawl_id' ), )
+    
+    ADDED = 'A'
+    REMOVED = 'R'
+    
+    id = Column( Integer, primary_key=True )
+    crawl_id = Column( Integer )
+    edge_id = Column( Integer, ForeignKey( 'friendship_edges.id' ) )
+    op = Column( String( 1 ) )
+    date = Column( DateTime )
+    
+    def __init__( self, crawl_id, edge_id, op, date ):
+        self.crawl_id = crawl_id
+        self.edge_id = edge_id
+        self.op = op
+        self.date = date
+    
+    def __repr__( self ):
+        return u"<FriendshipDelta('%s', '%d', '%s')>" % ( self.crawl_id, self.edge_id, self.op )
         
     
\ No newline at end of file
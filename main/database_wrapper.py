@@ -15,43 +15,330 @@
 #   limitations under the License.
 
 
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
-from sqlalchemy.sql.expression import and_
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import create_engine, func
+from sqlalchemy.interfaces import PoolListener
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import and_, or_, bindparam
 from sqlite3 import dbapi2 as sqlite
 from datetime import datetime as now
+from contextlib import contextmanager
 from database import *
+from identity_cache import IdentityCache
+from sqlite_profile import get_profile, apply_profile
+from ingest_service import IngestClient, marshal, unmarshal
+from working_set import VenueWorkingSet
+from statistics_rollup import Summary, epoch, local_epoch
+import geokey
+import heapq
+import itertools
+import math
 import _credentials
 import logging
 
 DATABASE = _credentials.database
 MODULE=sqlite
 DEBUG=False
+SQLITE_PROFILE = get_profile( getattr( _credentials, 'sqlite_profile', None ) )
+# SQLite connections kept open between checkouts, per process
+SQLITE_POOL_SIZE = getattr( _credentials, 'sqlite_pool_size', 10 )
+
+# If set, writes are sent to the ingestion service at this address rather than
+# made directly (see ingest_service.py).
+INGEST_ADDRESS = getattr( _credentials, 'ingest_address', None )
+INGEST_AUTHKEY = getattr( _credentials, 'ingest_authkey', None )
+
+# Columns of ActivityCounter that are counts
+COUNTERS = [ 'checkins', 'new_users', 'new_venues', 'statistics' ]
+
+# Seconds in a CaptureRate day
+DAY = 86400
+
+# Mean radius of the earth (km), for distances between venues
+EARTH_RADIUS = 6371.0
+
+# Maximum number of entries held by each of the identity caches
+CACHE_SIZES = { 'users': 50000, 'venues': 20000, 'categories': 1000, 'locations': 20000 }
+
+class SQLiteProfileListener( PoolListener ):
+    """
+    Applies the SQLite connection profile (WAL journaling, busy timeout etc.)
+    to each new connection made by the engine's pool.
+    """
+    def __init__( self, profile ):
+        self.profile = profile
+
+    def connect( self, dbapi_con, con_record ):
+        apply_profile( dbapi_con, self.profile )
+
+# One engine (and so one connection pool) per database URL per process.
+_engines = {}
+
+def create_database_engine( url, pool_size=SQLITE_POOL_SIZE ):
+    """
+    Create the engine for database `url`. Connections to an SQLite file get the
+    connection profile and are kept open in a pool of `pool_size`, so that the
+    PRAGMAs are only run when a connection is first made; SQLAlchemy's default
+    for SQLite files (NullPool) opens a new connection at every checkout. The
+    pool never hands a connection to two threads at once, so the sqlite3
+    module's same-thread check is turned off. Beyond `pool_size` connections
+    are still made on demand, and closed when returned.
+
+    A `pool_size` of None keeps SQLAlchemy's default pool.
+    """
+    options = {}
+    if url.startswith( 'sqlite' ):
+        options['listeners'] = [ SQLiteProfileListener( SQLITE_PROFILE ) ]
+        if pool_size is not None and url.startswith( 'sqlite:///' ) and ':memory:' not in url:
+            options.update( poolclass=QueuePool, pool_size=pool_size, max_overflow=-1,
+                            connect_args={ 'check_same_thread': False } )
+    return create_engine( url, module=MODULE, echo=DEBUG, **options )
+
+def ingested( sync=True ):
+    """
+    Decorator for DBWrapper write methods. When the wrapper is in client mode
+    the call is forwarded to the ingestion service instead of being run here.
+
+    `sync` calls wait for the service to commit the write and return the
+    resulting object (re-read through this wrapper's session). Other calls
+    return None as soon as the service has queued the write; if the write
+    fails there, the next forwarded call raises IngestError for it.
+    """
+    def decorate( method ):
+        def wrapper( self, *args, **kwargs ):
+            if self.ingest is None:
+                return method( self, *args, **kwargs )
+            return self._send_to_ingest( method.__name__, args, kwargs, sync )
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        wrapper.ingested = True
+        return wrapper
+    return decorate
+
+def spread_by_day( start, end, increase ):
+    """
+    Spread `increase` evenly over the time from `start` to `end` (epoch seconds).
+
+    Output  list of ( day, share of the increase, seconds of the day covered ), one per day
+    """
+    rows = []
+    t = start
+    while t < end:
+        day = t - t % DAY
+        stop = min( end, day + DAY )
+        rows.append( ( day, increase * float( stop - t ) / ( end - start ), stop - t ) )
+        t = stop
+    return rows
+
+def venue_activity( summaries, has_checkins=False, last_checkin_at=None ):
+    """
+    The activity summary of one venue.
+
+    Input   'summaries': the venue's statistics, as DBWrapper._statistic_summaries() generates them
+            'has_checkins': True if any checkins of the venue are stored
+            'last_checkin_at': time of the latest of them
+
+    Output  dict of first_checkins, first_stat_date, last_checkins, last_users, last_stat_date,
+            last_statistic_id, last_checkin_at and active
+    """
+    entry = { 'first_checkins': None, 'first_stat_date': None, 'last_checkins': None, 'last_users': None,
+              'last_stat_date': None, 'last_statistic_id': None, 'last_checkin_at': None, 'active': False }
+    for venue_id, date, kind, row_id, s in summaries:
+        if entry['first_stat_date'] is None:
+            entry['first_checkins'] = s.first_checkins
+            entry['first_stat_date'] = s.first_date
+        elif s.max_checkins is not None and entry['last_checkins'] is not None and s.max_checkins > entry['last_checkins']:
+            entry['active'] = True
+        if s.max_checkins > s.first_checkins:
+            # an increase inside a rollup bucket
+            entry['active'] = True
+        entry['last_checkins'] = s.last_checkins
+        entry['last_users'] = s.last_users
+        entry['last_stat_date'] = s.last_date
+        entry['last_statistic_id'] = row_id if kind == 1 else None
+    if has_checkins:
+        entry['last_checkin_at'] = last_checkin_at
+        entry['active'] = True
+    return entry
+
+def expected_checkins( summaries ):
+    """
+    The checkinsCount increases shown by one venue's statistics, spread over the time between
+    them (and over the buckets of rollups). Dates are local time.
+
+    Input   'summaries': the venue's statistics, as DBWrapper._statistic_summaries() generates them
+
+    Output  dict of day -> [ expected checkins, seconds of the day covered ]
+    """
+    days = {}
+    def spread( start, end, increase ):
+        for day, expected, covered in spread_by_day( local_epoch( start ), local_epoch( end ), increase ):
+            entry = days.setdefault( day, [ 0.0, 0 ] )
+            entry[0] += expected
+            entry[1] += covered
+
+    previous = None
+    for venue_id, date, kind, row_id, s in summaries:
+        if previous is not None:
+            spread( previous.last_date, s.first_date, max( 0, s.first_checkins - previous.last_checkins ) )
+        spread( s.first_date, s.last_date, max( 0, s.last_checkins - s.first_checkins ) )
+        previous = s
+    return days
+
+def haversine( lat1, lng1, lat2, lng2 ):
+    """
+    Great circle distance in km between two points given in degrees.
+    """
+    lat1, lng1, lat2, lng2 = map( math.radians, ( lat1, lng1, lat2, lng2 ) )
+    a = math.sin( ( lat2 - lat1 ) / 2 ) ** 2 + math.cos( lat1 ) * math.cos( lat2 ) * math.sin( ( lng2 - lng1 ) / 2 ) ** 2
+    return 2 * EARTH_RADIUS * math.asin( min( 1.0, math.sqrt( a ) ) )
 
 class DBWrapper( object ):
     """
     A simple wrapper providing some higher level methods to make adding to and querying the database easier.
     Database settings can be adjusted above, and *should* allow changes of database.
 
+    Sessions are thread-local: each thread using the wrapper gets its own session through 
+    `self.session`. Long-running loops should call `end_cycle` after each pass (or use 
+    `unit_of_work`) so that the session, and everything loaded into it, is thrown away.
+
     Note: there are two methods included that aren't needed for day-to-day running of the code:
     __drop_tables__ and __create_tables__. Pretty self explanatory what they do. Shouldn't have to 
     say this, but for god's sake don't run __drop_tables__ EVER. It's just a convenience until the
     schema is correct. Then it'll be removed.
     """
-    def __init__( self ):
-        Session = sessionmaker(bind=self._get_engine())
-        self.session = Session()
+    def __init__( self, warm_caches=True, ingest_address=INGEST_ADDRESS ):
+        self.Session = scoped_session( sessionmaker( bind=self._get_engine() ) )
+        #
+        # When `deferred_commit` is set, write methods only flush; the owner
+        # of the wrapper (the ingestion service) decides when to commit.
+        self.deferred_commit = False
+        self.ingest = None
+        if ingest_address is not None:
+            self.ingest = IngestClient( ingest_address, INGEST_AUTHKEY )
         # 
         # Logging
         logging.basicConfig( filename="4sq.log", level=logging.DEBUG, 
         datefmt='%d/%m/%y|%H:%M:%S', format=u'|%(asctime)s|%(levelname)s| %(message)s'  )
+        #
+        # Identity caches: natural key -> row id
+        self.caches = {}
+        for name, size in CACHE_SIZES.items():
+            self.caches[name] = IdentityCache( name, size )
+        if warm_caches:
+            self.warm_caches( )
+
+    @property
+    def session( self ):
+        """
+        The session of the current thread.
+        """
+        return self.Session()
 
     def get_session( self ):
         return self.session
+
+    @contextmanager
+    def unit_of_work( self ):
+        """
+        Runs a block of work in a fresh session of its own, e.g.
+
+            with dbw.unit_of_work() as session:
+                ...
+
+        The session is committed at the end of the block (rolled back if the block raises)
+        and then discarded, along with every object loaded in it.
+        """
+        self.Session.remove()
+        try:
+            yield self.session
+            self.session.commit( )
+        except:
+            self.rollback( )
+            raise
+        finally:
+            self.Session.remove()
+
+    def end_cycle( self ):
+        """
+        Commits and discards the current thread's session. Objects loaded before the call are
+        detached: their loaded attributes can still be read, but nothing more will be loaded.
+        """
+        self.session.commit( )
+        self.Session.remove()
+
+    def _commit( self ):
+        if self.deferred_commit:
+            self.session.flush( )
+        else:
+            self.session.commit( )
+
+    def rollback( self ):
+        """
+        Roll back the current transaction. Ids handed out inside the transaction
+        may be reused, so the identity caches are emptied too.
+        """
+        self.session.rollback( )
+        for cache in self.caches.values():
+            cache.clear( )
+
+    def _send_to_ingest( self, method_name, args, kwargs, sync ):
+        result = self.ingest.call( method_name, marshal( args ), marshal( kwargs ), sync )
+        # pysqlite only opens a transaction for writes, so this read sees rows
+        # the service has just committed.
+        return unmarshal( result, self.session )
+        
+    
+    #### identity caches ####
+
+    def warm_caches( self ):
+        """
+        Pre-load the identity caches with the most recently added rows of each table.
+        Only (key, id) pairs are read; no ORM objects are built.
+        """
+        def recent( columns, id_column, name ):
+            rows = self.session.query( *columns ).order_by( id_column.desc( ) ).limit( CACHE_SIZES[name] ).all( )
+            rows.reverse( )
+            return rows
+
+        self.caches['users'].warm( recent( [User.foursq_id, User.id], User.id, 'users' ) )
+        self.caches['venues'].warm( recent( [Venue.foursq_id, Venue.id], Venue.id, 'venues' ) )
+        self.caches['categories'].warm( recent( [Category.foursq_id, Category.id], Category.id, 'categories' ) )
+        self.caches['locations'].warm( ( key, i ) for key, i in recent( [Location.geokey, Location.id], Location.id, 'locations' )
+                                       if key is not None )
+        logging.info( u'DBW Identity caches warmed: %s' % ', '.join( '%s=%d' % ( n, len( c ) ) for n, c in self.caches.items() ) )
+
+    def log_cache_stats( self ):
+        for cache in self.caches.values():
+            logging.info( u'DBW %r' % cache )
+
+    def _cached_get( self, cache_name, cls, key, query ):
+        """
+        Look up the row for `key` through the named identity cache. On a hit the
+        object is fetched by primary key (from the session's identity map where 
+        possible); on a miss `query` is run and a positive result is cached.
+
+        If a cached id no longer resolves to a row, the entry is dropped and the
+        full query is run instead.
+        """
+        if key is None:
+            return query.first( )
+        cache = self.caches[cache_name]
+        row_id = cache.get( key )
+        if row_id is not None:
+            obj = self.session.query( cls ).get( row_id )
+            if obj is not None:
+                return obj
+            cache.invalidate( key )
+        obj = query.first( )
+        if obj is not None:
+            cache.put( key, obj.id )
+        return obj
         
     
     #### categories ####
     
+    @ingested( sync=True )
     def add_category_to_database( self, cat ):
         """
         Add a category to the database. Current schema does not relate categories to parents/children.
@@ -60,11 +347,12 @@ class DBWrapper( object ):
         if c == None:
             c = Category( name=cat['name'], foursq_id=cat['id'] )
             self.session.add( c )
-            self.session.commit()
+            self._commit( )
+            self.caches['categories'].put( c.foursq_id, c.id )
         return c
 
     def get_category_from_database_by_name( self, name ):
-        return self.session.query( Category ).filter( category.name == name ).all( )
+        return self.session.query( Category ).filter( Category.name == name ).all( )
 
     def get_category_from_database( self, category ):
         """
@@ -74,116 +362,495 @@ class DBWrapper( object ):
 
         Output:     Category object
         """
-        return self.session.query( Category ).filter( Category.foursq_id==category.get( 'id' ) ).first()
+        foursq_id = category.get( 'id' )
+        return self._cached_get( 'categories', Category, foursq_id, 
+                                 self.session.query( Category ).filter( Category.foursq_id==foursq_id ) )
         
         
     #### locations #####
     
+    @ingested( sync=True )
     def add_location_to_database( self, loc ):
         """
         Input:      'loc': dict containing location with 'lat' and 'lng' keys.
 
-        Checks to see if the location is already in the database, matching to both latitude and longitude.
-         If it isn't, the location is added to the database.
+        Checks to see if the location is already in the database, matching on its geokey (the
+        latitude and longitude quantised, see geokey.py). If it isn't, the location is added to
+        the database.
         
         Output:     Location object
         """
-        l = self.session.query( Location ).filter( Location.latitude==loc.get( 'lat' ) ).filter( Location.longitude==loc.get( 'lng' ) ).first( )
+        key = geokey.encode( loc.get( 'lat' ), loc.get( 'lng' ) )
+        if key is None:
+            query = self.session.query( Location ).filter( Location.latitude==loc.get( 'lat' ) ).filter( Location.longitude==loc.get( 'lng' ) )
+        else:
+            query = self.session.query( Location ).filter( Location.geokey==key )
+        l = self._cached_get( 'locations', Location, key, query )
         if l == None:
-            logging.info( u'DBW Location not found in database: %.5f, %.5f' % ( loc.get( 'lat' ), loc.get( 'lng' ) ) )
-            l = Location( latitude=loc.get( 'lat' ), longitude=loc.get( 'lng' ) )
-            self.session.add( l )
-            self.session.commit( )
+            logging.info( u'DBW Location not found in database: %s, %s' % ( loc.get( 'lat' ), loc.get( 'lng' ) ) )
+            # another writer may have just added the same location. Rolling back an IntegrityError 
+            # would discard the rest of the transaction too (e.g. the ingestion service's deferred 
+            # batch), and pysqlite commits before a SAVEPOINT, so the insert skips a duplicate instead
+            self.session.execute( Location.__table__.insert( ).prefix_with( 'OR IGNORE' ),
+                                  { 'latitude': loc.get( 'lat' ), 'longitude': loc.get( 'lng' ), 'geokey': key } )
+            l = query.first( )
+            self._commit( )
+            self.caches['locations'].put( key, l.id )
         else:
             logging.info( u'DBW Location already in database: %.5f, %.5f' % ( l.latitude, l.longitude ) )
         return l
         
+    def migrate_location_keys( self, batch_size=10000 ):
+        """
+        Sets the geokey of locations stored before locations were keyed. Locations
+        that share a key are merged into the one with the lowest id (or the one 
+        already keyed), and their venues moved onto it.
+        
+        Output  number of duplicate locations merged
+        """
+        rows = self.session.query( Location.id, Location.latitude, Location.longitude ).filter( Location.geokey == None 
+                    ).filter( Location.latitude != None ).filter( Location.longitude != None ).order_by( Location.id ).all( )
+        if not rows:
+            return 0
+        keys = {}
+        for location_id, lat, lng in rows:
+            keys.setdefault( geokey.encode( lat, lng ), [] ).append( location_id )
+        keyed = {}
+        key_list = keys.keys( )
+        for i in range( 0, len( key_list ), 500 ):
+            for key, location_id in self.session.query( Location.geokey, Location.id ).filter( Location.geokey.in_( key_list[i:i + 500] ) ):
+                keyed[key] = location_id
+
+        merges = []
+        updates = []
+        for key, ids in keys.items( ):
+            keep = keyed.get( key )
+            if keep is None:
+                keep = ids.pop( 0 )
+                updates.append( { 'location_id': keep, 'key': key } )
+            merges.extend( { 'location_id': i, 'keep_id': keep } for i in ids )
+
+        for i in range( 0, len( merges ), batch_size ):
+            batch = merges[i:i + batch_size]
+            self.session.execute( Venue.__table__.update( ).where( Venue.location_id == bindparam( 'location_id' ) 
+                                    ).values( location_id=bindparam( 'keep_id' ) ), batch )
+            self.session.execute( Location.__table__.delete( ).where( Location.id == bindparam( 'location_id' ) ), batch )
+            self.session.commit( )
+        for i in range( 0, len( updates ), batch_size ):
+            self.session.execute( Location.__table__.update( ).where( Location.id == bindparam( 'location_id' ) 
+                                    ).values( geokey=bindparam( 'key' ) ), updates[i:i + batch_size] )
+            self.session.commit( )
+        self.caches['locations'].clear( )
+        logging.info( u'DBW Keyed %d locations, merged %d duplicates' % ( len( updates ), len( merges ) ) )
+        return len( merges )
+    
     
     #### stats & searches ####
 
+    @ingested( sync=False )
     def add_statistics_to_database( self, venue, stats ):
         """
         Input   'venue': Venue object, the venue to which the statistics relate.
                 'stats': dict containing statistic information with 'checkinsCount' and 'usersCount' keys.
 
-        Adds a new set of statistics to the database for a venue. Adds the current date and time to the statistics.
+        Adds a new set of statistics to the database for a venue, dated with the current date and time. 
+        If the statistics are unchanged since the venue's last statistics, no row is added; the
+        `confirmed_at` time of the existing row is updated instead.
 
-        Output  Statistics object
+        Output  Statistics object (None in ingestion client mode)
         """
-        s = Statistic( venue.id, now.now( ), stats['checkinsCount'], stats['usersCount'] )
-        logging.info(u'DBW Statistics added: %d checkins, %d users' %  (stats['checkinsCount'], stats['usersCount']) )
-        self.session.add( s )
-        self.session.commit( )
+        date = now.now( )
+        checkins = stats['checkinsCount']
+        users = stats['usersCount']
+        last_checkins, last_users, last_statistic_id, last_stat_date = self.session.query( Venue.last_checkins, Venue.last_users, 
+                                                            Venue.last_statistic_id, Venue.last_stat_date ).filter( Venue.id == venue.id ).one( )
+        if last_statistic_id is not None and last_checkins == checkins and last_users == users:
+            s = self.session.query( Statistic ).get( last_statistic_id )
+        else:
+            s = None
+        if s is not None:
+            s.confirmed_at = date
+            logging.info(u'DBW Statistics unchanged: %d checkins, %d users' %  ( checkins, users ) )
+        else:
+            s = Statistic( venue.id, date, checkins, users )
+            logging.info(u'DBW Statistics added: %d checkins, %d users' %  ( checkins, users ) )
+            self.session.add( s )
+            self.bump_activity_counters( venue.city_code, epoch( date ), statistics=1 )
+        if last_stat_date is not None and last_checkins is not None:
+            # statistics dates are local time; checkin createdAt, and so the capture rate days, are UTC
+            self._add_expected_checkins( venue.id, local_epoch( last_stat_date ), local_epoch( date ), max( 0, checkins - last_checkins ) )
+        self._update_venue_statistics( venue, s, date )
+        self._commit( )
         return s
 
-    def add_crawl_to_database( self, crawltype, flag, date  ):
+    def get_statistics_series( self, venue, start=None, end=None, resolution=None ):
+        """
+        Input   'venue': Venue object (or VenueRecord)
+                'start', 'end': (optional) datetimes bounding the series
+                'resolution': (optional) timedelta between samples
+
+        Rebuilds the time series of a venue's statistics from the change-only rows and the
+        rollups of older statistics (where the first and last values of each bucket are used).
+
+        Output  Without a resolution, the stored changes as a list of (date, checkins, users) 
+                tuples. With a resolution, one (time, checkins, users) sample every `resolution` 
+                from `start` (default: the first statistic) to `end` (default: the last time the 
+                statistics were seen), taking the values in force at that time.
+        """
+        changes = []
+        for venue_id, date, kind, row_id, summary in self._statistic_summaries( venue.id ):
+            if kind == 0 and summary.last_date != summary.first_date:
+                changes.append( ( summary.first_date, summary.first_date, summary.first_checkins, summary.first_users ) )
+                changes.append( ( summary.last_date, summary.last_date, summary.last_checkins, summary.last_users ) )
+            else:
+                changes.append( ( summary.first_date, summary.last_date, summary.first_checkins, summary.first_users ) )
+        if resolution is None:
+            return [ ( date, checkins, users ) for date, confirmed_at, checkins, users in changes
+                     if ( start is None or date >= start ) and ( end is None or date <= end ) ]
+        if not changes:
+            return []
+        if start is None:
+            start = changes[0][0]
+        if end is None:
+            end = max( confirmed_at or date for date, confirmed_at, checkins, users in changes )
+        series = []
+        i = -1
+        t = start
+        while t <= end:
+            while i + 1 < len( changes ) and changes[i+1][0] <= t:
+                i += 1
+            if i >= 0:
+                series.append( ( t, changes[i][2], changes[i][3] ) )
+            t += resolution
+        return series
+
+    def _statistic_summaries( self, venue_id=None ):
+        """
+        All statistics of one venue, or of every venue, from both the statistics table and the 
+        rollups. Generates (venue_id, first date, kind, row id, Summary) tuples in venue and date
+        order; kind is 0 for a rollup and 1 for a statistics row.
+        """
+        raw = self.session.query( Statistic.venue_id, Statistic.date, Statistic.id, Statistic.confirmed_at,
+                                  Statistic.checkins, Statistic.users )
+        rolled = self.session.query( StatisticRollup.venue_id, StatisticRollup.first_date, StatisticRollup.id, 
+                                     *[ getattr( StatisticRollup, name ) for name in Summary.__slots__ ] )
+        if venue_id is not None:
+            raw = raw.filter( Statistic.venue_id == venue_id )
+            rolled = rolled.filter( StatisticRollup.venue_id == venue_id )
+        raw = raw.order_by( Statistic.venue_id, Statistic.date, Statistic.id ).yield_per( 10000 )
+        rolled = rolled.order_by( StatisticRollup.venue_id, StatisticRollup.first_date ).yield_per( 10000 )
+
+        def from_raw():
+            for v, date, row_id, confirmed_at, checkins, users in raw:
+                yield ( v, date, 1, row_id, Summary.from_statistic( date, confirmed_at, checkins, users ) )
+        def from_rolled():
+            for row in rolled:
+                summary = Summary()
+                for name, value in zip( Summary.__slots__, row[3:] ):
+                    setattr( summary, name, value )
+                yield ( row[0], row[1], 0, row[2], summary )
+        return heapq.merge( from_rolled(), from_raw() )
+
+    def compress_statistics( self, batch_size=10000 ):
+        """
+        Converts an existing statistics table to change-only storage: rows that repeat the 
+        previous statistics of the same venue are deleted and the previous row's `confirmed_at`
+        is moved forward instead. Works through the table one venue at a time, committing every
+        `batch_size` deleted rows. The venue summaries are rebuilt afterwards.
+
+        Output  number of rows deleted
+        """
+        self.session.execute( "UPDATE statistics SET confirmed_at = date WHERE confirmed_at IS NULL" )
+        self.session.commit( )
+        venue_ids = [ row[0] for row in self.session.query( Statistic.venue_id ).distinct( ).all( ) ]
+        def rows():
+            for venue_id in venue_ids:
+                for row in self.session.query( Statistic.venue_id, Statistic.id, Statistic.confirmed_at, Statistic.checkins,
+                                               Statistic.users ).filter( Statistic.venue_id == venue_id 
+                                             ).order_by( Statistic.date, Statistic.id ).all( ):
+                    yield row
+        kept = None     # [venue_id, id, confirmed_at, checkins, users, changed]
+        deletes = []
+        confirms = []
+        deleted = 0
+        def write():
+            if deletes:
+                self.session.execute( Statistic.__table__.delete().where( Statistic.id == bindparam( 'statistic_id' ) ), deletes )
+            if confirms:
+                self.session.execute( Statistic.__table__.update().where( Statistic.id == bindparam( 'statistic_id' ) 
+                                        ).values( confirmed_at=bindparam( 'confirmed' ) ), confirms )
+            self.session.commit( )
+            del deletes[:]
+            del confirms[:]
+
+        for venue_id, statistic_id, confirmed_at, checkins, users in rows():
+            if kept is not None and kept[0] == venue_id and kept[3] == checkins and kept[4] == users:
+                deletes.append( { 'statistic_id': statistic_id } )
+                kept[2] = max( kept[2], confirmed_at )
+                kept[5] = True
+                deleted += 1
+                continue
+            if kept is not None and kept[5]:
+                confirms.append( { 'statistic_id': kept[1], 'confirmed': kept[2] } )
+            kept = [ venue_id, statistic_id, confirmed_at, checkins, users, False ]
+            if len( deletes ) >= batch_size:
+                write()
+        if kept is not None and kept[5]:
+            confirms.append( { 'statistic_id': kept[1], 'confirmed': kept[2] } )
+        write()
+        logging.info( u'DBW Compressed statistics: %d rows deleted' % deleted )
+        self.rebuild_venue_activity( )
+        self.rebuild_activity_counters( )
+        return deleted
+
+    @ingested( sync=True )
+    def add_crawl_to_database( self, crawltype, flag, date, run_id=None ):
         """
         Input   'crawltype': The type of crawl being carried out, Venue Search, Monitor Checkins, Check Stats etc.
-                'flag': Flag for 'START' or 'FINISH' of the crawl.
+                'flag': Flag for 'START', 'RESUME' or 'FINISH' of the crawl.
                 'date': Time the crawl was started or stopped.
+                'run_id': Identifies the run of the crawl, see checkpoint.start_run()
 
         Adds a log to the database when a particular crawl is started.
 
         Output  The CrawlLog object
         """
-        c = CrawlLog(crawltype, flag, date)
+        c = CrawlLog(crawltype, flag, date, run_id)
         self.session.add(c)
-        self.session.commit()
+        self._commit( )
         return c
     
     
     #### friendship ####
+    #
+    # Friendships are stored as undirected edges (FriendshipEdge) plus the
+    # changes found by each crawl (FriendshipDelta). A crawl calls
+    # add_friendship_to_database for every friendship it finds and then
+    # finish_friendship_crawl, which records the edges that have gone.
     
+    @ingested( sync=True )
     def add_friendship_to_database( self, userA, userB, crawl_id=None ):
         """
         Input
-            userA, userB: User objects from database.
+            userA, userB: User objects from database, in either order.
+            crawl_id: the crawl in which the friendship was found. Defaults
+                to the latest crawl.
+        
+        Records that the friendship was seen in crawl `crawl_id`. Adding the
+        same friendship more than once in a crawl (e.g. once from each side)
+        has no further effect.
+        
+        Output  the FriendshipEdge
+        """
+        if crawl_id is None:
+            crawl_id = self.get_friendships_max_crawl_id( ) or 1
+        low_id, high_id = min( userA.id, userB.id ), max( userA.id, userB.id )
+        edge = self.session.query( FriendshipEdge ).filter( FriendshipEdge.user_low_id == low_id
+                    ).filter( FriendshipEdge.user_high_id == high_id ).first( )
+        if edge is None:
+            edge = FriendshipEdge( low_id, high_id, crawl_id )
+            self.session.add( edge )
+            self.session.flush( )
+        if not edge.present:
+            self.session.add( FriendshipDelta( crawl_id, edge.id, FriendshipDelta.ADDED, now.now() ) )
+            edge.present = True
+        edge.last_seen_crawl_id = max( edge.last_seen_crawl_id, crawl_id )
+        self._commit( )
+        return edge
+    
+    @ingested( sync=True )
+    def finish_friendship_crawl( self, crawl_id, crawled_user_ids=None ):
+        """
+        Input
+            crawl_id: the crawl that has just finished.
+            crawled_user_ids: (optional) ids of the users whose friends were 
+                fetched by the crawl. If given, only edges touching one of 
+                these users can be removed, so that users the crawl failed to
+                fetch don't lose their friendships.
         
-        This method only adds one row to the database.
-        The date crawled is automatically taken as the current time.
+        Records a removal for every edge present before the crawl that the
+        crawl did not see.
+        
+        Output  number of edges removed
         """
-        date_crawled = now.now()
-        f = Friendship( userA, userB, date_crawled, crawl_id )
-        self.session.add( f )
-        self.session.commit()
-        return f
+        self.session.flush( )
+        rows = self.session.query( FriendshipEdge.id, FriendshipEdge.user_low_id, FriendshipEdge.user_high_id
+                    ).filter( FriendshipEdge.present == True ).filter( FriendshipEdge.last_seen_crawl_id < crawl_id ).all( )
+        if crawled_user_ids is not None:
+            crawled_user_ids = set( crawled_user_ids )
+            rows = [ r for r in rows if r[1] in crawled_user_ids or r[2] in crawled_user_ids ]
+        if rows:
+            date = now.now()
+            self.session.execute( FriendshipDelta.__table__.insert(),
+                                  [ { 'crawl_id': crawl_id, 'edge_id': r[0], 'op': FriendshipDelta.REMOVED, 'date': date } for r in rows ] )
+            self.session.execute( FriendshipEdge.__table__.update().where( FriendshipEdge.id == bindparam( 'edge_id' ) 
+                                    ).values( present=False ), [ { 'edge_id': r[0] } for r in rows ] )
+        self._commit( )
+        logging.info( u'DBW friendship crawl %s finished: %d edges removed' % ( crawl_id, len( rows ) ) )
+        return len( rows )
         
     def get_friendships_max_crawl_id( self ):
         """
-        Find the highest crawl_id in the friendships table. 
-        Returns None if there are no crawl_ids were found.
+        Find the highest crawl_id recorded, in the edge store or the legacy
+        friendships table. Returns None if no crawls were found.
         """
-        stmt = "SELECT max(crawl_id) as max_id FROM friendships"
-        result_row = self.session.query( "max_id" ).from_statement( stmt ).first()
-        max_id = result_row[0]
-        return max_id
+        ids = [ self.session.query( func.max( FriendshipEdge.last_seen_crawl_id ) ).scalar( ),
+                self.session.query( func.max( FriendshipDelta.crawl_id ) ).scalar( ),
+                self.session.query( func.max( Friendship.crawl_id ) ).scalar( ) ]
+        ids = [ i for i in ids if i is not None ]
+        return max( ids ) if ids else None
 
     def get_friendship_from_database( self, userA, userB, crawl_id=None ):
         """
         Input
-            userA, userB: user objects.
-            crawl_id: (optional) if included, only looks for the friendship 
-                in the particular run. otherwise, all copies of the friendship
-                are returned.
-        
-        Retrieves the specified friendship from the database. There may be
-        multiple matches because the same friendship maybe have been mined
-        and stored on multiple occasions.
+            userA, userB: user objects, in either order.
+            crawl_id: (optional) if included, only returns the friendship if
+                it was present in that crawl.
         
-        Output  List of friendship objects. If none found, list length is 0.
+        Output  List holding the FriendshipEdge. If none found, list length is 0.
         """
-        userA_id = userA.id
-        userB_id = userB.id
+        low_id, high_id = min( userA.id, userB.id ), max( userA.id, userB.id )
+        edge = self.session.query( FriendshipEdge ).filter( FriendshipEdge.user_low_id == low_id
+                    ).filter( FriendshipEdge.user_high_id == high_id ).first( )
+        if edge is None:
+            return []
         if crawl_id is not None:
-            results = self.session.query( Friendship ).filter( and_(
-                Friendship.userA_id==userA_id,
-                Friendship.userB_id==userB_id,
-                Friendship.crawl_id==crawl_id ) ).all()
-        else:
-            results = self.session.query( Friendship ).filter( and_(
-                Friendship.userA_id==userA_id,
-                Friendship.userB_id==userB_id ) ).all()
-        return results 
+            op = self.session.query( FriendshipDelta.op ).filter( FriendshipDelta.edge_id == edge.id
+                    ).filter( FriendshipDelta.crawl_id <= crawl_id ).order_by( FriendshipDelta.crawl_id.desc( ), 
+                                                                              FriendshipDelta.id.desc( ) ).first( )
+            if op is None or op[0] != FriendshipDelta.ADDED:
+                return []
+        return [ edge ]
+    
+    def _friendship_snapshot_rows( self, crawl_id ):
+        return self.session.execute( """SELECT e.user_low_id, e.user_high_id
+                                        FROM friendship_edges e JOIN friendship_deltas d ON d.edge_id = e.id
+                                        WHERE d.op = :added AND d.crawl_id = (
+                                            SELECT MAX( d2.crawl_id ) FROM friendship_deltas d2
+                                            WHERE d2.edge_id = d.edge_id AND d2.crawl_id <= :crawl_id )
+                                        ORDER BY e.user_low_id, e.user_high_id""",
+                                     { 'added': FriendshipDelta.ADDED, 'crawl_id': crawl_id } )
+    
+    def get_friendship_snapshot( self, crawl_id ):
+        """
+        Rebuilds the friendship graph as found by crawl `crawl_id`.
+        
+        Output  list of ( user_low_id, user_high_id ) tuples, one per friendship
+        """
+        return [ ( row[0], row[1] ) for row in self._friendship_snapshot_rows( crawl_id ) ]
+    
+    def iter_friendships( self, crawl_id ):
+        """
+        Streams the friendships of crawl `crawl_id` in both directions, in the
+        same shape as rows of the legacy friendships table.
+        
+        Output  generator of ( userA_id, userB_id ) tuples, two per friendship
+        """
+        for low_id, high_id in self._friendship_snapshot_rows( crawl_id ):
+            yield ( low_id, high_id )
+            yield ( high_id, low_id )
+    
+    def get_friendship_changes( self, after_crawl_id, crawl_id ):
+        """
+        The friendship deltas of the crawls after `after_crawl_id` up to and
+        including `crawl_id`, oldest first.
+        
+        Output  list of ( user_low_id, user_high_id, op ) tuples
+        """
+        return self.session.execute( """SELECT e.user_low_id, e.user_high_id, d.op
+                                        FROM friendship_deltas d JOIN friendship_edges e ON e.id = d.edge_id
+                                        WHERE d.crawl_id > :after_crawl_id AND d.crawl_id <= :crawl_id
+                                        ORDER BY d.crawl_id, d.id""",
+                                     { 'after_crawl_id': after_crawl_id, 'crawl_id': crawl_id } ).fetchall( )
+    
+    def migrate_friendships( self ):
+        """
+        Copies the legacy friendships table into the edge store, one crawl at
+        a time in crawl order. Rows without a crawl_id are treated as crawl 0.
+        Crawls that already have deltas in the edge store are skipped, so this
+        can be re-run after an interrupted migration. The legacy table is left
+        in place.
+        
+        crawl_friends runs this before every crawl, so that legacy crawls come
+        before the new ones. A legacy crawl older than crawls already in the
+        edge store (crawled before the migration was run) is slotted in before
+        them, see _migrate_friendship_crawl_before().
+        
+        Output  number of crawls migrated
+        """
+        crawl_ids = [ row[0] for row in self.session.execute( 
+                        """SELECT DISTINCT COALESCE( crawl_id, 0 ) FROM friendships
+                           WHERE COALESCE( crawl_id, 0 ) NOT IN ( SELECT DISTINCT crawl_id FROM friendship_deltas )
+                           ORDER BY 1""" ) ]
+        for crawl_id in crawl_ids:
+            params = { 'crawl_id': crawl_id, 'added': FriendshipDelta.ADDED, 'removed': FriendshipDelta.REMOVED, 'date': now.now() }
+            # temp tables belong to the connection, so these only live for the crawl's transaction
+            self.session.execute( "CREATE TEMP TABLE IF NOT EXISTS migrate_pairs ( lo INTEGER, hi INTEGER, PRIMARY KEY ( lo, hi ) )" )
+            self.session.execute( "DELETE FROM migrate_pairs" )
+            self.session.execute( """INSERT OR IGNORE INTO migrate_pairs
+                                     SELECT MIN( userA_id, userB_id ), MAX( userA_id, userB_id ) FROM friendships
+                                     WHERE COALESCE( crawl_id, 0 ) = :crawl_id""", params )
+            self.session.execute( """INSERT INTO friendship_edges ( user_low_id, user_high_id, first_crawl_id, last_seen_crawl_id, present )
+                                     SELECT lo, hi, :crawl_id, :crawl_id, 0 FROM migrate_pairs p WHERE NOT EXISTS (
+                                        SELECT 1 FROM friendship_edges e WHERE e.user_low_id = p.lo AND e.user_high_id = p.hi )""", params )
+            later = self.session.execute( "SELECT MIN( crawl_id ) FROM friendship_deltas WHERE crawl_id > :crawl_id", params ).scalar( )
+            if later is not None:
+                params['later'] = later
+                self._migrate_friendship_crawl_before( params )
+                self.session.execute( "DROP TABLE migrate_pairs" )
+                self._commit( )
+            else:
+                self.session.execute( """INSERT INTO friendship_deltas ( crawl_id, edge_id, op, date )
+                                         SELECT :crawl_id, e.id, :added, :date FROM friendship_edges e 
+                                         WHERE NOT e.present AND EXISTS (
+                                            SELECT 1 FROM migrate_pairs p WHERE e.user_low_id = p.lo AND e.user_high_id = p.hi )""", params )
+                self.session.execute( """UPDATE friendship_edges SET present = 1, last_seen_crawl_id = :crawl_id
+                                         WHERE EXISTS (
+                                            SELECT 1 FROM migrate_pairs p WHERE user_low_id = p.lo AND user_high_id = p.hi )""", params )
+                self.session.execute( "DROP TABLE migrate_pairs" )
+                self.finish_friendship_crawl( crawl_id )
+            logging.info( u'DBW migrated friendship crawl %s' % crawl_id )
+        return len( crawl_ids )
+    
+    def _migrate_friendship_crawl_before( self, params ):
+        """
+        Migrate legacy crawl `crawl_id` (its pairs in migrate_pairs, their edges
+        created) into an edge store that already holds a later crawl, `later`:
+        its deltas are taken against the edges present before it (by their
+        latest delta) rather than the current ones, and the deltas of crawl
+        `later`, recorded without it, are restated against it, so that every
+        crawl's snapshot comes out as it was found.
+        """
+        self.session.execute( "CREATE TEMP TABLE IF NOT EXISTS migrate_before ( edge_id INTEGER PRIMARY KEY )" )
+        self.session.execute( "CREATE TEMP TABLE IF NOT EXISTS migrate_seen ( edge_id INTEGER PRIMARY KEY )" )
+        self.session.execute( "DELETE FROM migrate_before" )
+        self.session.execute( "DELETE FROM migrate_seen" )
+        self.session.execute( """INSERT INTO migrate_before
+                                 SELECT d.edge_id FROM friendship_deltas d WHERE d.op = :added AND d.id = (
+                                    SELECT d2.id FROM friendship_deltas d2 WHERE d2.edge_id = d.edge_id AND d2.crawl_id < :crawl_id
+                                    ORDER BY d2.crawl_id DESC, d2.id DESC LIMIT 1 )""", params )
+        self.session.execute( """INSERT INTO migrate_seen
+                                 SELECT e.id FROM friendship_edges e JOIN migrate_pairs p ON e.user_low_id = p.lo AND e.user_high_id = p.hi""" )
+        # crawl `later` recorded no delta where it found an edge as it was before this crawl: where this crawl 
+        # changed the edge, `later` now changes it back; where `later` made the same change as this crawl, it is dropped
+        self.session.execute( """INSERT INTO friendship_deltas ( crawl_id, edge_id, op, date )
+                                 SELECT :later, edge_id, :added, :date FROM migrate_before b WHERE edge_id NOT IN ( SELECT edge_id FROM migrate_seen )
+                                    AND NOT EXISTS ( SELECT 1 FROM friendship_deltas d WHERE d.edge_id = b.edge_id AND d.crawl_id = :later )
+                                 UNION ALL
+                                 SELECT :later, edge_id, :removed, :date FROM migrate_seen s WHERE edge_id NOT IN ( SELECT edge_id FROM migrate_before )
+                                    AND NOT EXISTS ( SELECT 1 FROM friendship_deltas d WHERE d.edge_id = s.edge_id AND d.crawl_id = :later )""", params )
+        self.session.execute( """DELETE FROM friendship_deltas WHERE crawl_id = :later AND (
+                                    ( op = :added AND edge_id IN ( SELECT edge_id FROM migrate_seen ) ) OR
+                                    ( op = :removed AND edge_id NOT IN ( SELECT edge_id FROM migrate_seen ) ) )""", params )
+        self.session.execute( """INSERT INTO friendship_deltas ( crawl_id, edge_id, op, date )
+                                 SELECT :crawl_id, edge_id, :added, :date FROM migrate_seen WHERE edge_id NOT IN ( SELECT edge_id FROM migrate_before )
+                                 UNION ALL
+                                 SELECT :crawl_id, edge_id, :removed, :date FROM migrate_before WHERE edge_id NOT IN ( SELECT edge_id FROM migrate_seen )""", params )
+        self.session.execute( """UPDATE friendship_edges SET first_crawl_id = MIN( first_crawl_id, :crawl_id ),
+                                    last_seen_crawl_id = MAX( last_seen_crawl_id, :crawl_id )
+                                 WHERE id IN ( SELECT edge_id FROM migrate_seen )""", params )
+        self.session.execute( "DROP TABLE migrate_before" )
+        self.session.execute( "DROP TABLE migrate_seen" )
     
     
     #### venues ####
@@ -192,7 +859,7 @@ class DBWrapper( object ):
         """
         Count all the venues in the database
         """
-        return len( self.session.query( Venue ).all( ) )
+        return self.session.query( func.count( Venue.id ) ).scalar( )
     
     def get_venues_by_category( self, category ):
         """
@@ -202,14 +869,9 @@ class DBWrapper( object ):
 
         Output  list of all venues matching that category.
         """
-        venues = self.session.query(Venue).all()
-        v = []
-        for venue in venues:
-            if venue.category:
-                if venue.category.foursq_id == category.foursq_id:
-                    v.append(venue)
-        return v
+        return self.session.query( Venue ).join( Venue.category ).filter( Category.foursq_id == category.foursq_id ).all( )
     
+    @ingested( sync=True )
     def add_venue_to_database( self, venue, citycode ):
         """
         Input       'venue': dict containing venue information with 'id', 'name' and 'verified' keys and dicts with location, 
@@ -236,11 +898,14 @@ class DBWrapper( object ):
                     v.category_id = c.id
                     v.category = c
             self.session.add( v )
-            self.session.commit( )
+            self.session.flush( )
+            self._index_venue_location( v, l )
+            self._commit( )
+            self.caches['venues'].put( v.foursq_id, v.id )
 
             stat = venue['stats']
             self.add_statistics_to_database( v, stat )
-            self.session.commit( )
+            self._commit( )
         else:
             logging.info( u'DBW Venue already in database: %s' % (v.name) )
         return v
@@ -255,14 +920,24 @@ class DBWrapper( object ):
         """
         return self.session.query( Venue ).filter( Venue.name==name ).first( )
     
-    def get_all_venues( self ):
+    def get_all_venues( self, after_id=None, limit=None ):
         """
-        Retrieves all venues from the database.
+        Input   'after_id': only retrieve the venues with a greater id, e.g. to resume a crawl
+                'limit': retrieve at most this many venues, e.g. to walk the venues in batches
+
+        Retrieves all venues from the database, in id order.
 
         Output  list of Venue objects
         """
-        return self.session.query( Venue ).all( )
+        query = self.session.query( Venue )
+        if after_id is not None:
+            query = query.filter( Venue.id > after_id )
+        query = query.order_by( Venue.id )
+        if limit is not None:
+            query = query.limit( limit )
+        return query.all( )
 
+    @ingested( sync=True )
     def update_mayor( self, venue, mayor ):
         """
         Input   'venue': dict containing venue information, foursquare 'id' is used to match venues
@@ -280,7 +955,7 @@ class DBWrapper( object ):
             v.mayor_id = u.id
             v.mayor = u
             self.session.add( v )
-            self.session.commit( )
+            self._commit( )
 
     def get_venue_from_database( self, venue ):
         """
@@ -290,7 +965,8 @@ class DBWrapper( object ):
         
         Output  Venue object. Will be 'None' if venue does not exist in the database. 
         """
-        return self.session.query( Venue ).filter( Venue.foursq_id==venue['id'] ).first( )
+        return self._cached_get( 'venues', Venue, venue['id'],
+                                 self.session.query( Venue ).filter( Venue.foursq_id==venue['id'] ) )
 
 
     def get_all_venues_with_checkins( self ):
@@ -309,25 +985,109 @@ class DBWrapper( object ):
         venues = self.session.query(Venue).from_statement(stmt).all()
         return venues
     
+    def count_venues_with_checkins( self ):
+        """
+        Count the venues where someone has checked in at least once.
+        """
+        return self.session.query( func.count( func.distinct( Checkin.venue_id ) ) ).scalar( )
+
+    def count_venues_in_city( self, citycode ):
+        """
+        Count the venues with the given citycode
+        """
+        return self.session.query( func.count( Venue.id ) ).filter( Venue.city_code == citycode ).scalar( )
+    
     def is_active(self, venue):
         """
-        Checks to see if a venue is active. Compares the first number of recorded checkins against
-        the most recent number of recorded checkins. If there are new checkins, the venue is active,
-        if not, the venue is inactive.
+        Checks to see if a venue is active: a venue is active if a checkin has been captured there,
+        or if its checkinsCount has increased between any two recorded statistics.
+
+        This reads the venue's denormalised `active` flag; see rebuild_venue_activity().
 
         Output:  True/False depending on if the venue is active
         """
-        if len(venue.checkins) > 0:
-            return True
-        else:
-            for i, stat in enumerate(venue.statistics):
-                if i > 0:
-                    if venue.statistics[i].checkins > venue.statistics[i-1].checkins:
-                        return True
-        if len(venue.statistics) > 1:
-            return venue.statistics[0].checkins < venue.statistics[-1].checkins
-        else:
-            return False
+        return bool( venue.active )
+
+    def get_active_venues_in_city( self, citycode ):
+        """
+        Retrieves all active venues with the given citycode (a single indexed query).
+
+        Output: a list of Venue objects
+        """
+        return self.session.query( Venue ).filter( Venue.city_code == citycode ).filter( Venue.active == True ).all( )
+
+    def _update_venue_statistics( self, venue, statistic, date ):
+        """
+        Update the venue's activity summary for statistics seen at `date` (stored in `statistic`).
+        Done in SQL so that the venue doesn't need to be loaded, and so that concurrent writers
+        can't lose an update.
+        """
+        self.session.flush( )
+        self.session.execute( """UPDATE venues SET
+                                    first_checkins = COALESCE( first_checkins, :checkins ),
+                                    first_stat_date = COALESCE( first_stat_date, :date ),
+                                    active = CASE WHEN active OR ( last_checkins IS NOT NULL AND :checkins > last_checkins )
+                                                  THEN 1 ELSE 0 END,
+                                    last_checkins = :checkins,
+                                    last_users = :users,
+                                    last_stat_date = :date,
+                                    last_statistic_id = :statistic_id
+                                 WHERE id = :venue_id """,
+                              { 'checkins': statistic.checkins, 'users': statistic.users, 'date': date,
+                                'statistic_id': statistic.id, 'venue_id': venue.id } )
+        self._expire_venue( venue )
+
+    def _update_venue_checkins( self, venue, checkin ):
+        """
+        Update the venue's activity summary for a newly captured checkin.
+
+        Output  True if it is the venue's first checkin (no last_checkin_at yet)
+        """
+        first = self.session.execute( "SELECT last_checkin_at IS NULL FROM venues WHERE id = :venue_id",
+                                      { 'venue_id': venue.id } ).scalar( )
+        self.session.execute( """UPDATE venues SET
+                                    active = 1,
+                                    last_checkin_at = MAX( COALESCE( last_checkin_at, 0 ), :created_at )
+                                 WHERE id = :venue_id """,
+                              { 'created_at': checkin.created_at, 'venue_id': venue.id } )
+        self._expire_venue( venue )
+        return bool( first )
+
+    def _expire_venue( self, venue ):
+        if isinstance( venue, Venue ) and venue in self.session:
+            self.session.expire( venue, [ 'first_checkins', 'first_stat_date', 'last_checkins', 'last_users', 'last_stat_date',
+                                          'last_statistic_id', 'last_checkin_at', 'active' ] )
+
+    def rebuild_venue_activity( self ):
+        """
+        Recomputes the activity summary of every venue from the statistics (and rollups) and
+        checkins tables, e.g. after upgrading an existing database. Statistics are read once, in
+        venue order.
+
+        Output: number of active venues
+        """
+        checkins = dict( self.session.query( Checkin.venue_id, func.max( Checkin.created_at ) ).group_by( Checkin.venue_id ) )
+        summary = {}
+        for venue_id, summaries in itertools.groupby( self._statistic_summaries( ), lambda row: row[0] ):
+            summary[venue_id] = venue_activity( summaries, venue_id in checkins, checkins.pop( venue_id, None ) )
+        for venue_id, created_at in checkins.items():
+            summary[venue_id] = venue_activity( [], True, created_at )
+        for venue_id, entry in summary.items():
+            entry['venue_id'] = venue_id
+
+        self.session.execute( """UPDATE venues SET first_checkins = NULL, first_stat_date = NULL, last_checkins = NULL,
+                                    last_users = NULL, last_stat_date = NULL, last_statistic_id = NULL,
+                                    last_checkin_at = NULL, active = 0 """ )
+        params = summary.values()
+        if params:
+            self.session.execute( Venue.__table__.update().where( Venue.id == bindparam( 'venue_id' ) ).values(
+                                    first_checkins=bindparam( 'first_checkins' ), first_stat_date=bindparam( 'first_stat_date', type_=DateTime ),
+                                    last_checkins=bindparam( 'last_checkins' ), last_users=bindparam( 'last_users' ),
+                                    last_stat_date=bindparam( 'last_stat_date', type_=DateTime ), last_statistic_id=bindparam( 'last_statistic_id' ),
+                                    last_checkin_at=bindparam( 'last_checkin_at' ), active=bindparam( 'active' ) ), params )
+        self.session.commit( )
+        self.session.expire_all( )
+        return len( [ p for p in params if p['active'] ] )
 
     def get_venues_in_city( self, citycode ):
         """
@@ -337,19 +1097,225 @@ class DBWrapper( object ):
         """
         return self.session.query( Venue ).filter(Venue.city_code == citycode).all( )
 
+    def get_current_statistics( self, citycode=None ):
+        """
+        The most recent statistics of every venue (optionally only those with the given citycode),
+        read from the venues table in a single scan.
+
+        Output: list of (venue id, foursq_id, checkins, users, date) tuples. The statistics are
+                None for venues with no statistics recorded.
+        """
+        query = self.session.query( Venue.id, Venue.foursq_id, Venue.last_checkins, Venue.last_users, Venue.last_stat_date )
+        if citycode is not None:
+            query = query.filter( Venue.city_code == citycode )
+        return query.all( )
+
+    def get_venue_working_set( self, citycode, fence=None ):
+        """
+        Loads a compact, read-only copy of all venues with the given citycode, optionally
+        marking which are inside `fence` (see geofence.py). See working_set.py.
+
+        Output: a VenueWorkingSet
+        """
+        return VenueWorkingSet( self, citycode, fence )
+
+    def get_venue_record_rows( self, citycode, after_id=0 ):
+        """
+        Venue, location and activity columns for the venues with the given citycode and an id 
+        greater than `after_id`, ordered by id. Rows are tuples, in VenueRecord slot order.
+        """
+        return self.session.query( Venue.id, Venue.foursq_id, Venue.name, Venue.city_code,
+                                   Location.latitude, Location.longitude, Venue.active, Venue.first_checkins,
+                                   Venue.first_stat_date, Venue.last_checkins, Venue.last_users, Venue.last_stat_date,
+                                   Venue.last_checkin_at
+                                 ).outerjoin( Location, Venue.location_id == Location.id
+                                 ).filter( Venue.city_code == citycode ).filter( Venue.id > after_id
+                                 ).order_by( Venue.id ).all( )
+
+    def get_venue_activity_rows( self, citycode ):
+        """
+        The activity columns of the venues with the given citycode: rows of id, active, first_checkins,
+        first_stat_date, last_checkins, last_users, last_stat_date and last_checkin_at.
+        """
+        return self.session.query( Venue.id, Venue.active, Venue.first_checkins, Venue.first_stat_date,
+                                   Venue.last_checkins, Venue.last_users, Venue.last_stat_date, Venue.last_checkin_at
+                                 ).filter( Venue.city_code == citycode ).all( )
+
+    def get_venue_change_seq( self ):
+        """
+        Output: the seq of the latest venue change (see VenueChange), 0 if none
+        """
+        return self.session.query( func.max( VenueChange.seq ) ).scalar( ) or 0
+
+    def get_changed_venue_rows( self, after_seq, citycode=None ):
+        """
+        Venue, location and activity columns, as in get_venue_record_rows, of the venues changed 
+        since the venue change `after_seq`, each followed by the seq of its latest change. Ordered 
+        by seq. With `citycode`, only the venues in that city before or after their latest change.
+        """
+        query = self.session.query( Venue.id, Venue.foursq_id, Venue.name, Venue.city_code,
+                                   Location.latitude, Location.longitude, Venue.active, Venue.first_checkins,
+                                   Venue.first_stat_date, Venue.last_checkins, Venue.last_users, Venue.last_stat_date,
+                                   Venue.last_checkin_at, VenueChange.seq
+                                 ).select_from( VenueChange ).join( Venue, Venue.id == VenueChange.venue_id
+                                 ).outerjoin( Location, Venue.location_id == Location.id
+                                 ).filter( VenueChange.seq > after_seq )
+        if citycode is not None:
+            query = query.filter( or_( VenueChange.city_code == citycode, VenueChange.old_city_code == citycode ) )
+        return query.order_by( VenueChange.seq ).all( )
+
+    def get_venue_checkin_counts( self, citycode, since ):
+        """
+        Input   'since': epoch seconds
+
+        Output: dict of venue id -> number of checkins stored for the venue created since `since`,
+                for the venues with the given citycode that have any
+        """
+        return dict( self.session.query( Checkin.venue_id, func.count( Checkin.id )
+                                 ).join( Venue, Venue.id == Checkin.venue_id
+                                 ).filter( Checkin.created_at >= since ).filter( Venue.city_code == citycode
+                                 ).group_by( Checkin.venue_id ).all( ) )
+
+    def _create_venue_change_triggers( self ):
+        # (re)created every time, so that databases with older versions of the triggers get these
+        triggers = {
+            'insert': ( 'INSERT', '', 'NULL' ),
+            'update': ( 'UPDATE OF name, city_code, location_id, active',
+                        """WHEN OLD.name IS NOT NEW.name OR OLD.city_code IS NOT NEW.city_code
+                             OR OLD.location_id IS NOT NEW.location_id OR OLD.active IS NOT NEW.active""",
+                        'OLD.city_code' ),
+        }
+        for name, ( event, when, old_city_code ) in triggers.items():
+            self.session.execute( "DROP TRIGGER IF EXISTS venue_changes_%s" % name )
+            self.session.execute( """CREATE TRIGGER venue_changes_%s AFTER %s ON venues %s
+                                     BEGIN
+                                        INSERT OR REPLACE INTO venue_changes ( venue_id, seq, old_city_code, city_code )
+                                        VALUES ( NEW.id, ( SELECT COALESCE( MAX( seq ), 0 ) + 1 FROM venue_changes ),
+                                                 %s, NEW.city_code );
+                                     END""" % ( name, event, when, old_city_code ) )
+        self.session.commit( )
+
+    #### spatial index ####
+    #
+    # venue_rtree is an SQLite R*Tree over venue locations (latitude, longitude),
+    # keyed by venue id. It is filled by add_venue_to_database and backfilled by
+    # upgrade_tables. Queries use it to find candidate venues from a bounding box
+    # and then test the candidates' exact locations.
+
+    def _create_venue_rtree( self ):
+        self.session.execute( """CREATE VIRTUAL TABLE IF NOT EXISTS venue_rtree
+                                 USING rtree( id, min_lat, max_lat, min_lng, max_lng )""" )
+        added = self.session.execute( """INSERT INTO venue_rtree ( id, min_lat, max_lat, min_lng, max_lng )
+                                         SELECT v.id, l.latitude, l.latitude, l.longitude, l.longitude
+                                         FROM venues v JOIN locations l ON l.id = v.location_id
+                                         WHERE l.latitude IS NOT NULL AND l.longitude IS NOT NULL
+                                            AND v.id NOT IN ( SELECT id FROM venue_rtree )""" ).rowcount
+        self.session.commit( )
+        if added:
+            logging.info( u'DBW Added %d venues to the spatial index' % added )
+
+    def _index_venue_location( self, venue, location ):
+        if location.latitude is None or location.longitude is None:
+            return
+        self.session.execute( """INSERT OR REPLACE INTO venue_rtree ( id, min_lat, max_lat, min_lng, max_lng )
+                                 VALUES ( :id, :lat, :lat, :lng, :lng )""",
+                              { 'id': venue.id, 'lat': location.latitude, 'lng': location.longitude } )
+
+    def _venue_location_rows( self, min_lat, min_lng, max_lat, max_lng, citycode=None ):
+        """
+        ( id, latitude, longitude ) of the venues inside the bounding box.
+        """
+        # The R*Tree stores 32 bit floats rounded outwards, so it is only used to pick
+        # candidates; the exact test is against the locations table.
+        stmt = """SELECT v.id, l.latitude, l.longitude
+                  FROM venue_rtree r JOIN venues v ON v.id = r.id JOIN locations l ON l.id = v.location_id
+                  WHERE r.max_lat >= :min_lat AND r.min_lat <= :max_lat
+                    AND r.max_lng >= :min_lng AND r.min_lng <= :max_lng
+                    AND l.latitude BETWEEN :min_lat AND :max_lat
+                    AND l.longitude BETWEEN :min_lng AND :max_lng"""
+        params = { 'min_lat': min_lat, 'max_lat': max_lat, 'min_lng': min_lng, 'max_lng': max_lng }
+        if citycode is not None:
+            stmt += " AND v.city_code = :citycode"
+            params['citycode'] = citycode
+        return self.session.execute( stmt, params ).fetchall( )
+
+    def _venues_by_id( self, ids ):
+        venues = {}
+        ids = list( ids )
+        for i in range( 0, len( ids ), 500 ):
+            for v in self.session.query( Venue ).filter( Venue.id.in_( ids[i:i + 500] ) ).all( ):
+                venues[v.id] = v
+        return [ venues[i] for i in ids if i in venues ]
+
+    def get_venues_in_bbox( self, min_lat, min_lng, max_lat, max_lng, citycode=None ):
+        """
+        Retrieves the venues located inside the bounding box (inclusive),
+        optionally only those with the given citycode.
+
+        Output: a list of Venue objects
+        """
+        rows = self._venue_location_rows( min_lat, min_lng, max_lat, max_lng, citycode )
+        return self._venues_by_id( row[0] for row in rows )
+
+    def get_venues_within_radius( self, latitude, longitude, radius, citycode=None ):
+        """
+        Retrieves the venues within `radius` km (great circle distance) of the
+        given point, optionally only those with the given citycode.
+
+        Output: a list of ( Venue, distance in km ) tuples, nearest first
+        """
+        d_lat = math.degrees( radius / EARTH_RADIUS )
+        cos_lat = math.cos( math.radians( latitude ) )
+        d_lng = 180.0 if cos_lat < 1e-6 else min( 180.0, d_lat / cos_lat )
+        found = []
+        for venue_id, lat, lng in self._venue_location_rows( latitude - d_lat, longitude - d_lng,
+                                                            latitude + d_lat, longitude + d_lng, citycode ):
+            distance = haversine( latitude, longitude, lat, lng )
+            if distance <= radius:
+                found.append( ( distance, venue_id ) )
+        found.sort()
+        venues = self._venues_by_id( venue_id for distance, venue_id in found )
+        return zip( venues, [ distance for distance, venue_id in found ] )
+
+    def get_venue_ids_in_polygon( self, polygon, citycode=None ):
+        """
+        Input:  'polygon': a shapely Polygon with (latitude, longitude) coordinates
+
+        Output: set of the ids of the venues inside the polygon
+        """
+        from shapely.geometry import Point
+        from shapely.prepared import prep
+        min_lat, min_lng, max_lat, max_lng = polygon.bounds
+        prepared = prep( polygon )
+        return set( venue_id for venue_id, lat, lng in self._venue_location_rows( min_lat, min_lng, max_lat, max_lng, citycode )
+                    if prepared.contains( Point( lat, lng ) ) )
+
+    def get_venues_in_polygon( self, polygon, citycode=None ):
+        """
+        Input:  'polygon': a shapely Polygon with (latitude, longitude) coordinates
+
+        Output: a list of the Venue objects inside the polygon
+        """
+        return self._venues_by_id( sorted( self.get_venue_ids_in_polygon( polygon, citycode ) ) )
+
+
     #### checkins ####
 
     def count_checkins_in_database( self ):
-        return len( self.session.query( Venue ).all( ) )
+        """
+        Count all the checkins in the database
+        """
+        return self.session.query( func.count( Checkin.id ) ).scalar( )
 
+    @ingested( sync=False )
     def add_checkin_to_database( self, checkin, venue ):
         """
         Input:      'checkin': dict containing checkin information with 'id' and 'createdAt' keys and a dict with user information.
-        Input:      'venue': Venue object from database (e.g. returned from get_venue_by_name())
+        Input:      'venue': Venue object from database (e.g. returned from get_venue_by_name()), or a VenueRecord
 
         Checks to see if the checkin already exists in the database, matching to foursquare provided 'id'. If it doesn't,
         the information is extracted and added to the database.
-        Note: venue is supplied as a Venue object and is assumed to already exist in the database.
+        Note: venue is supplied as a Venue object or VenueRecord and is assumed to already exist in the database.
 
         Output:     Checkin object
         """
@@ -360,16 +1326,22 @@ class DBWrapper( object ):
             user = checkin.get( 'user' )
             
             u = self.get_user_from_database( user )
+            # a user added here has no checkins yet; only a known one needs looking up
+            new_user = u == None or not self._has_checkins( Checkin.user_id, u.id )
             if u == None:
                 u = self.add_user_to_database( user )
             c.user = u
             c.user_id = u.id
-            c.venue = venue
             c.venue_id = venue.id
+            new_venue = self._update_venue_checkins( venue, c )
+            self.bump_activity_counters( venue.city_code, c.created_at, checkins=1,
+                                 new_users=1 if new_user else 0, new_venues=1 if new_venue else 0 )
+            if c.created_at is not None:
+                self.bump_capture_rate( venue.id, c.created_at - c.created_at % DAY, captured=1 )
         else:
             logging.info( u'DBW Checkin found in database' )
         self.session.add( c )
-        self.session.commit( )
+        self._commit( )
         
     def get_checkin_from_database( self, checkin ):
         """
@@ -381,6 +1353,15 @@ class DBWrapper( object ):
         """
         return self.session.query( Checkin ).filter( Checkin.foursq_id==checkin.get('id') ).first( )
 
+    def get_recent_checkin_ids( self, since ):
+        """
+        Input   'since': epoch seconds
+
+        Output  list of (foursq_id, created_at) tuples of the checkins created since `since`,
+                found through the created_at index, without building Checkin objects
+        """
+        return self.session.query( Checkin.foursq_id, Checkin.created_at ).filter( Checkin.created_at >= since ).all( )
+
     def get_all_checkins( self ):
         """
         Retrieves all checkins from the database.
@@ -390,6 +1371,183 @@ class DBWrapper( object ):
         return self.session.query( Checkin ).all( )
         
         
+    def _has_checkins( self, column, row_id ):
+        return self.session.query( Checkin.id ).filter( column == row_id ).first( ) is not None
+
+
+    #### activity counters ####
+
+    def bump_activity_counters( self, city_code, timestamp, **counts ):
+        """
+        Add `counts` (column name -> increment) to the counters of the city for
+        the hour containing `timestamp` (epoch seconds), in the current transaction.
+        """
+        if timestamp is None:
+            return
+        params = dict( ( name, counts.get( name, 0 ) ) for name in COUNTERS )
+        params['city_code'] = city_code or ''
+        params['hour'] = timestamp - timestamp % 3600
+        self.session.execute( """INSERT OR IGNORE INTO activity_counters ( city_code, hour, checkins, new_users, new_venues, statistics )
+                                 VALUES ( :city_code, :hour, 0, 0, 0, 0 )""", params )
+        self.session.execute( """UPDATE activity_counters SET checkins = checkins + :checkins, new_users = new_users + :new_users,
+                                    new_venues = new_venues + :new_venues, statistics = statistics + :statistics
+                                 WHERE city_code = :city_code AND hour = :hour""", params )
+
+    def get_activity_counters( self, start=None, end=None, citycode=None ):
+        """
+        The counters for the hours from `start` (inclusive) to `end` (exclusive),
+        epoch seconds, optionally only for the given citycode.
+
+        Output: list of (city_code, hour, checkins, new_users, new_venues, statistics) tuples, by hour
+        """
+        query = self.session.query( ActivityCounter.city_code, ActivityCounter.hour, ActivityCounter.checkins,
+                                    ActivityCounter.new_users, ActivityCounter.new_venues, ActivityCounter.statistics )
+        if start is not None:
+            query = query.filter( ActivityCounter.hour >= start - start % 3600 )
+        if end is not None:
+            query = query.filter( ActivityCounter.hour < end )
+        if citycode is not None:
+            query = query.filter( ActivityCounter.city_code == citycode )
+        return query.order_by( ActivityCounter.hour, ActivityCounter.city_code ).all( )
+
+    def _count_activity( self ):
+        """
+        The activity counters, computed from the raw tables.
+        """
+        return self.session.execute( """SELECT city_code, hour, SUM( checkins ), SUM( new_users ), SUM( new_venues ), SUM( statistics )
+            FROM (
+                SELECT COALESCE( v.city_code, '' ) AS city_code, c.created_at - c.created_at % 3600 AS hour,
+                       COUNT(*) AS checkins, 0 AS new_users, 0 AS new_venues, 0 AS statistics
+                FROM checkins c JOIN venues v ON v.id = c.venue_id WHERE c.created_at IS NOT NULL GROUP BY 1, 2
+                UNION ALL
+                SELECT COALESCE( v.city_code, '' ), c.created_at - c.created_at % 3600, 0, COUNT(*), 0, 0
+                FROM checkins c JOIN venues v ON v.id = c.venue_id
+                WHERE c.created_at IS NOT NULL AND c.id IN ( SELECT MIN( id ) FROM checkins GROUP BY user_id ) GROUP BY 1, 2
+                UNION ALL
+                SELECT COALESCE( v.city_code, '' ), c.created_at - c.created_at % 3600, 0, 0, COUNT(*), 0
+                FROM checkins c JOIN venues v ON v.id = c.venue_id
+                WHERE c.created_at IS NOT NULL AND c.id IN ( SELECT MIN( id ) FROM checkins GROUP BY venue_id ) GROUP BY 1, 2
+                UNION ALL
+                SELECT COALESCE( v.city_code, '' ), CAST( strftime( '%s', s.date ) AS INTEGER ) / 3600 * 3600, 0, 0, 0, COUNT(*)
+                FROM statistics s JOIN venues v ON v.id = s.venue_id WHERE s.date IS NOT NULL GROUP BY 1, 2
+            ) GROUP BY 1, 2 ORDER BY 2, 1""" ).fetchall( )
+
+    def rebuild_activity_counters( self ):
+        """
+        Recomputes all the activity counters from the raw tables.
+
+        Output  number of counter rows written
+        """
+        rows = self._count_activity( )
+        self.session.execute( "DELETE FROM activity_counters" )
+        if rows:
+            self.session.execute( ActivityCounter.__table__.insert( ),
+                                  [ dict( zip( [ 'city_code', 'hour' ] + COUNTERS, row ) ) for row in rows ] )
+        self.session.commit( )
+        return len( rows )
+
+    def check_activity_counters( self ):
+        """
+        Compares the stored activity counters with counts from the raw tables.
+
+        Output  list of ( city_code, hour, counter, stored value, actual value ) for each difference
+        """
+        actual = dict( ( ( row[0], row[1] ), row[2:] ) for row in self._count_activity( ) )
+        stored = dict( ( ( row[0], row[1] ), row[2:] ) for row in self.get_activity_counters( ) )
+        differences = []
+        for key in sorted( set( actual ) | set( stored ) ):
+            a = actual.get( key, ( 0, ) * len( COUNTERS ) )
+            b = stored.get( key, ( 0, ) * len( COUNTERS ) )
+            for name, stored_value, actual_value in zip( COUNTERS, b, a ):
+                if stored_value != actual_value:
+                    differences.append( key + ( name, stored_value, actual_value ) )
+        return differences
+
+
+    #### capture rates ####
+    #
+    # How many of each venue's checkins were captured, per day: see CaptureRate.
+
+    def bump_capture_rate( self, venue_id, day, expected=0.0, covered=0, captured=0 ):
+        """
+        Add to the capture rate of a venue for `day` (epoch seconds the day starts at), in the 
+        current transaction.
+        """
+        params = { 'venue_id': venue_id, 'day': day, 'expected': expected, 'covered': covered, 'captured': captured }
+        self.session.execute( """INSERT OR IGNORE INTO capture_rates ( venue_id, day, expected, covered, captured )
+                                 VALUES ( :venue_id, :day, 0.0, 0, 0 )""", params )
+        self.session.execute( """UPDATE capture_rates SET expected = expected + :expected, covered = covered + :covered,
+                                    captured = captured + :captured
+                                 WHERE venue_id = :venue_id AND day = :day""", params )
+
+    def _add_expected_checkins( self, venue_id, start, end, increase ):
+        """
+        Record that the venue's checkinsCount rose by `increase` between two statistics, seen at
+        `start` and `end` (epoch seconds).
+        """
+        for day, expected, covered in spread_by_day( start, end, increase ):
+            self.bump_capture_rate( venue_id, day, expected=expected, covered=covered )
+
+    def get_capture_rates( self, start=None, end=None, citycode=None, complete=True ):
+        """
+        Input   'start', 'end': (optional) epoch seconds, the days from the one containing `start` up 
+                to `end` (exclusive)
+                'citycode': (optional) only the venues of this city
+                'complete': only the days fully covered by statistics
+
+        Output: list of (city_code, venue_id, day, expected, captured) tuples, by day
+        """
+        query = self.session.query( Venue.city_code, CaptureRate.venue_id, CaptureRate.day, CaptureRate.expected,
+                                    CaptureRate.captured ).select_from( CaptureRate ).join( ( Venue, Venue.id == CaptureRate.venue_id ) )
+        if start is not None:
+            query = query.filter( CaptureRate.day >= start - start % DAY )
+        if end is not None:
+            query = query.filter( CaptureRate.day < end )
+        if citycode is not None:
+            query = query.filter( Venue.city_code == citycode )
+        if complete:
+            query = query.filter( CaptureRate.covered >= DAY )
+        return query.order_by( CaptureRate.day, CaptureRate.venue_id ).all( )
+
+    def rebuild_capture_rates( self, batch_size=10000 ):
+        """
+        Recomputes all the capture rates from the statistics (and rollups, whose increases are 
+        spread over their buckets) and the checkins, e.g. to backfill a database collected before
+        they were kept. Statistics are read once, in venue order.
+
+        Output  number of rows written
+        """
+        captured = {}
+        for venue_id, day, count in self.session.execute( """SELECT venue_id, created_at - created_at % 86400, COUNT(*)
+                FROM checkins WHERE venue_id IS NOT NULL AND created_at IS NOT NULL GROUP BY 1, 2""" ):
+            captured.setdefault( venue_id, {} )[day] = count
+        self.session.execute( "DELETE FROM capture_rates" )
+
+        rows = []
+        written = [ 0 ]
+        def write( venue_id, days ):
+            for day, ( expected, covered ) in days.items():
+                rows.append( { 'venue_id': venue_id, 'day': day, 'expected': expected, 'covered': covered,
+                               'captured': captured.get( venue_id, {} ).pop( day, 0 ) } )
+            for day, count in captured.pop( venue_id, {} ).items():
+                rows.append( { 'venue_id': venue_id, 'day': day, 'expected': 0.0, 'covered': 0, 'captured': count } )
+            if len( rows ) >= batch_size:
+                flush()
+        def flush():
+            if rows:
+                self.session.execute( CaptureRate.__table__.insert( ), rows )
+                written[0] += len( rows )
+                del rows[:]
+
+        for venue_id, summaries in itertools.groupby( self._statistic_summaries( ), lambda row: row[0] ):
+            write( venue_id, expected_checkins( summaries ) )
+        for venue_id in captured.keys():
+            write( venue_id, {} )
+        flush()
+        self.session.commit( )
+        return written[0]
+
+
     #### users ####
         
     def get_user_from_database( self, user):
@@ -400,8 +1558,11 @@ class DBWrapper( object ):
         
         Output  User object. Will be 'None' if user does not exist in the database. 
         """
-        return self.session.query( User ).filter( User.foursq_id==user.get( 'id' ) ).first( )
+        foursq_id = user.get( 'id' )
+        return self._cached_get( 'users', User, foursq_id,
+                                 self.session.query( User ).filter( User.foursq_id==foursq_id ) )
         
+    @ingested( sync=True )
     def add_user_to_database( self, user):
         """
         Input   'user': dict containing user information with 'id', 'firstName', 'lastName', 'gender' and 'homeCity' keys
@@ -419,11 +1580,24 @@ class DBWrapper( object ):
             logging.info( u'DBW User not found in database: %s %s' % ( user.get( 'firstName' ), user.get( 'lastName' ) ) )
             u = User( foursq_id=user.get( 'id' ), first_name=user.get( 'firstName' ), last_name=user.get( 'lastName' ), gender=user.get( 'gender' ), home_city=user.get( 'homeCity' ) )
             self.session.add( u )
-            self.session.commit( )
+            self._commit( )
+            self.caches['users'].put( u.foursq_id, u.id )
         else:
             logging.info( u'DBW User found in database: %s %s' % ( u.first_name, u.last_name ) )
         return u
         
+    def count_users_in_database( self ):
+        """
+        Count all the users in the database
+        """
+        return self.session.query( func.count( User.id ) ).scalar( )
+
+    def count_users_with_checkins( self ):
+        """
+        Count the users who have checked in at least once.
+        """
+        return self.session.query( func.count( func.distinct( Checkin.user_id ) ) ).scalar( )
+
     def get_all_users_with_checkins( self ):
         """
         Retrieves all users who have checked in at least once from the 
@@ -444,7 +1618,51 @@ class DBWrapper( object ):
     #### other ####
     
     def _get_engine( self ):
-        return create_engine( DATABASE, module=MODULE, echo=DEBUG )
+        engine = _engines.get( DATABASE )
+        if engine is None:
+            engine = create_database_engine( DATABASE )
+            _engines[DATABASE] = engine
+        return engine
+
+    def upgrade_tables( self ):
+        """
+        Brings an existing database up to date with the schema in database.py:
+        creates missing tables, adds missing columns and creates missing indexes,
+        creates the triggers that log venue changes (see VenueChange), keys any
+        unkeyed locations, adds any venues missing from the spatial index and
+        counts the existing data into newly created activity counters and capture rates.
+        Existing data is left alone, so this is safe to run on a live database.
+        """
+        engine = self._get_engine()
+        new_counters = not engine.has_table( ActivityCounter.__tablename__ )
+        new_capture_rates = not engine.has_table( CaptureRate.__tablename__ )
+        Base.metadata.create_all( engine )
+        def pragma( sql ):
+            # PRAGMAs with an empty result don't look like a query to SQLAlchemy
+            con = engine.raw_connection()
+            try:
+                return con.cursor().execute( sql ).fetchall()
+            finally:
+                con.close()
+
+        for table in Base.metadata.sorted_tables:
+            existing = set( row[1] for row in pragma( 'PRAGMA table_info(%s)' % table.name ) )
+            for column in table.columns:
+                if column.name not in existing:
+                    logging.info( u'DBW Adding column %s.%s' % ( table.name, column.name ) )
+                    engine.execute( 'ALTER TABLE %s ADD COLUMN %s %s' % ( table.name, column.name, column.type.compile( dialect=engine.dialect ) ) )
+            indexes = set( row[1] for row in pragma( 'PRAGMA index_list(%s)' % table.name ) )
+            for index in table.indexes:
+                if index.name not in indexes:
+                    logging.info( u'DBW Creating index %s' % index.name )
+                    index.create( bind=engine )
+        self._create_venue_change_triggers( )
+        self.migrate_location_keys( )
+        self._create_venue_rtree( )
+        if new_counters:
+            self.rebuild_activity_counters( )
+        if new_capture_rates:
+            self.rebuild_capture_rates( )
 
     def __create_tables__( self ):
         """
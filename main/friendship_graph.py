@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Export of the friendship graph of a crawl as a CSR adjacency in NumPy files,
+for analysis without going through the database.
+
+Each crawl is written to its own directory under the export root:
+
+    <root>/crawl_<crawl_id>/nodes.npy     int64, user id of each node, sorted
+    <root>/crawl_<crawl_id>/indptr.npy    int32, len(nodes) + 1
+    <root>/crawl_<crawl_id>/indices.npy   int32, the neighbours of node i are
+                                          indices[indptr[i]:indptr[i+1]], sorted
+    <root>/crawl_<crawl_id>/meta.json     crawl id, sizes, what it was built from
+
+The graph is undirected, so every friendship appears in the rows of both of
+its users. The arrays are opened with mmap_mode='r', so opening a graph is
+instant and processes opening the same export share its pages.
+
+If the export of an earlier crawl exists, a new crawl is built from it plus
+the friendship deltas recorded since (see FriendshipDelta), rather than from
+the whole snapshot.
+
+Usage: friendship_graph.py [crawl_id] [export_root]
+"""
+import numpy as np
+import tempfile
+import logging
+import shutil
+import json
+import os
+import re
+import sys
+
+EXPORT_ROOT = 'friendship_graph'
+
+CRAWL_DIR = re.compile( r'^crawl_(\d+)$' )
+
+
+class FriendshipGraph( object ):
+    """
+    A crawl's friendship graph, opened read-only from its export directory.
+    """
+    def __init__( self, path ):
+        self.path = path
+        with open( os.path.join( path, 'meta.json' ) ) as f:
+            self.meta = json.load( f )
+        self.crawl_id = self.meta['crawl_id']
+        self.nodes = np.load( os.path.join( path, 'nodes.npy' ), mmap_mode='r' )
+        self.indptr = np.load( os.path.join( path, 'indptr.npy' ), mmap_mode='r' )
+        self.indices = np.load( os.path.join( path, 'indices.npy' ), mmap_mode='r' )
+
+    def __len__( self ):
+        return len( self.nodes )
+
+    def __repr__( self ):
+        return u"<FriendshipGraph(crawl %s: %d users, %d friendships)>" % ( self.crawl_id, len( self ), self.num_edges() )
+
+    def num_edges( self ):
+        """
+        Number of (undirected) friendships.
+        """
+        return len( self.indices ) // 2
+
+    def node_index( self, user_id ):
+        """
+        Output  row of user `user_id` in the adjacency, or None if the user
+                has no friendships in this crawl
+        """
+        i = int( np.searchsorted( self.nodes, user_id ) )
+        if i < len( self.nodes ) and self.nodes[i] == user_id:
+            return i
+        return None
+
+    def degrees( self ):
+        """
+        Output  int32 array, the number of friends of each node
+        """
+        return np.diff( self.indptr ).astype( np.int32 )
+
+    def friends_of( self, user_id ):
+        """
+        Output  array of the user ids of the friends of `user_id`
+        """
+        i = self.node_index( user_id )
+        if i is None:
+            return np.zeros( 0, dtype=np.int64 )
+        return self.nodes[self.indices[self.indptr[i]:self.indptr[i + 1]]]
+
+    def edge_keys( self ):
+        """
+        Output  sorted int64 array with one key per friendship, see edge_key()
+        """
+        rows = np.repeat( np.arange( len( self.nodes ), dtype=np.int64 ), np.diff( self.indptr ) )
+        upper = self.indices > rows
+        return np.sort( edge_key( self.nodes[rows[upper]], self.nodes[self.indices[upper]] ) )
+
+
+def edge_key( low_ids, high_ids ):
+    """
+    Packs canonical (low, high) user id pairs into single int64 keys.
+    """
+    return ( np.asarray( low_ids, dtype=np.int64 ) << 32 ) | np.asarray( high_ids, dtype=np.int64 )
+
+def build_csr( keys ):
+    """
+    Input   int64 edge keys, one per friendship
+    Output  ( nodes, indptr, indices ) arrays of the CSR adjacency
+    """
+    low = keys >> 32
+    high = keys & 0xffffffff
+    nodes = np.unique( np.concatenate( [ low, high ] ) )
+    low = np.searchsorted( nodes, low ).astype( np.int32 )
+    high = np.searchsorted( nodes, high ).astype( np.int32 )
+    src = np.concatenate( [ low, high ] )
+    dst = np.concatenate( [ high, low ] )
+    order = np.lexsort( ( dst, src ) )
+    indptr = np.zeros( len( nodes ) + 1, dtype=np.int32 )
+    np.cumsum( np.bincount( src, minlength=len( nodes ) ), out=indptr[1:] )
+    return nodes.astype( np.int64 ), indptr, dst[order]
+
+def exported_crawls( root ):
+    """
+    Output  sorted list of the crawl ids exported under `root`
+    """
+    if not os.path.isdir( root ):
+        return []
+    crawls = []
+    for name in os.listdir( root ):
+        match = CRAWL_DIR.match( name )
+        if match and os.path.exists( os.path.join( root, name, 'meta.json' ) ):
+            crawls.append( int( match.group( 1 ) ) )
+    return sorted( crawls )
+
+def crawl_path( root, crawl_id ):
+    return os.path.join( root, 'crawl_%d' % crawl_id )
+
+def open_graph( root=EXPORT_ROOT, crawl_id=None ):
+    """
+    Open the export of crawl `crawl_id` (default: the latest exported crawl).
+    """
+    if crawl_id is None:
+        crawls = exported_crawls( root )
+        if not crawls:
+            raise IOError( u'no friendship graphs exported under %s' % root )
+        crawl_id = crawls[-1]
+    return FriendshipGraph( crawl_path( root, crawl_id ) )
+
+def export_crawl( dbw, crawl_id, root=EXPORT_ROOT ):
+    """
+    Write the friendship graph of crawl `crawl_id` under `root`, building on
+    the latest earlier export if there is one. An existing export of the
+    crawl is replaced.
+
+    Output  the exported FriendshipGraph
+    """
+    earlier = [ c for c in exported_crawls( root ) if c < crawl_id ]
+    if earlier:
+        base = open_graph( root, earlier[-1] )
+        changes = {}
+        for low_id, high_id, op in dbw.get_friendship_changes( base.crawl_id, crawl_id ):
+            changes[( low_id << 32 ) | high_id] = op
+        added = np.array( [ k for k, op in changes.items() if op == 'A' ], dtype=np.int64 )
+        removed = np.array( [ k for k, op in changes.items() if op == 'R' ], dtype=np.int64 )
+        keys = np.setdiff1d( np.union1d( base.edge_keys(), added ), removed )
+        built_from = base.crawl_id
+        logging.info( u'GRAPH crawl %s: %d changes since crawl %s' % ( crawl_id, len( changes ), base.crawl_id ) )
+        del base
+    else:
+        pairs = np.array( dbw.get_friendship_snapshot( crawl_id ), dtype=np.int64 ).reshape( -1, 2 )
+        keys = np.unique( edge_key( pairs[:, 0], pairs[:, 1] ) )
+        built_from = None
+
+    nodes, indptr, indices = build_csr( keys )
+    if not os.path.isdir( root ):
+        os.makedirs( root )
+    # Written to a temporary directory and renamed into place, so readers
+    # never see a half written export.
+    tmp = tempfile.mkdtemp( prefix='.crawl_%d.' % crawl_id, dir=root )
+    np.save( os.path.join( tmp, 'nodes.npy' ), nodes )
+    np.save( os.path.join( tmp, 'indptr.npy' ), indptr )
+    np.save( os.path.join( tmp, 'indices.npy' ), indices )
+    with open( os.path.join( tmp, 'meta.json' ), 'w' ) as f:
+        json.dump( { 'crawl_id': crawl_id, 'nodes': len( nodes ), 'edges': len( keys ), 'built_from': built_from }, f )
+    path = crawl_path( root, crawl_id )
+    if os.path.exists( path ):
+        shutil.rmtree( path )
+    os.rename( tmp, path )
+    logging.info( u'GRAPH exported crawl %s: %d users, %d friendships' % ( crawl_id, len( nodes ), len( keys ) ) )
+    return FriendshipGraph( path )
+
+
+if __name__ == "__main__":
+    import _credentials
+    from database_wrapper import DBWrapper
+
+    args = sys.argv
+    dbw = DBWrapper( warm_caches=False, ingest_address=None )
+    crawl_id = int( args[1] ) if len( args ) > 1 else dbw.get_friendships_max_crawl_id()
+    root = args[2] if len( args ) > 2 else getattr( _credentials, 'friendship_graph_dir', EXPORT_ROOT )
+    if crawl_id is None:
+        print 'No friendship crawls found.'
+        exit( 1 )
+    print export_crawl( dbw, crawl_id, root )
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+City geofences, tested against whole arrays of venue locations at once.
+
+A fence's `contains( latitudes, longitudes )` takes sequences of coordinates
+(None for a missing coordinate) and returns a NumPy boolean array, True for
+the points inside. Coordinates are treated as planar (degrees), as the
+monitor's shapely circle was (the circle is now exact rather than an 80-gon).
+Points with a missing coordinate are outside.
+"""
+import numpy as np
+
+
+def coordinates( latitudes, longitudes ):
+    """
+    Output  ( latitudes, longitudes ) as float arrays, NaN where missing
+    """
+    return np.array( latitudes, dtype=np.float64 ), np.array( longitudes, dtype=np.float64 )
+
+
+class CircleFence( object ):
+    """
+    The points within `radius` degrees of ( latitude, longitude ).
+    """
+    def __init__( self, latitude, longitude, radius ):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius = radius
+
+    def __repr__( self ):
+        return u"<CircleFence(%f, %f, %f)>" % ( self.latitude, self.longitude, self.radius )
+
+    def contains( self, latitudes, longitudes ):
+        lat, lng = coordinates( latitudes, longitudes )
+        with np.errstate( invalid='ignore' ):
+            return ( lat - self.latitude ) ** 2 + ( lng - self.longitude ) ** 2 <= self.radius ** 2
+
+
+class PolygonFence( object ):
+    """
+    The points inside a polygon given as a list of ( latitude, longitude )
+    vertices (closing the ring is optional).
+    """
+    def __init__( self, vertices ):
+        vertices = np.array( vertices, dtype=np.float64 )
+        if len( vertices ) and ( vertices[0] == vertices[-1] ).all():
+            vertices = vertices[:-1]
+        if len( vertices ) < 3:
+            raise ValueError( u'a polygon fence needs at least 3 vertices' )
+        self.vertices = vertices
+
+    def __repr__( self ):
+        return u"<PolygonFence(%d vertices)>" % len( self.vertices )
+
+    def contains( self, latitudes, longitudes ):
+        """
+        Even-odd ray casting, one pass over the edges for all the points.
+        """
+        lat, lng = coordinates( latitudes, longitudes )
+        inside = np.zeros( lat.shape, dtype=bool )
+        lat1, lng1 = self.vertices[-1]
+        with np.errstate( invalid='ignore' ):
+            for lat2, lng2 in self.vertices:
+                if lat1 != lat2:
+                    crosses = ( lat1 > lat ) != ( lat2 > lat )
+                    at = lng1 + ( lat - lat1 ) * ( lng2 - lng1 ) / ( lat2 - lat1 )
+                    inside ^= crosses & ( lng < at )
+                lat1, lng1 = lat2, lng2
+        return inside
+
+
+def city_fence( centre, radius=0.25, polygon=None ):
+    """
+    The fence of a city: `polygon` (a list of ( latitude, longitude ) vertices)
+    if given, otherwise a circle of `radius` degrees around `centre`.
+    """
+    if polygon:
+        return PolygonFence( polygon )
+    return CircleFence( centre[0], centre[1], radius )
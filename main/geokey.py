@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Integer keys for locations.
+
+Latitude and longitude are quantised to PRECISION degrees (about 11cm) and
+their bits interleaved (a Morton or Z-order code), giving one integer that
+fits in a signed 64 bit column. Locations that round to the same point get
+the same key, so the key can be used for exact matching with a unique index
+instead of comparing floats.
+
+Nearby points share the high bits of their keys: `bucket(key, level)` drops
+the lowest `level` bits of each coordinate, giving cells of 2**level *
+PRECISION degrees on a side that can be used as a coarse spatial grouping.
+"""
+
+PRECISION = 1e-6
+SCALE = 1000000
+
+# Each quantised coordinate fits in 29 bits (360 * SCALE < 2**29).
+BITS = 29
+
+def _spread( n ):
+    """
+    Spreads the low 32 bits of n out to the even bits of a 64 bit integer.
+    """
+    n &= 0xffffffff
+    n = ( n | ( n << 16 ) ) & 0x0000ffff0000ffff
+    n = ( n | ( n << 8 ) ) & 0x00ff00ff00ff00ff
+    n = ( n | ( n << 4 ) ) & 0x0f0f0f0f0f0f0f0f
+    n = ( n | ( n << 2 ) ) & 0x3333333333333333
+    n = ( n | ( n << 1 ) ) & 0x5555555555555555
+    return n
+
+def _compact( n ):
+    """
+    Inverse of _spread: gathers the even bits of n.
+    """
+    n &= 0x5555555555555555
+    n = ( n | ( n >> 1 ) ) & 0x3333333333333333
+    n = ( n | ( n >> 2 ) ) & 0x0f0f0f0f0f0f0f0f
+    n = ( n | ( n >> 4 ) ) & 0x00ff00ff00ff00ff
+    n = ( n | ( n >> 8 ) ) & 0x0000ffff0000ffff
+    n = ( n | ( n >> 16 ) ) & 0x00000000ffffffff
+    return n
+
+def quantise( latitude, longitude ):
+    """
+    Output  ( lat, lng ) as non-negative integers in units of PRECISION
+    """
+    return int( round( ( latitude + 90.0 ) * SCALE ) ), int( round( ( longitude + 180.0 ) * SCALE ) )
+
+def encode( latitude, longitude ):
+    """
+    Output  the key of a location, or None if either coordinate is missing
+    """
+    if latitude is None or longitude is None:
+        return None
+    lat, lng = quantise( latitude, longitude )
+    return int( _spread( lat ) << 1 | _spread( lng ) )
+
+def decode( key ):
+    """
+    Output  ( latitude, longitude ) of the point a key was rounded to
+    """
+    lat = _compact( key >> 1 )
+    lng = _compact( key )
+    return lat / float( SCALE ) - 90.0, lng / float( SCALE ) - 180.0
+
+def bucket( key, level ):
+    """
+    The cell containing `key` at `level` (0 <= level <= BITS). Keys in the same
+    cell have the same bucket.
+    """
+    return key >> ( 2 * level )
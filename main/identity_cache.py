@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Bounded identity caches used by the DBWrapper to avoid repeated lookups
+of rows we have already seen (users, venues, categories, locations).
+
+A cache maps a natural key (e.g. a foursquare id) to the primary key of the
+row in the database. Only positive results are cached: a key that is not
+in the database is never remembered, so a row inserted by another process
+will always be found on the next lookup. Row ids never change once
+assigned, so a cached entry can only go stale if the row is deleted; the
+DBWrapper calls `invalidate` when a cached id no longer resolves.
+"""
+from collections import OrderedDict
+import threading
+
+
+class IdentityCache( object ):
+    """
+    A least-recently-used mapping of natural key -> row id, bounded to
+    `capacity` entries. Keeps hit/miss counters so the effectiveness of
+    the cache can be checked from the logs.
+    """
+
+    def __init__( self, name, capacity=10000 ):
+        self.name = name
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.RLock()
+
+    def __len__( self ):
+        return len( self.__entries )
+
+    def __contains__( self, key ):
+        return key in self.__entries
+
+    def get( self, key ):
+        """
+        Return the row id cached for `key`, or None. A successful lookup
+        marks the entry as most recently used.
+        """
+        with self.__lock:
+            row_id = self.__entries.pop( key, None )
+            if row_id is None:
+                self.misses += 1
+                return None
+            self.__entries[key] = row_id
+            self.hits += 1
+            return row_id
+
+    def put( self, key, row_id ):
+        """
+        Remember that `key` is stored in the row `row_id`. The least
+        recently used entry is dropped if the cache is full.
+        """
+        if key is None or row_id is None:
+            return
+        with self.__lock:
+            self.__entries.pop( key, None )
+            self.__entries[key] = row_id
+            while len( self.__entries ) > self.capacity:
+                self.__entries.popitem( last=False )
+                self.evictions += 1
+
+    def invalidate( self, key ):
+        with self.__lock:
+            self.__entries.pop( key, None )
+
+    def clear( self ):
+        with self.__lock:
+            self.__entries.clear()
+
+    def warm( self, pairs ):
+        """
+        Fill the cache from an iterable of (key, row_id) pairs, e.g. the
+        result of a query over the whole table. Stops once the cache is
+        full so that warming a huge table stays cheap.
+        """
+        for key, row_id in pairs:
+            if len( self.__entries ) >= self.capacity:
+                break
+            self.put( key, row_id )
+
+    def hit_rate( self ):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float( self.hits ) / lookups
+
+    def stats( self ):
+        """
+        Output  dict of counters describing the cache.
+        """
+        return { 'name': self.name, 'size': len( self.__entries ), 'capacity': self.capacity,
+                 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                 'hit_rate': self.hit_rate() }
+
+    def __repr__( self ):
+        return u"<IdentityCache('%s', %d/%d, hit rate %.3f)>" % ( self.name, len( self.__entries ), self.capacity, self.hit_rate() )
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Single-writer ingestion service.
+
+SQLite allows one writer at a time. Rather than having every crawler commit
+its own tiny transactions (and fight over the lock), one process runs this
+service and owns all writes to the database. Crawlers run their DBWrapper in
+client mode (set `ingest_address` and `ingest_authkey` in _credentials.py);
+the DBWrapper write methods are then sent here over a local socket.
+
+The service applies writes as they arrive but only commits once a batch is
+full, a batch has been open for too long, or a client is waiting on the
+result of a write. Incoming writes go through a bounded queue: when the
+writer falls behind, the queue fills and clients block until there is room
+(backpressure), rather than the service buffering without limit.
+
+Asynchronous writes are acknowledged once queued. If one fails later, the
+failure is sent back with the reply to the same client's next call, which
+raises IngestError for it.
+
+Run with:   ./ingest_service.py
+"""
+from multiprocessing.connection import Listener, Client
+from collections import namedtuple
+from database import Base, Category, CrawlLog, Location, Statistic, StatisticRollup, Venue, User, Checkin, Friendship, \
+                     FriendshipEdge, FriendshipDelta
+import Queue
+import threading
+import logging
+import time
+import sys
+
+BATCH_SIZE = 500            # commit after this many writes...
+BATCH_INTERVAL = 2.0        # ...or once the oldest uncommitted write is this old (s)
+QUEUE_SIZE = 5000           # writes waiting to be applied before clients block
+
+ORM_CLASSES = dict( ( cls.__name__, cls ) for cls in [ Category, CrawlLog, Location, Statistic, StatisticRollup,
+                                                                 Venue, User, Checkin, Friendship,
+                                                                 FriendshipEdge, FriendshipDelta ] )
+
+# A reference to a database row, used to pass ORM objects between processes.
+OrmRef = namedtuple( 'OrmRef', [ 'cls_name', 'id' ] )
+
+
+class IngestError( RuntimeError ):
+    pass
+
+
+def marshal( value ):
+    """
+    Replace ORM objects in `value` (recursively through lists, tuples and
+    dicts) with OrmRefs so that they can be sent to the service.
+    """
+    if isinstance( value, Base ):
+        return OrmRef( value.__class__.__name__, value.id )
+    if isinstance( value, dict ):
+        return dict( ( k, marshal( v ) ) for k, v in value.items() )
+    if isinstance( value, ( list, tuple ) ):
+        return type( value )( marshal( v ) for v in value )
+    return value
+
+def unmarshal( value, session ):
+    """
+    Inverse of `marshal`: load the rows referred to by OrmRefs.
+    """
+    if isinstance( value, OrmRef ):
+        return session.query( ORM_CLASSES[value.cls_name] ).get( value.id )
+    if isinstance( value, dict ):
+        return dict( ( k, unmarshal( v, session ) ) for k, v in value.items() )
+    if isinstance( value, ( list, tuple ) ):
+        return type( value )( unmarshal( v, session ) for v in value )
+    return value
+
+
+class IngestClient( object ):
+    """
+    Client side of the service, used by DBWrapper in client mode.
+
+    Every call waits for an acknowledgement. For asynchronous calls this only
+    says that the write has been queued, so a call blocks while the service's
+    queue is full. Asynchronous writes that failed since the last call are
+    reported with the acknowledgement: they are added to `failed_writes` and
+    the call raises IngestError (its own write has been sent all the same).
+    """
+    def __init__( self, address, authkey ):
+        self.address = address
+        self.authkey = authkey
+        self.conn = None
+        self.lock = threading.Lock()
+        self.failed_writes = 0
+
+    def call( self, method_name, args, kwargs, sync ):
+        """
+        Send one write. Returns the marshalled result of a synchronous write,
+        otherwise None.
+        """
+        with self.lock:
+            if self.conn is None:
+                self.conn = Client( self.address, authkey=self.authkey )
+            try:
+                self.conn.send( ( method_name, args, kwargs, sync ) )
+                status, result, failures = self.conn.recv()
+            except ( EOFError, IOError ):
+                self.conn = None
+                raise IngestError( u'lost connection to ingestion service at %s' % self.address )
+            self.failed_writes += len( failures )
+        if status != 'ok':
+            raise IngestError( result )
+        if failures:
+            raise IngestError( u'%d earlier writes failed: %s' % ( len( failures ), u'; '.join( failures ) ) )
+        return result
+
+    def close( self ):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class Command( object ):
+    """
+    One write from a client. `failures` is the client's list of failed
+    asynchronous writes, to which this one's error is added if it fails.
+    """
+    __slots__ = [ 'method_name', 'args', 'kwargs', 'sync', 'done', 'status', 'result', 'failures' ]
+
+    def __init__( self, method_name, args, kwargs, sync, failures ):
+        self.method_name = method_name
+        self.args = args
+        self.kwargs = kwargs
+        self.sync = sync
+        self.done = threading.Event() if sync else None
+        self.status = 'ok'
+        self.result = None
+        self.failures = failures
+
+    def finish( self, status, result ):
+        self.status = status
+        self.result = result
+        if self.done is not None:
+            self.done.set()
+        elif status != 'ok':
+            self.failures.append( result )
+
+
+class IngestServer( object ):
+    """
+    Accepts connections from clients and applies their writes through a
+    single DBWrapper, committing in batches.
+    """
+    def __init__( self, dbw, address, authkey, batch_size=BATCH_SIZE, batch_interval=BATCH_INTERVAL, queue_size=QUEUE_SIZE ):
+        self.dbw = dbw
+        self.dbw.deferred_commit = True
+        self.address = address
+        self.authkey = authkey
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.queue = Queue.Queue( queue_size )
+        self.pending = []
+        self.batch_started = None
+        self.count_commits = 0
+        self.count_writes = 0
+        self.count_failed = 0
+
+    def serve_forever( self ):
+        listener = Listener( self.address, authkey=self.authkey )
+        logging.info( u'INGEST listening on %s' % ( self.address, ) )
+        acceptor = threading.Thread( target=self.__accept, args=( listener, ) )
+        acceptor.daemon = True
+        acceptor.start()
+        while True:
+            self.__write_step()
+
+    def __accept( self, listener ):
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                logging.info( u'INGEST rejected connection: %s' % e )
+                continue
+            t = threading.Thread( target=self.__serve_client, args=( conn, ) )
+            t.daemon = True
+            t.start()
+
+    def __serve_client( self, conn ):
+        failures = []       # this client's asynchronous writes that failed, not yet reported
+        try:
+            while True:
+                method_name, args, kwargs, sync = conn.recv()
+                command = Command( method_name, args, kwargs, sync, failures )
+                self.queue.put( command )   # blocks while the writer is behind
+                if sync:
+                    command.done.wait()
+                # the writer thread only appends to failures
+                reported = failures[:]
+                del failures[:len( reported )]
+                conn.send( ( command.status, command.result, reported ) )
+        except ( EOFError, IOError ):
+            pass
+        finally:
+            conn.close()
+
+    def __write_step( self ):
+        timeout = self.batch_interval
+        if self.batch_started is not None:
+            timeout = max( 0, self.batch_started + self.batch_interval - time.time() )
+        try:
+            command = self.queue.get( timeout=timeout )
+        except Queue.Empty:
+            command = None
+
+        if command is not None and not self.__allowed( command ):
+            command.finish( 'error', u'not a write method: %s' % command.method_name )
+            self.count_failed += 1
+            command = None
+
+        if command is not None:
+            if self.batch_started is None:
+                self.batch_started = time.time()
+            self.pending.append( command )
+            if not self.__apply( command ):
+                # the failed write has been reported; the rest of the batch was
+                # rolled back with it and must be applied again.
+                self.pending.remove( command )
+                self.__replay()
+
+        if not self.pending:
+            self.batch_started = None
+        elif ( ( command is not None and command.sync ) or len( self.pending ) >= self.batch_size
+                or time.time() - self.batch_started >= self.batch_interval ):
+            self.__commit()
+
+    def __allowed( self, command ):
+        method = getattr( self.dbw, command.method_name, None )
+        return getattr( method, 'ingested', False )
+
+    def __apply( self, command ):
+        method = getattr( self.dbw, command.method_name )
+        try:
+            args = unmarshal( command.args, self.dbw.session )
+            kwargs = unmarshal( command.kwargs, self.dbw.session )
+            obj = method( *args, **kwargs )
+            if command.sync:
+                command.result = marshal( obj )
+            return True
+        except Exception as e:
+            logging.exception( u'INGEST write failed: %s' % command.method_name )
+            self.dbw.rollback()
+            self.count_failed += 1
+            command.finish( 'error', u'%s failed: %s' % ( command.method_name, e ) )
+            return False
+
+    def __replay( self ):
+        for command in list( self.pending ):
+            if not self.__apply( command ):
+                self.pending.remove( command )
+                return self.__replay()
+
+    def __commit( self ):
+        try:
+            self.dbw.session.commit()
+        except Exception as e:
+            logging.exception( u'INGEST commit failed, %d writes lost' % len( self.pending ) )
+            self.dbw.rollback()
+            self.count_failed += len( self.pending )
+            for command in self.pending:
+                command.finish( 'error', u'commit failed: %s' % e )
+        else:
+            self.count_commits += 1
+            self.count_writes += len( self.pending )
+            for command in self.pending:
+                command.finish( 'ok', command.result )
+            logging.debug( u'INGEST committed %d writes (%d queued)' % ( len( self.pending ), self.queue.qsize() ) )
+        self.pending = []
+        self.batch_started = None
+
+
+if __name__ == "__main__":
+    import _credentials
+    from database_wrapper import DBWrapper
+    from setproctitle import setproctitle
+
+    setproctitle( 'INGEST' )
+    dbw = DBWrapper( ingest_address=None )
+    server = IngestServer( dbw, _credentials.ingest_address, _credentials.ingest_authkey )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info( u'INGEST shutting down after %d commits, %d writes, %d failed' % (
+                      server.count_commits, server.count_writes, server.count_failed ) )
+        sys.exit( 0 )
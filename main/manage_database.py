@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Maintenance commands for the database configured in _credentials.py.
+
+Usage: manage_database.py command
+
+Commands:
+    upgrade             create missing tables, columns and indexes
+    rebuild-activity    recompute the activity summary stored on each venue
+    compress-stats      convert the statistics table to change-only storage
+    rollup-stats        fold old statistics into the hourly/daily/weekly rollups
+    migrate-friendships copy the legacy friendships table into the edge store
+    rebuild-counters    recompute the per city, per hour activity counters
+    check-counters      compare the activity counters with the raw tables
+    rebuild-capture     recompute the per venue, per day capture rates (e.g. to backfill them)
+"""
+from database_wrapper import DBWrapper
+from datetime import datetime
+from statistics_rollup import StatisticsRollup, TIERS
+import _credentials
+import logging
+import sys
+
+def upgrade( dbw ):
+    dbw.upgrade_tables( )
+    print 'Database schema is up to date.'
+
+def rebuild_activity( dbw ):
+    active = dbw.rebuild_venue_activity( )
+    print 'Venue activity rebuilt: %d active venues.' % active
+
+def compress_stats( dbw ):
+    deleted = dbw.compress_statistics( )
+    print 'Statistics compressed: %d unchanged rows removed. Run VACUUM to reclaim the space.' % deleted
+
+def rollup_stats( dbw ):
+    tiers = getattr( _credentials, 'statistics_rollup_tiers', TIERS )
+    folded = StatisticsRollup( dbw, tiers ).run( )
+    for tier, width, age in tiers:
+        print 'Rolled up into %s: %d rows' % ( tier, folded[tier] )
+
+def migrate_friendships( dbw ):
+    crawls = dbw.migrate_friendships( )
+    print 'Friendships migrated: %d crawls.' % crawls
+
+def rebuild_counters( dbw ):
+    rows = dbw.rebuild_activity_counters( )
+    print 'Activity counters rebuilt: %d city-hours.' % rows
+
+def check_counters( dbw ):
+    differences = dbw.check_activity_counters( )
+    for city_code, hour, counter, stored, actual in differences:
+        print '%-8s %s %-12s stored %d, actual %d' % ( city_code, datetime.utcfromtimestamp( hour ).isoformat( ' ' ), counter, stored, actual )
+    print 'Activity counters checked: %d differences.' % len( differences )
+
+def rebuild_capture( dbw ):
+    rows = dbw.rebuild_capture_rates( )
+    print 'Capture rates rebuilt: %d venue-days.' % rows
+
+COMMANDS = {
+    'upgrade': upgrade,
+    'rebuild-activity': rebuild_activity,
+    'compress-stats': compress_stats,
+    'rollup-stats': rollup_stats,
+    'migrate-friendships': migrate_friendships,
+    'rebuild-counters': rebuild_counters,
+    'check-counters': check_counters,
+    'rebuild-capture': rebuild_capture,
+}
+
+if __name__ == "__main__":
+    args = sys.argv
+    if len( args ) != 2 or args[1] not in COMMANDS:
+        print __doc__
+        exit( 1 )
+
+    dbw = DBWrapper( warm_caches=False, ingest_address=None )
+    logging.info( u'DBM running %s' % args[1] )
+    COMMANDS[args[1]]( dbw )
@@ -14,104 +14,431 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+
+"""
+Merges the city databases into one joint database.
+
+Each source database is ATTACHed to the joint database in turn and every table is
+copied with one INSERT ... SELECT per table and source.
+Rows are matched on their natural keys (foursquare ids, location geokeys,
+venue and date for statistics, ...) so a row already in the joint database is
+not copied twice. Foreign keys are rewritten through an id map (source id ->
+joint id) built as each table is copied.
+
+Merges are incremental: the joint database records, per source and table,
+the highest source id merged so far, and later runs only copy rows added
+since. Statistics confirmed in a source since the last run are carried over
+too. The activity counters are brought up to date from the rows inserted, and
+the activity summaries and capture rates of the venues these rows belong to
+are recomputed from the joint database's statistics and checkins, in the same
+transaction, so a venue found in several sources gets the values a rebuild
+would give it. Each source is merged in one transaction, so merging is safe to
+interrupt and to repeat, e.g. hourly.
+
+Source databases may have an older schema: columns missing from a source are
+left empty, and location keys are computed for sources that don't store them.
+A venue found in more than one source keeps the details of the first.
+
+Usage: merge_database.py [joint_db source_db:CITY ...]
+
+With no arguments the Cardiff, Cambridge and Bristol databases below are
+merged into JNT_DB.
+"""
 from sqlite3 import dbapi2 as sqlite
-from datetime import datetime as now
-import database
-import new_database
+from database import Base
+from sqlite_profile import apply_profile
+from sqlalchemy.processors import str_to_datetime
+from statistics_rollup import Summary
+import database_wrapper
+import geokey
+import logging
+import time
+import sys
+import os
 
 BRS_DB='sqlite:///bristol4sq.db'
 CDF_DB='sqlite:///cardiff4sq.db'
 CAM_DB='sqlite:///cambridge4sq.db'
 JNT_DB='sqlite:///4sq.db'
-MODULE=sqlite
-DEBUG=False
-
-jnt_engine = create_engine( JNT_DB, module=MODULE, echo=DEBUG )
-jnt_session = sessionmaker( bind=jnt_engine )( )
-
-def get_category( category ):
-    return jnt_session.query( new_database.Category ).filter( new_database.Category.foursq_id==category.foursq_id ).first( )
-
-def get_location( location ):
-    return jnt_session.query( new_database.Location ).filter( new_database.Location.latitude==location.latitude and new_database.Location.longitude==location.longitude).first( )
-
-def get_venue( venue ):
-    return jnt_session.query( new_database.Venue ).filter( new_database.Venue.foursq_id==venue.foursq_id ).first( )
-
-def add_category( category ):
-    c = get_category( category )
-    if c == None:
-        c = new_database.Category( name=category.name, foursq_id=category.foursq_id )
-        jnt_session.add( c )
-        jnt_session.commit( )
-    return c
-
-def add_location( location ):
-    l = get_location( location )
-    if l == None:
-        l = new_database.Location( location.latitude, location.longitude )
-        jnt_session.add( l )
-        jnt_session.commit( )
-    return l
-
-def add_venue( venue, city_code ):
-    l = add_location( venue.location )
-    v = get_venue( venue )
-    if v == None:
-        v = new_database.Venue( foursq_id=venue.foursq_id, name=venue.name, verified=venue.verified, location_id=l.id, city_code=city_code )
-        if not venue.category == None:
-            c = add_category( venue.category )
-            v.category = c
-        jnt_session.add( v )
-        jnt_session.commit( )
-    return v
+
+SOURCES = [ ( CDF_DB, 'CDF' ), ( CAM_DB, 'CAM' ), ( BRS_DB, 'BRS' ) ]
+
+
+class MergeTable( object ):
+    """
+    How one table is merged.
+
+    `key`           columns identifying a row (after foreign keys are mapped)
+    `fks`           column -> referenced table, for columns to map to joint ids
+    `required`      mapped columns without which a row is not copied
+    `computed`      column -> function( source columns ) giving an SQL expression
+                    for the column; mapped columns are available as m_<column>.new_id
+    `mapped`        whether other tables refer to this one (builds its id map)
+    """
+    def __init__( self, name, key, fks={}, required=[], computed={}, mapped=False ):
+        self.name = name
+        self.key = key
+        self.fks = fks
+        self.required = required
+        self.computed = computed
+        self.mapped = mapped
+
+    def columns( self ):
+        return [ c.name for c in Base.metadata.tables[self.name].columns if c.name != 'id' ]
+
+TABLES = [
+    MergeTable( 'categories', [ 'foursq_id' ], mapped=True ),
+    MergeTable( 'locations', [ 'geokey' ], mapped=True,
+                computed={ 'geokey': lambda cols: 'COALESCE( s.geokey, geokey( s.latitude, s.longitude ) )' if 'geokey' in cols
+                                                  else 'geokey( s.latitude, s.longitude )' } ),
+    MergeTable( 'users', [ 'foursq_id' ], mapped=True ),
+    MergeTable( 'venues', [ 'foursq_id' ], mapped=True,
+                fks={ 'location_id': 'locations', 'category_id': 'categories', 'mayor_id': 'users' },
+                computed={ 'city_code': lambda cols: 'COALESCE( s.city_code, :city_code )' if 'city_code' in cols else ':city_code' } ),
+    MergeTable( 'statistics', [ 'venue_id', 'date' ], mapped=True, fks={ 'venue_id': 'venues' }, required=[ 'venue_id' ] ),
+    MergeTable( 'statistic_rollups', [ 'venue_id', 'tier', 'bucket_start' ], fks={ 'venue_id': 'venues' }, required=[ 'venue_id' ] ),
+    MergeTable( 'checkins', [ 'foursq_id' ], fks={ 'user_id': 'users', 'venue_id': 'venues' }, required=[ 'user_id', 'venue_id' ] ),
+    MergeTable( 'friendships', [ 'userA_id', 'userB_id', 'crawl_id' ], fks={ 'userA_id': 'users', 'userB_id': 'users' },
+                required=[ 'userA_id', 'userB_id' ] ),
+    MergeTable( 'friendship_edges', [ 'user_low_id', 'user_high_id' ], mapped=True,
+                fks={ 'user_low_id': 'users', 'user_high_id': 'users' }, required=[ 'user_low_id', 'user_high_id' ],
+                computed={ 'user_low_id': lambda cols: 'MIN( m_user_low_id.new_id, m_user_high_id.new_id )',
+                           'user_high_id': lambda cols: 'MAX( m_user_low_id.new_id, m_user_high_id.new_id )' } ),
+    MergeTable( 'friendship_deltas', [ 'crawl_id', 'edge_id', 'op' ], fks={ 'edge_id': 'friendship_edges' }, required=[ 'edge_id' ] ),
+    MergeTable( 'crawllog', [ 'crawltype', 'flag', 'date' ] ),
+]
+
+
+def db_url( path ):
+    """
+    SQLAlchemy URL of a database given as a URL or a file name.
+    """
+    if path.startswith( 'sqlite:' ):
+        return path
+    return 'sqlite:///' + path
+
+def db_file( url ):
+    """
+    Path of the database file of an sqlite:/// URL.
+    """
+    if url.startswith( 'sqlite:///' ):
+        return url[len( 'sqlite:///' ):]
+    return url
+
+MERGE_TABLES = [
+    """CREATE TABLE IF NOT EXISTS merge_idmap (
+            source VARCHAR, table_name VARCHAR, old_id INTEGER, new_id INTEGER,
+            PRIMARY KEY ( source, table_name, old_id ) )""",
+    """CREATE TABLE IF NOT EXISTS merge_watermarks (
+            source VARCHAR, table_name VARCHAR, max_id INTEGER, max_stamp VARCHAR, merged_at VARCHAR,
+            PRIMARY KEY ( source, table_name ) )""",
+]
+
+class Merger( object ):
+    """
+    Merges attached source databases into the joint database open on `con`.
+
+    Progress is kept in the joint database: merge_idmap holds the joint id of
+    every source row of the tables other tables refer to, and merge_watermarks
+    the highest source id merged per table (and, for statistics, the latest
+    confirmed_at seen). Each source is merged in its own transaction together
+    with its watermarks, so an interrupted merge is simply run again.
+    """
+    def __init__( self, con ):
+        self.con = con
+        self.report = []
+        for sql in MERGE_TABLES:
+            self.execute( sql )
+
+    def execute( self, sql, params={} ):
+        return self.con.execute( sql, params )
+
+    def source_columns( self, schema, table ):
+        return [ row[1] for row in self.execute( 'PRAGMA %s.table_info(%s)' % ( schema, table ) ) ]
+
+    def watermark( self, source, table_name ):
+        row = self.execute( """SELECT max_id, max_stamp FROM merge_watermarks WHERE source = :source AND table_name = :table_name""",
+                            { 'source': source, 'table_name': table_name } ).fetchone()
+        return row if row is not None else ( 0, None )
+
+    def set_watermark( self, source, table_name, max_id, max_stamp=None ):
+        self.execute( """INSERT OR REPLACE INTO merge_watermarks ( source, table_name, max_id, max_stamp, merged_at )
+                         VALUES ( :source, :table_name, :max_id, :max_stamp, datetime( 'now' ) )""",
+                      { 'source': source, 'table_name': table_name, 'max_id': max_id, 'max_stamp': max_stamp } )
+
+    def merge_source( self, schema, source, city_code ):
+        """
+        Copy the rows added to every table of the source attached as `schema`
+        since it was last merged. `source` identifies the source in the
+        watermark and id map tables.
+
+        The transaction is a plain BEGIN: the first INSERT takes the write
+        lock on the joint database only. (BEGIN IMMEDIATE would lock every
+        attached database, the live source included, for the whole merge.)
+        """
+        self.execute( 'BEGIN' )
+        try:
+            # joint venues up to this id were there before this source's
+            venues_before = self.execute( 'SELECT COALESCE( MAX( id ), 0 ) FROM main.venues' ).fetchone()[0]
+            before = dict( ( name, self.execute( 'SELECT COALESCE( MAX( id ), 0 ) FROM main.%s' % name ).fetchone()[0] )
+                           for name in [ 'checkins', 'statistics', 'statistic_rollups' ] )
+            first = len( self.report )
+            confirmed = []
+            for table in TABLES:
+                src_cols = self.source_columns( schema, table.name )
+                if not src_cols:
+                    self.report.append( ( source, table.name, None, 0, 0 ) )
+                    continue
+                after_id, stamp = self.watermark( source, table.name )
+                upto_id = self.execute( 'SELECT COALESCE( MAX( id ), 0 ) FROM %s.%s' % ( schema, table.name ) ).fetchone()[0]
+                total = self.execute( 'SELECT COUNT(*) FROM %s.%s WHERE id > ? AND id <= ?' % ( schema, table.name ),
+                                      ( after_id, upto_id ) ).fetchone()[0]
+                inserted = self.merge_table( schema, source, table, src_cols, city_code, after_id, upto_id )
+                updated = 0
+                if table.name == 'statistics':
+                    confirmed, stamp = self.update_statistics( schema, source, src_cols, after_id, stamp )
+                    updated = len( confirmed )
+                self.set_watermark( source, table.name, max( after_id, upto_id ), stamp )
+                self.report.append( ( source, table.name, total, inserted, updated ) )
+            self.count_activity( before )
+            rebuilt = self.rebuild_venues( self.changed_venues( before, venues_before, confirmed ) )
+            for i in range( first, len( self.report ) ):
+                if self.report[i][1] == 'venues' and self.report[i][2] is not None:
+                    self.report[i] = self.report[i][:4] + ( rebuilt, )
+            self.execute( 'COMMIT' )
+        except:
+            self.execute( 'ROLLBACK' )
+            raise
+
+    def merge_table( self, schema, source, table, src_cols, city_code, after_id, upto_id ):
+        """
+        Copy the source rows with ids in ( after_id, upto_id ] that are not
+        already in the joint database and, if other tables refer to this one,
+        record their joint ids.
+
+        Output  number of rows inserted
+        """
+        joins = []
+        exprs = {}
+        for column, target in table.fks.items():
+            if column not in src_cols:
+                continue
+            # CROSS JOIN keeps the source table first in the join order;
+            # otherwise SQLite can start from the id maps and pair them up
+            kind = 'CROSS JOIN' if column in table.required else 'LEFT JOIN'
+            joins.append( """%s main.merge_idmap m_%s ON m_%s.source = :source AND m_%s.table_name = '%s'
+                             AND m_%s.old_id = s.%s""" % ( kind, column, column, column, target, column, column ) )
+            exprs[column] = 'm_%s.new_id' % column
+        if any( column not in exprs for column in table.required ):
+            return 0
+        for column, expr in table.computed.items():
+            exprs[column] = expr( src_cols )
+        for column in table.columns():
+            if column not in exprs and column in src_cols:
+                exprs[column] = 's.%s' % column
+        columns = [ c for c in table.columns() if c in exprs ]
+        from_clause = '%s.%s s %s' % ( schema, table.name, ' '.join( joins ) )
+        new_rows = 's.id > :after_id AND s.id <= :upto_id'
+        key_exprs = [ exprs.get( k, 'NULL' ) for k in table.key ]
+        match = ' AND '.join( 'm.%s IS %s' % ( k, e ) for k, e in zip( table.key, key_exprs ) )
+        params = { 'city_code': city_code, 'source': source, 'after_id': after_id, 'upto_id': upto_id }
+
+        # rowcount, unlike total_changes, leaves out the rows written by triggers (venue_changes)
+        cursor = self.execute( """INSERT INTO main.%s ( %s )
+                         SELECT %s FROM %s
+                         WHERE s.id IN ( SELECT MIN( s.id ) FROM %s WHERE %s GROUP BY %s )
+                           AND NOT EXISTS ( SELECT 1 FROM main.%s m WHERE %s )
+                         ORDER BY s.id""" % (
+                            table.name, ', '.join( columns ), ', '.join( exprs[c] for c in columns ), from_clause,
+                            from_clause, new_rows, ', '.join( key_exprs ), table.name, match ), params )
+        inserted = cursor.rowcount
+
+        if table.mapped:
+            self.execute( """INSERT OR IGNORE INTO main.merge_idmap ( source, table_name, old_id, new_id )
+                             SELECT :source, '%s', s.id, m.id FROM %s JOIN main.%s m ON %s WHERE %s""" % (
+                                table.name, from_clause, table.name, match, new_rows ), params )
+        return inserted
+
+    def count_activity( self, before ):
+        """
+        Add the checkins and statistics inserted by this source's merge (the
+        rows with ids above `before`, table name -> highest id before the
+        merge) to the activity counters, counted as
+        DBWrapper.rebuild_activity_counters() counts them.
+        """
+        rows = self.execute( """SELECT city_code, hour, SUM( checkins ), SUM( new_users ), SUM( new_venues ), SUM( statistics )
+            FROM (
+                SELECT COALESCE( v.city_code, '' ) AS city_code, c.created_at - c.created_at % 3600 AS hour, 1 AS checkins,
+                       NOT EXISTS ( SELECT 1 FROM main.checkins e WHERE e.user_id = c.user_id AND e.id < c.id ) AS new_users,
+                       NOT EXISTS ( SELECT 1 FROM main.checkins e WHERE e.venue_id = c.venue_id AND e.id < c.id ) AS new_venues,
+                       0 AS statistics
+                FROM main.checkins c JOIN main.venues v ON v.id = c.venue_id
+                WHERE c.id > :checkins AND c.created_at IS NOT NULL
+                UNION ALL
+                SELECT COALESCE( v.city_code, '' ), CAST( strftime( '%s', s.date ) AS INTEGER ) / 3600 * 3600, 0, 0, 0, 1
+                FROM main.statistics s JOIN main.venues v ON v.id = s.venue_id
+                WHERE s.id > :statistics AND s.date IS NOT NULL
+            ) GROUP BY 1, 2""", before ).fetchall()
+        params = [ dict( zip( [ 'city_code', 'hour' ] + database_wrapper.COUNTERS, row ) ) for row in rows ]
+        self.con.executemany( """INSERT OR IGNORE INTO main.activity_counters ( city_code, hour, checkins, new_users, new_venues, statistics )
+                                 VALUES ( :city_code, :hour, 0, 0, 0, 0 )""", params )
+        self.con.executemany( """UPDATE main.activity_counters SET checkins = checkins + :checkins, new_users = new_users + :new_users,
+                                    new_venues = new_venues + :new_venues, statistics = statistics + :statistics
+                                 WHERE city_code = :city_code AND hour = :hour""", params )
+
+    def changed_venues( self, before, venues_before, confirmed ):
+        """
+        Output  set of the joint ids of the venues inserted by this source's merge (ids above
+                `venues_before`) or with statistics, rollups or checkins inserted (ids above
+                `before`) or statistics confirmed (ids `confirmed`) by it
+        """
+        params = dict( before, venues=venues_before )
+        venue_ids = set( row[0] for row in self.execute( """SELECT venue_id FROM main.statistics WHERE id > :statistics
+                                                            UNION SELECT venue_id FROM main.statistic_rollups WHERE id > :statistic_rollups
+                                                            UNION SELECT venue_id FROM main.checkins WHERE id > :checkins
+                                                            UNION SELECT id FROM main.venues WHERE id > :venues""", params ) )
+        for i in range( 0, len( confirmed ), 500 ):
+            batch = confirmed[i:i + 500]
+            venue_ids.update( row[0] for row in self.execute( 'SELECT DISTINCT venue_id FROM main.statistics WHERE id IN ( %s )' %
+                                                              ', '.join( '?' * len( batch ) ), batch ) )
+        venue_ids.discard( None )
+        return venue_ids
+
+    def statistic_summaries( self, venue_id ):
+        """
+        The statistics of one joint venue, from both the statistics table and the rollups, as
+        DBWrapper._statistic_summaries() generates them.
+        """
+        rows = [ ( venue_id, str_to_datetime( date ), 1, row_id,
+                   Summary.from_statistic( str_to_datetime( date ), str_to_datetime( confirmed_at ), checkins, users ) )
+                 for row_id, date, confirmed_at, checkins, users in self.execute(
+                    'SELECT id, date, confirmed_at, checkins, users FROM main.statistics WHERE venue_id = ?', ( venue_id, ) ) ]
+        for row in self.execute( 'SELECT id, %s FROM main.statistic_rollups WHERE venue_id = ?' % ', '.join( Summary.__slots__ ),
+                                 ( venue_id, ) ):
+            summary = Summary()
+            for name, value in zip( Summary.__slots__, row[1:] ):
+                setattr( summary, name, value )
+            summary.first_date = str_to_datetime( summary.first_date )
+            summary.last_date = str_to_datetime( summary.last_date )
+            rows.append( ( venue_id, summary.first_date, 0, row[0], summary ) )
+        rows.sort( )
+        return rows
+
+    def rebuild_venues( self, venue_ids, batch_size=500 ):
+        """
+        Recompute the activity summaries and capture rates of the joint venues `venue_ids` from
+        all their statistics and checkins in the joint database, as
+        DBWrapper.rebuild_venue_activity() and rebuild_capture_rates() do.
+
+        Output  number of venues rebuilt
+        """
+        venue_ids = sorted( venue_ids )
+        for i in range( 0, len( venue_ids ), batch_size ):
+            activity = []
+            rates = []
+            for venue_id in venue_ids[i:i + batch_size]:
+                summaries = self.statistic_summaries( venue_id )
+                count, last_checkin_at = self.execute( 'SELECT COUNT(*), MAX( created_at ) FROM main.checkins WHERE venue_id = ?',
+                                                       ( venue_id, ) ).fetchone()
+                entry = database_wrapper.venue_activity( summaries, count > 0, last_checkin_at )
+                entry['id'] = venue_id
+                for name in [ 'first_stat_date', 'last_stat_date' ]:
+                    if entry[name] is not None:
+                        # as SQLAlchemy stores a DateTime
+                        entry[name] = entry[name].strftime( '%Y-%m-%d %H:%M:%S.%f' )
+                activity.append( entry )
+
+                captured = dict( self.execute( """SELECT created_at - created_at % 86400, COUNT(*) FROM main.checkins
+                                                  WHERE venue_id = ? AND created_at IS NOT NULL GROUP BY 1""", ( venue_id, ) ) )
+                for day, ( expected, covered ) in database_wrapper.expected_checkins( summaries ).items():
+                    rates.append( ( venue_id, day, expected, covered, captured.pop( day, 0 ) ) )
+                rates.extend( ( venue_id, day, 0.0, 0, count ) for day, count in captured.items() )
+
+            self.con.executemany( """UPDATE main.venues SET first_checkins = :first_checkins, first_stat_date = :first_stat_date,
+                                        last_checkins = :last_checkins, last_users = :last_users, last_stat_date = :last_stat_date,
+                                        last_statistic_id = :last_statistic_id, last_checkin_at = :last_checkin_at, active = :active
+                                     WHERE id = :id""", activity )
+            self.con.executemany( 'DELETE FROM main.capture_rates WHERE venue_id = ?', [ ( e['id'], ) for e in activity ] )
+            self.con.executemany( """INSERT INTO main.capture_rates ( venue_id, day, expected, covered, captured )
+                                     VALUES ( ?, ?, ?, ?, ? )""", rates )
+        return len( venue_ids )
+
+    def update_statistics( self, schema, source, src_cols, after_id, stamp ):
+        """
+        Statistics are stored only when they change, so rows merged earlier
+        can have had their confirmed_at moved on since. Copy those forward.
+
+        Output  ( joint ids of the rows updated, new confirmed_at watermark )
+        """
+        if 'confirmed_at' not in src_cols:
+            return [], stamp
+        rows = self.execute( """SELECT m.new_id, s.confirmed_at FROM %s.statistics s
+                                JOIN main.merge_idmap m ON m.source = :source AND m.table_name = 'statistics' AND m.old_id = s.id
+                                WHERE s.id <= :after_id AND s.confirmed_at > COALESCE( :stamp, '' )""" % schema,
+                             { 'source': source, 'after_id': after_id, 'stamp': stamp } ).fetchall()
+        self.con.executemany( """UPDATE main.statistics SET confirmed_at = ?
+                                 WHERE id = ? AND ( confirmed_at IS NULL OR confirmed_at < ? )""",
+                              [ ( confirmed_at, new_id, confirmed_at ) for new_id, confirmed_at in rows ] )
+        stamp = self.execute( 'SELECT MAX( confirmed_at ) FROM %s.statistics' % schema ).fetchone()[0] or stamp
+        return [ new_id for new_id, confirmed_at in rows ], stamp
+
+
+def merge( joint_url, sources ):
+    """
+    Merge `sources`, a list of ( database URL, city code ) pairs, into the
+    database at `joint_url`.
+
+    Output  list of ( source, table, new source rows, rows inserted, rows updated )
+            tuples; new source rows is None where the source has no such table
+    """
+    # bring the joint database's schema up to date first
+    database_wrapper.DATABASE = db_url( joint_url )
+    dbw = database_wrapper.DBWrapper( warm_caches=False, ingest_address=None )
+    dbw.upgrade_tables( )
+    dbw.session.close( )
+
+    con = sqlite.connect( db_file( joint_url ), isolation_level=None )
+    apply_profile( con, database_wrapper.SQLITE_PROFILE )
+    con.create_function( 'geokey', 2, geokey.encode )
+    merger = Merger( con )
+    try:
+        for url, city_code in sources:
+            # only the source being merged is attached
+            con.execute( 'ATTACH DATABASE ? AS src', ( db_file( url ), ) )
+            try:
+                logging.info( u'MERGE merging %s (%s)' % ( url, city_code ) )
+                merger.merge_source( 'src', os.path.abspath( db_file( url ) ), city_code )
+            finally:
+                con.execute( 'DETACH DATABASE src' )
+    finally:
+        con.close( )
+
+    # index the new venues' locations
+    dbw._create_venue_rtree( )
+    return merger.report
+
+def print_report( report ):
+    print '%-30s %-20s %10s %10s %10s %10s' % ( 'source', 'table', 'new rows', 'inserted', 'present', 'updated' )
+    for source, table, total, inserted, updated in report:
+        source = os.path.basename( source )
+        if total is None:
+            print '%-30s %-20s %10s' % ( source, table, '-' )
+        else:
+            print '%-30s %-20s %10d %10d %10d %10d' % ( source, table, total, inserted, total - inserted, updated )
+
 
 if __name__ == "__main__":
+    args = sys.argv
+    if len( args ) == 1:
+        joint_url, sources = JNT_DB, SOURCES
+    elif len( args ) >= 3 and all( ':' in a for a in args[2:] ):
+        joint_url = args[1]
+        sources = [ tuple( a.rsplit( ':', 1 ) ) for a in args[2:] ]
+    else:
+        print __doc__
+        exit( 1 )
 
-    cdf_engine = create_engine( CDF_DB, module=MODULE, echo=DEBUG )
-    cam_engine = create_engine( CAM_DB, module=MODULE, echo=DEBUG )
-    brs_engine = create_engine( BRS_DB, module=MODULE, echo=DEBUG )
-    
-    cdf_session = sessionmaker( bind=cdf_engine )( )
-    cam_session = sessionmaker( bind=cam_engine )( )
-    brs_session = sessionmaker( bind=brs_engine )( )
-
-    cdf_venues = cdf_session.query( database.Venue ).all( )
-    cam_venues = cam_session.query( database.Venue ).all( )
-    brs_venues = brs_session.query( database.Venue ).all( )
-
-    print 'Cardiff Venues: %d' % len( cdf_venues )
-    print 'Cambridge Venues: %d' % len( cam_venues )
-    print 'Bristol Venues: %d' % len( brs_venues )
-
-    cdf_locations = cdf_session.query( database.Location ).all( )
-    cam_locations = cam_session.query( database.Location ).all( )
-    brs_locations = brs_session.query( database.Location ).all( )
-
-    print 'Cardiff Locations: %d' % len( cdf_locations )
-    print 'Cambridge Locations: %d' % len( cam_locations )
-    print 'Bristol Locations: %d' % len( brs_locations )
-
-    cdf_categories = cdf_session.query( database.Category ).all( )
-    cam_categories = cam_session.query( database.Category ).all( )
-    brs_categories = brs_session.query( database.Category ).all( )
-
-    print 'Cardiff Categories: %d' % len( cdf_categories )
-    print 'Cambridge Categories: %d' % len( cam_categories )
-    print 'Bristol Categories: %d' % len( brs_categories ) 
-
-    for venue in cdf_venues:
-        add_venue( venue, 'CDF' )
-    for venue in cam_venues:
-        add_venue( venue, 'CAM' )
-    for venue in brs_venues:
-        add_venue( venue, 'BRS' )
-
-    jnt_venues = jnt_session.query( new_database.Venue ).all( )
-    jnt_locations = jnt_session.query( new_database.Location ).all( )
-    jnt_categories = jnt_session.query( new_database.Category ).all( )
-    print 'Joint Venues: %d' % len( jnt_venues )
-    print 'Joint Locations: %d' % len( jnt_locations )
-    print 'Joint Categories: %d' % len( jnt_categories )
\ No newline at end of file
+    start = time.time( )
+    report = merge( joint_url, sources )
+    print_report( report )
+    print 'Merged %d databases in %.1fs' % ( len( sources ), time.time( ) - start )
@@ -15,29 +15,74 @@
 #   limitations under the License.
 
 from database_wrapper import DBWrapper
+from scheduler import PollScheduler, fair_shares, total_hours
 from urllib2 import HTTPError
 from api import *
 from exceptions import Exception
-from shapely.geometry import Point, Polygon
-from datetime import datetime as now
+from geofence import city_fence
+from seen_checkins import SeenCheckins
+from checkpoint import Checkpoint, start_run, finish_run
+from datetime import timedelta
 from setproctitle import setproctitle
+import threading
 import logging
+import time
 import sys
 
 """
 Monitor Checkin script.
 
-This will loop through all the venues for a city and look for checkins. The city to be checked
-is determined by the 'city_code' command line argument, which should match a city code that can
-be found in the database.
+This will loop through all the venues for one or more cities and look for checkins. The cities to 
+be checked are determined by the 'city_code' command line arguments, which should match city 
+codes that can be found in the database.
 
-Checks the venue is active before checking the venue, and checks the location falls within a 
-circular area of a given size around a central point of the city. This uses the Shapely package 
-for doing testing of whether a point is within a given polygon. Shapely can be obtained by the 
-usual python methods (easy_install etc) but relies on the GEOS  framework. OS X users can obtain 
-a port of GEOS here: http://www.kyngchaos.com/software:frameworks
+Only venues marked active in the database are checked, and only if the location falls within a 
+circular area of a given size around a central point of the city, or within the polygon given for 
+the city in _credentials.geofences (a list of (latitude, longitude) vertices). Venues are tested 
+against the fence once, when they are loaded into the working set (see geofence.py).
+
+Venues are not walked in a fixed order: a PollScheduler (see scheduler.py) estimates how often 
+each venue gets checkins and polls busy venues often and quiet ones rarely, to capture as many 
+checkins as possible within the API quota. Venues added or changed in the database are picked 
+up every REFRESH seconds (see working_set.py) and the schedule is reallocated every CYCLE seconds.
+
+All the cities are monitored by one process: they share one API gateway (with the credentials of 
+every city), one DBWrapper and a pool of WORKERS threads that make whichever city's poll is due 
+next. Each city gets a fair share of the quotas (see scheduler.fair_shares), so a small city's 
+unused quota goes to the bigger ones. Every poll is a userless call, and a poll that finds people 
+in the herenow list makes an authenticated call too, so both quotas are shared out and the 
+schedule keeps within both. An error in one city is logged and counted against that 
+city only; after MAX_FAILURES errors in a row the city is suspended for a while, doubling up to 
+CYCLE, while the others carry on.
+
+Checkins already stored are remembered for SEEN_WINDOW (see seen_checkins.py, warmed from the 
+database at startup), so the checkins a poll finds again are skipped without touching the database.
+
+Every REFRESH seconds each city's crawl log run, schedule and metrics are checkpointed (see 
+checkpoint.py). A restarted monitor resumes the cycle it was in: venues polled shortly before the 
+restart are not polled again until they are due, so the venues not reached yet are polled first.
 """
 
+# hourly API quotas, per access token and per client
+AUTH_QUOTA = 500
+USERLESS_QUOTA = 5000
+
+# seconds between crawl log entries and reallocations of the schedule
+CYCLE = 3600
+
+# seconds between checks for new and changed venues
+REFRESH = 300
+
+# number of threads polling venues
+WORKERS = 4
+
+# errors in a row after which a city is suspended, and the first suspension (seconds)
+MAX_FAILURES = 5
+BACKOFF = 60
+
+# how long stored checkins are remembered, to skip them when polls find them again
+SEEN_WINDOW = timedelta( hours=12 )
+
 def get_venue_details( id, aspect=None, userless=False ):
     """
     wrapper routine to call the venues API. 
@@ -52,6 +97,319 @@ def get_venue_details( id, aspect=None, userless=False ):
             logging.debug( u'CHK_MON Error (Venue deletion/Foursquare down?), moving on. ' )
             return response, False
 
+def new_metrics( ):
+    return { 'venues': 0, 'failed': 0, 'venues_with_checkins': 0, 'checkins': 0, 'new_checkins': 0, 'errors': 0 }
+
+
+class CityMonitor( object ):
+    """
+    The monitoring of one city: its venues, polling schedule and metrics.
+
+    The venues are polled by the workers of a MultiCityMonitor, so the
+    schedule is only used under `lock`; the polls themselves run outside it.
+    """
+    def __init__( self, dbw, city_code, fence, seen ):
+        self.dbw = dbw
+        self.city_code = city_code
+        self.fence = fence
+        self.seen = seen                    # SeenCheckins, shared by the cities
+        self.lock = threading.RLock()
+        self.scheduler = PollScheduler( USERLESS_QUOTA, AUTH_QUOTA )
+        self.working_set = None
+        self.captured_counts = {}
+        self.metrics = new_metrics( )       # this cycle
+        self.failures = 0                   # errors in a row
+        self.backoff = BACKOFF
+        self.suspended_until = 0
+        self.crawl_string = 'MONITOR_CHECKINS_' + city_code
+        self.checkpoint = Checkpoint( 'monitor_checkins_%s' % city_code )
+        self.run = None                     # crawl log run of this cycle, see checkpoint.start_run
+
+    def refresh( self, full=False ):
+        """
+        Load the city's venues, or pick up those added or changed since the last refresh.
+        With `full`, also re-read the venues' activity summaries and capture history and
+        reallocate the schedule.
+        """
+        with self.lock:
+            if self.working_set is None:
+                self.working_set = self.dbw.get_venue_working_set( self.city_code, self.fence )
+                logging.info( u'CHK_MON retrieved %d venues from database for %s, %d in the bounding area' % (
+                              len(self.working_set), self.city_code, self.working_set.inside.sum( ) ) )
+                added, changed, full = [], [], True
+            else:
+                added, changed = self.working_set.refresh( )
+            if added or changed:
+                logging.info( u'CHK_MON %s %d new venues, %d changed venues' % ( self.city_code, len(added), len(changed) ) )
+            if full:
+                self.working_set.reload_activity( )
+                history = time.time( ) - total_hours( self.scheduler.history ) * 3600
+                self.captured_counts = self.dbw.get_venue_checkin_counts( self.city_code, history )
+            if full or added or changed:
+                self.scheduler.update( self.working_set.active( ), self.captured_counts )
+
+    def set_share( self, polls_per_hour, auth_per_hour ):
+        with self.lock:
+            self.scheduler.polls_per_hour = polls_per_hour
+            self.scheduler.auth_per_hour = auth_per_hour
+            self.scheduler.allocate( )
+
+    def demand( self ):
+        with self.lock:
+            return self.scheduler.demand( )
+
+    def next_due( self ):
+        """
+        Output  when the city next has a venue to poll, or None if it has no venues
+        """
+        with self.lock:
+            due, venue = self.scheduler.next_venue( )
+            if due is not None and self.suspended_until > due:
+                return self.suspended_until
+            return due
+
+    def take( self, now ):
+        """
+        Output  a venue due to be polled at `now`, taken for the calling worker, or None
+        """
+        with self.lock:
+            if now < self.suspended_until:
+                return None
+            return self.scheduler.take( now )
+
+    def poll( self, venue, stored ):
+        """
+        Looks for checkins at a venue and stores those not seen before. The
+        ( foursquare id, createdAt ) of the checkins stored are appended to
+        `stored`, to be added to the seen set once they are committed.
+
+        Output  createdAt of the checkins found, or None if the venue could not be polled
+        """
+        logging.info( u'CHK_MON %s: retrieve details for venue: %s' % ( self.city_code, venue.name ) )
+        response, success = get_venue_details( venue.foursq_id, userless=True )
+        if not success:
+            logging.info( u'STAT_CHK %s: Error for venue: %s, id: %s' % ( venue.city_code, venue.name, venue.foursq_id ) )
+            self.count( 'failed' )
+            return None
+        self.count( 'venues' )
+        v = response.get( 'response' )
+        v = v.get( 'venue' )
+        hereNow = v.get( 'hereNow' )
+        count = hereNow.get( 'count' )
+        logging.info( u'CHK_MON %s: checkins found: %d' % ( self.city_code, count ) )
+        checkin_times = []
+        if count > 0:
+            self.count( 'venues_with_checkins' )
+            response, success = get_venue_details( venue.foursq_id, aspect="herenow", userless=False )
+            if not success:
+                self.count( 'failed' )
+                return None
+            hereNow = response['response']
+            hereNow = hereNow['hereNow']
+            items = hereNow['items']
+            for item in items:
+                self.count( 'checkins' )
+                checkin_times.append( item.get( 'createdAt', 0 ) )
+                if self.seen.seen( item ):
+                    continue
+                self.count( 'new_checkins' )
+                logging.info( u'CHK_MON %s: Adding checkin' % self.city_code )
+                self.dbw.add_checkin_to_database( item, venue )
+                stored.append( ( item.get( 'id' ), item.get( 'createdAt', 0 ) ) )
+        return checkin_times
+
+    def count( self, name ):
+        with self.lock:
+            self.metrics[name] += 1
+
+    def record( self, venue, checkin_times ):
+        with self.lock:
+            self.scheduler.record( venue.id, checkin_times )
+            if checkin_times is not None:
+                self.failures = 0
+                self.backoff = BACKOFF
+
+    def failed( self, what ):
+        """
+        Log the exception being handled, and suspend the city if it keeps failing.
+        """
+        with self.lock:
+            logging.exception( u'CHK_MON %s: error %s' % ( self.city_code, what ) )
+            self.count( 'errors' )
+            self.failures += 1
+            if self.failures >= MAX_FAILURES:
+                logging.error( u'CHK_MON %s: %d errors in a row, suspended for %d seconds' % (
+                               self.city_code, self.failures, self.backoff ) )
+                self.suspended_until = time.time( ) + self.backoff
+                self.backoff = min( self.backoff * 2, CYCLE )
+                self.failures = 0
+
+    def start_cycle( self ):
+        """
+        Log the start of a crawl, or resume the cycle checkpointed before a restart.
+
+        Output  the end of the resumed cycle (epoch seconds), or None for a new cycle
+        """
+        run = start_run( self.dbw, self.crawl_string, self.checkpoint )
+        with self.lock:
+            self.run = run
+            if 'schedule' in run:
+                logging.info( u'CHK_MON resume running checkin crawl in %s' % self.city_code )
+                self.scheduler.restore( run['schedule'] )
+                self.metrics.update( run['metrics'] )
+            else:
+                logging.info( u'CHK_MON start running checkin crawl in %s' % self.city_code )
+            self.scheduler.log_state( u'CHK_MON %s' % self.city_code )
+        return run.get( 'cycle_end' )
+
+    def save_checkpoint( self, cycle_end ):
+        with self.lock:
+            if self.run is None:
+                return
+            state = dict( self.run, cycle_end=cycle_end, schedule=self.scheduler.snapshot( ), metrics=self.metrics )
+            self.checkpoint.save( state, force=True )
+
+    def finish_cycle( self ):
+        # log the end of the crawl
+        with self.lock:
+            run, self.run = self.run, None
+        if run is not None:
+            finish_run( self.dbw, run, self.checkpoint )
+        with self.lock:
+            metrics, self.metrics = self.metrics, new_metrics( )
+            polls_per_hour = self.scheduler.polls_per_hour
+            auth_per_hour = self.scheduler.auth_per_hour
+            suspended = self.suspended_until > time.time( )
+        logging.info( u'CHK_MON %s venues checked: %d' % ( self.city_code, metrics['venues'] ) )
+        logging.info( u'CHK_MON %s venues with checkins: %d' % ( self.city_code, metrics['venues_with_checkins'] ) )
+        logging.info( u'CHK_MON %s checkins: %d, not seen before: %d' % ( self.city_code, metrics['checkins'], metrics['new_checkins'] ) )
+        logging.info( u'CHK_MON %s failed polls: %d, errors: %d, quota share: %.0f polls/hour, %.0f authenticated calls/hour%s' % (
+                      self.city_code, metrics['failed'], metrics['errors'], polls_per_hour, auth_per_hour,
+                      ', suspended' if suspended else '' ) )
+
+
+class MultiCityMonitor( object ):
+    """
+    Monitors several cities with one pool of worker threads. See the module docstring.
+    """
+    def __init__( self, dbw, cities, polls_per_hour, auth_per_hour, seen, workers=WORKERS ):
+        self.dbw = dbw
+        self.cities = cities
+        self.seen = seen
+        self.polls_per_hour = polls_per_hour
+        self.auth_per_hour = auth_per_hour
+        self.workers = [ None ] * workers
+
+    def run( self ):
+        self.seen.warm( self.dbw.get_recent_checkin_ids( time.time( ) - self.seen.window ) )
+        logging.info( u'CHK_MON seen checkins warmed: %d' % len( self.seen ) )
+        for city in self.cities:
+            self.isolated( city, 'loading venues', city.refresh, True )
+        self.rebalance( )
+        cycle_end = self.start_cycles( )
+        # loop forever: the workers poll, this thread looks after the cities
+        while True:
+            self.start_workers( )
+            time.sleep( max( 0, min( REFRESH, cycle_end - time.time( ) ) ) )
+            full = time.time( ) >= cycle_end
+            if full:
+                for city in self.cities:
+                    self.isolated( city, 'finishing cycle', city.finish_cycle )
+                self.dbw.log_cache_stats( )
+                logging.info( u'CHK_MON %r' % self.seen )
+            for city in self.cities:
+                self.isolated( city, 'refreshing venues', city.refresh, full )
+            if full:
+                self.rebalance( )
+                cycle_end = self.start_cycles( )
+            else:
+                self.dbw.end_cycle( )
+            for city in self.cities:
+                self.isolated( city, 'saving checkpoint', city.save_checkpoint, cycle_end )
+
+    def start_cycles( self ):
+        """
+        Start a cycle in every city, resuming the checkpointed cycles if any.
+
+        Output  the end of the cycle (epoch seconds): that of the earliest
+                resumed cycle, or CYCLE from now
+        """
+        ends = []
+        for city in self.cities:
+            try:
+                ends.append( city.start_cycle( ) )
+            except Exception:
+                self.dbw.rollback( )
+                city.failed( 'starting cycle' )
+        self.dbw.end_cycle( )
+        ends = [ end for end in ends if end is not None ]
+        return min( ends ) if ends else time.time( ) + CYCLE
+
+    def rebalance( self ):
+        """
+        Share the quotas between the cities by how much each can use.
+        """
+        demands = dict( ( city, city.demand( ) ) for city in self.cities )
+        shares = fair_shares( dict( ( city, polls ) for city, ( polls, auth ) in demands.items() ), self.polls_per_hour )
+        auth_shares = fair_shares( dict( ( city, auth ) for city, ( polls, auth ) in demands.items() ), self.auth_per_hour )
+        for city in self.cities:
+            city.set_share( max( shares[city], 1.0 ), max( auth_shares[city], 1.0 ) )
+
+    def isolated( self, city, what, method, *args ):
+        try:
+            method( *args )
+        except Exception:
+            self.dbw.rollback( )
+            city.failed( what )
+
+    def start_workers( self ):
+        for i, worker in enumerate( self.workers ):
+            if worker is None or not worker.is_alive( ):
+                if worker is not None:
+                    logging.error( u'CHK_MON worker %d died, restarting it' % i )
+                worker = threading.Thread( target=self.work, name='worker-%d' % i )
+                worker.daemon = True
+                worker.start( )
+                self.workers[i] = worker
+
+    def work( self ):
+        """
+        Worker loop: poll whichever city's venue is due soonest.
+        """
+        while True:
+            due = [ ( city.next_due( ), city ) for city in self.cities ]
+            due = [ ( when, city ) for when, city in due if when is not None ]
+            if not due:
+                time.sleep( 1.0 )
+                continue
+            when, city = min( due, key=lambda d: d[0] )
+            wait = when - time.time( )
+            if wait > 0:
+                time.sleep( min( wait, 1.0 ) )
+                continue
+            venue = city.take( time.time( ) )
+            if venue is None:
+                continue
+            checkin_times = None
+            stored = []
+            try:
+                checkin_times = city.poll( venue, stored )
+            except Exception:
+                self.dbw.rollback( )
+                city.failed( u'polling venue %s' % venue.foursq_id )
+                stored = []
+            city.record( venue, checkin_times )
+            # commit and drop this worker's session; only committed checkins count as seen
+            try:
+                self.dbw.end_cycle( )
+            except Exception:
+                self.dbw.rollback( )
+                city.failed( 'ending session' )
+                continue
+            for foursq_id, created_at in stored:
+                self.seen.add( foursq_id, created_at )
+
+
 if __name__ == "__main__":
 
     import _credentials
@@ -61,82 +419,44 @@ if __name__ == "__main__":
     # Input & args
     args = sys.argv
 
-    if len(args) is not 2:
-        print "Incorrect number of arguments - please supply city_code"
+    if len(args) < 2:
+        print "Incorrect number of arguments - please supply one or more city_codes"
         exit(1)
     else:
-        city_code = args[1]
+        city_codes = args[1:]
 
     logging.info( u'CHK_MON Restarted monitor_checkins.py' )
-    logging.info( u'CHK_MON Running with city_code: %s' % city_code )
-    setproctitle( u'CHK_MON %s' % city_code )
+    logging.info( u'CHK_MON Running with city_codes: %s' % ', '.join( city_codes ) )
+    setproctitle( u'CHK_MON %s' % ','.join( city_codes ) )
 
-    # load credentials
-    client_id = _credentials.client_id[city_code]
-    client_secret = _credentials.client_secret[city_code]
-    client_tuples = [(client_id, client_secret)]
-    access_tokens = _credentials.access_tokens[city_code]
+    # load credentials: the cities' clients and tokens are pooled in one gateway
+    client_tuples = []
+    access_tokens = []
+    for city_code in city_codes:
+        client = ( _credentials.client_id[city_code], _credentials.client_secret[city_code] )
+        if client not in client_tuples:
+            client_tuples.append( client )
+        for token in _credentials.access_tokens[city_code]:
+            if token not in access_tokens:
+                access_tokens.append( token )
+        logging.info( u'CHK_MON %s client_id: %s' % ( city_code, client[0] ) )
+        logging.info( u'CHK_MON %s client_secret: %s' % ( city_code, client[1] ) )
+        logging.info( u'CHK_MON %s access_tokens: %s' % ( city_code, _credentials.access_tokens[city_code][0] ) )
 
-    gateway = APIGateway( access_tokens, 500, client_tuples, 5000 )
+    gateway = APIGateway( access_tokens, AUTH_QUOTA, client_tuples, USERLESS_QUOTA )
     api = APIWrapper( gateway )
+    logging.info( u'CHK_MON api gateway initialised: %d clients, %d access tokens' % ( len( client_tuples ), len( access_tokens ) ) )
 
-    logging.info( u'CHK_MON %s client_id: %s' % ( city_code, client_id ) )
-    logging.info( u'CHK_MON %s client_secret: %s' % ( city_code, client_secret ) )
-    logging.info( u'CHK_MON %s access_tokens: %s' % ( city_code, access_tokens[0] ) )
-    logging.info( u'CHK_MON %s api gateways initialised' % city_code )
-
-    # get the centre point for the city and construct a bounding area
-    centre = _credentials.centres[city_code]
-    centre = Point(centre[0], centre[1])
-    logging.info( u'CHK_MON %s centre: %s' % ( city_code, centre ) )
-
-    polygon = centre.buffer( 0.25, resolution=20 )
-    logging.info( u'CHK_MON %s bounding polygon: %s' % ( city_code, polygon ) )
+    seen = SeenCheckins( SEEN_WINDOW )
+    cities = []
+    for city_code in city_codes:
+        # get the centre point for the city and construct a bounding area
+        centre = _credentials.centres[city_code]
+        logging.info( u'CHK_MON %s centre: %s' % ( city_code, centre ) )
+        fence = city_fence( centre, polygon=getattr( _credentials, 'geofences', {} ).get( city_code ) )
+        logging.info( u'CHK_MON %s bounding area: %s' % ( city_code, fence ) )
+        cities.append( CityMonitor( dbw, city_code, fence, seen ) )
 
-    # retrieve the list of venues from the database
-    venues = dbw.get_venues_in_city( city_code )
-    logging.info( u'CHK_MON retrieved %d venues from database for %s' % ( len(venues), city_code ) )
-
-    # loop forever checking the venues for checkins
-    while True:
-        count_venues = 0
-        count_checkins = 0
-        count_venues_with_checkins = 0
-        logging.info( u'CHK_MON start running checkin crawl in %s' % city_code )
-        # log the start of a crawl
-        crawl_string = 'MONITOR_CHECKINS_' + city_code
-        dbw.add_crawl_to_database( crawl_string, 'START', now.now( ) )
-        for venue in venues:
-            if dbw.is_active( venue ):
-                location = venue.location
-                lat = location.latitude
-                lng = location.longitude
-                point = Point(lat,lng)
-                if polygon.contains(point):
-                    logging.info( u'CHK_MON %s: retrieve details for venue: %s' % ( city_code, venue.name ) )
-                    response, success = get_venue_details( venue.foursq_id, userless=True )
-                    if success:
-                        count_venues = count_venues + 1
-                        v = response.get( 'response' )
-                        v = v.get( 'venue' )
-                        hereNow = v.get( 'hereNow' )
-                        count = hereNow.get( 'count' )
-                        logging.info( u'CHK_MON %s: checkins found: %d' % ( city_code, count ) )
-                        if count > 0:
-                            count_venues_with_checkins = count_venues_with_checkins + 1
-                            response, success = get_venue_details( venue.foursq_id, aspect="herenow", userless=False )
-                            if success:
-                                hereNow = response['response']
-                                hereNow = hereNow['hereNow']
-                                items = hereNow['items']
-                                for item in items:
-                                    count_checkins = count_checkins + 1
-                                    logging.info( u'CHK_MON %s: Adding checkin' % city_code )
-                                    dbw.add_checkin_to_database(item, venue )
-                    else:
-                        logging.info( u'STAT_CHK %s: Error for venue: %s, id: %s' % ( venue.city_code, venue.name, venue.foursq_id ) )
-        # log the end of the crawl
-        dbw.add_crawl_to_database(crawl_string, 'FINISH', now.now( ) )
-        logging.info( u'CHK_MON %s venues checked: %d' % ( city_code, count_venues ) )
-        logging.info( u'CHK_MON %s venues with checkins: %d' % ( city_code, count_venues_with_checkins ) )
-        logging.info( u'CHK_MON %s checkins: %d' % ( city_code, count_checkins ) )
+    # every poll is one userless query, and one authenticated query if anyone is there
+    workers = getattr( _credentials, 'monitor_workers', WORKERS )
+    MultiCityMonitor( dbw, cities, USERLESS_QUOTA * len( client_tuples ), AUTH_QUOTA * len( access_tokens ), seen, workers ).run( )
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Polling schedule for the checkin monitor.
+
+A checkin stays in a venue's herenow list for a while (`window`) after it is
+made, so polling a venue every `window` catches all of its checkins, and
+polling it every interval t > window catches about window / t of them. With
+checkins arriving at a venue at rate r, a poll of the venue is worth about
+r * window checkins for as long as the venue is polled less often than once
+per window, and nothing more beyond that.
+
+The scheduler estimates r for each venue and spends the polling quota (polls
+per hour) where it is worth the most:
+
+    - every venue is polled at least once every `max_interval`, so that
+      quiet venues are still noticed when they get busier;
+    - the rest of the quota goes to the venues with the highest rates,
+      each polled once per `window`, busiest first, until it runs out.
+
+Polling a venue more often than once per `window` is not worth a poll, so
+with quota to spare every venue is polled once per window.
+
+A poll is one userless call, plus one authenticated call to read the herenow
+list when it is not empty. The authenticated calls have a quota of their own
+(`auth_per_hour`), so each venue's polls are also charged the authenticated
+calls they are expected to make: with checkins arriving at rate r and staying
+`window`, the herenow list is empty with probability exp( -r * window ). The
+extra polls stop at whichever quota runs out first.
+
+A venue's rate is estimated from
+    - its statistics: the growth of its total checkin count between its
+      first and last statistics (first_checkins ... last_stat_date),
+    - its captured history: checkins stored for it over the last
+      `history` (a lower bound, as not every checkin is captured),
+taking the larger of the two as a prior worth `prior_hours` of polling, and
+then from what its own polls capture while the monitor runs.
+
+Times are epoch seconds; rates are checkins per hour.
+"""
+from datetime import timedelta
+import heapq
+import logging
+import math
+import time
+
+HOUR = 3600.0
+
+
+def total_hours( delta ):
+    return ( delta.days * 86400 + delta.seconds ) / HOUR
+
+
+class VenueSchedule( object ):
+    """
+    What the scheduler knows about one venue.
+    """
+    __slots__ = [ 'venue', 'prior_rate', 'polls', 'captured', 'exposure', 'interval', 'next_poll', 'last_poll' ]
+
+    def __init__( self, venue, prior_rate ):
+        self.venue = venue
+        self.prior_rate = prior_rate
+        self.polls = 0
+        self.captured = 0       # checkins captured by polls of this venue
+        self.exposure = 0.0     # hours of herenow covered by those polls
+        self.interval = None    # seconds between polls
+        self.next_poll = None
+        self.last_poll = None
+
+    def rate( self, prior_hours ):
+        """
+        Estimated checkins per hour: the prior, counted as `prior_hours` of
+        polling, updated with the captures of the polls so far.
+        """
+        return ( self.prior_rate * prior_hours + self.captured ) / ( prior_hours + self.exposure )
+
+    def occupancy( self, prior_hours, window ):
+        """
+        Probability that a poll finds checkins in the herenow list, and so makes
+        an authenticated call: a Poisson arrival of the checkins made during
+        the last `window` seconds.
+        """
+        return 1.0 - math.exp( -self.rate( prior_hours ) * window / HOUR )
+
+
+class PollScheduler( object ):
+    """
+    Decides which venue to poll next. See the module docstring.
+
+    Use: update( venues ) with the venues to monitor (again whenever the set
+    changes), then repeatedly next_venue(), poll it, and record() the
+    checkins found.
+    """
+    def __init__( self, polls_per_hour, auth_per_hour=None, window=timedelta( hours=2 ), max_interval=timedelta( hours=24 ),
+                        prior_hours=24.0, history=timedelta( days=7 ) ):
+        self.polls_per_hour = float( polls_per_hour )
+        self.auth_per_hour = float( auth_per_hour ) if auth_per_hour is not None else None     # None for no limit
+        self.window = total_hours( window ) * HOUR
+        self.max_interval = total_hours( max_interval ) * HOUR
+        self.prior_hours = prior_hours
+        self.history = history
+        self.venues = {}        # venue id -> VenueSchedule
+        self.queue = []         # heap of ( next poll time, venue id )
+        self.in_flight = set()  # venue ids taken and not yet recorded
+
+    def __len__( self ):
+        return len( self.venues )
+
+    def update( self, venues, captured_counts={}, now=None ):
+        """
+        Set the venues to monitor and recompute every venue's polling interval.
+
+        Input   `venues`: VenueRecords
+                `captured_counts`: venue id -> checkins stored for the venue over
+                the last `history` (see DBWrapper.get_venue_checkin_counts())
+        """
+        if now is None:
+            now = time.time()
+        history_hours = total_hours( self.history )
+        venues_by_id = dict( ( v.id, v ) for v in venues )
+        for venue_id in self.venues.keys():
+            if venue_id not in venues_by_id:
+                del self.venues[venue_id]
+        for venue_id, venue in venues_by_id.items():
+            prior = max( statistics_rate( venue ), captured_counts.get( venue_id, 0 ) / history_hours )
+            schedule = self.venues.get( venue_id )
+            if schedule is None:
+                self.venues[venue_id] = VenueSchedule( venue, prior )
+            else:
+                schedule.venue = venue
+                schedule.prior_rate = prior
+        self.allocate( now )
+
+    def allocate( self, now=None ):
+        """
+        Divide the polling quota between the venues and reschedule them.
+        """
+        if now is None:
+            now = time.time()
+        schedules = self.venues.values()
+        if not schedules:
+            self.queue = []
+            return
+        floor = HOUR / self.max_interval                        # polls per hour per venue
+        cap = HOUR / self.window
+        occupancy = dict( ( s.venue.id, s.occupancy( self.prior_hours, self.window ) ) for s in schedules )
+        # the authenticated quota as a number of userless polls, at the venues' occupancies
+        auth = self.auth_per_hour if self.auth_per_hour is not None else float( 'inf' )
+        minimum = floor * len( schedules )
+        if minimum >= self.polls_per_hour or floor * sum( occupancy.values() ) >= auth:
+            # not even enough quota for the minimum: poll round robin
+            frequency = self.polls_per_hour / len( schedules )
+            if sum( occupancy.values() ):
+                frequency = min( frequency, auth / sum( occupancy.values() ) )
+            frequencies = dict( ( s.venue.id, frequency ) for s in schedules )
+        else:
+            spare = self.polls_per_hour - minimum
+            spare_auth = auth - floor * sum( occupancy.values() )
+            frequencies = {}
+            for s in sorted( schedules, key=lambda s: s.rate( self.prior_hours ), reverse=True ):
+                p = occupancy[s.venue.id]
+                extra = min( cap - floor, spare, spare_auth / p if p else spare )
+                spare -= extra
+                spare_auth -= extra * p
+                frequencies[s.venue.id] = floor + extra
+
+        self.queue = []
+        unpolled = 0
+        for s in sorted( schedules, key=lambda s: s.rate( self.prior_hours ), reverse=True ):
+            s.interval = HOUR / frequencies[s.venue.id]
+            if s.last_poll is None:
+                # first polls at the quota's pace, busiest first
+                s.next_poll = now + unpolled * HOUR / self.polls_per_hour
+                unpolled += 1
+            else:
+                s.next_poll = max( now, s.last_poll + s.interval )
+            if s.venue.id not in self.in_flight:
+                self.queue.append( ( s.next_poll, s.venue.id ) )
+        heapq.heapify( self.queue )
+
+    def next_venue( self ):
+        """
+        Output  ( time the venue is due, venue ) for the venue due soonest,
+                or ( None, None ) if there are no venues
+        """
+        while self.queue:
+            due, venue_id = self.queue[0]
+            schedule = self.venues.get( venue_id )
+            if schedule is not None and schedule.next_poll == due:
+                return due, schedule.venue
+            heapq.heappop( self.queue )         # removed or rescheduled
+        return None, None
+
+    def take( self, now=None ):
+        """
+        For several workers sharing a scheduler: takes the venue due soonest
+        if it is due by `now`, so that no other worker polls it before its
+        poll is record()ed.
+
+        Output  the venue, or None if no venue is due
+        """
+        if now is None:
+            now = time.time()
+        due, venue = self.next_venue()
+        if venue is None or due > now:
+            return None
+        heapq.heappop( self.queue )
+        self.in_flight.add( venue.id )
+        return venue
+
+    def record( self, venue_id, checkin_times, now=None ):
+        """
+        Record a poll of a venue and schedule its next poll.
+
+        Input   `checkin_times`: createdAt (epoch seconds) of the checkins the
+                poll found, or None if the poll failed. Only the checkins made
+                since the venue's previous poll count as captured by this one.
+        """
+        if now is None:
+            now = time.time()
+        self.in_flight.discard( venue_id )
+        schedule = self.venues.get( venue_id )
+        if schedule is None:
+            return
+        if checkin_times is not None:
+            covered = self.window if schedule.last_poll is None else min( self.window, now - schedule.last_poll )
+            schedule.polls += 1
+            schedule.captured += len( [ t for t in checkin_times if t >= now - covered ] )
+            schedule.exposure += covered / HOUR
+            schedule.last_poll = now
+        schedule.next_poll = now + schedule.interval
+        heapq.heappush( self.queue, ( schedule.next_poll, venue_id ) )
+
+    def snapshot( self ):
+        """
+        Output  what the polls so far have learnt, as a JSON-serialisable dict of
+                venue id (string) -> [ polls, captured, exposure, last poll time ]
+        """
+        return dict( ( str( venue_id ), [ s.polls, s.captured, s.exposure, s.last_poll ] )
+                     for venue_id, s in self.venues.items() if s.polls )
+
+    def restore( self, snapshot, now=None ):
+        """
+        Carry on from a snapshot() taken before a restart: venues polled
+        recently are not polled again until they are due, so the venues not
+        reached before the restart are polled first. Venues not monitored
+        any more are ignored.
+        """
+        for venue_id, ( polls, captured, exposure, last_poll ) in snapshot.items():
+            schedule = self.venues.get( int( venue_id ) )
+            if schedule is not None:
+                schedule.polls = polls
+                schedule.captured = captured
+                schedule.exposure = exposure
+                schedule.last_poll = last_poll
+        self.allocate( now )
+
+    def demand( self ):
+        """
+        Output  ( polls per hour, authenticated calls per hour ) that could be put to use: every
+                venue polled once per window
+        """
+        auth = sum( s.occupancy( self.prior_hours, self.window ) for s in self.venues.values() )
+        return len( self.venues ) * HOUR / self.window, auth * HOUR / self.window
+
+    def expected_per_hour( self ):
+        """
+        Output  ( polls per hour, expected authenticated calls per hour, expected checkins
+                captured per hour ) of the current allocation
+        """
+        polls = 0.0
+        auth = 0.0
+        captured = 0.0
+        for s in self.venues.values():
+            polls += HOUR / s.interval
+            auth += HOUR / s.interval * s.occupancy( self.prior_hours, self.window )
+            captured += s.rate( self.prior_hours ) * min( 1.0, self.window / s.interval )
+        return polls, auth, captured
+
+    def state( self ):
+        """
+        Output  list of dicts, one per venue, busiest first: venue id, name, estimated
+                rate, prior rate, polls, checkins captured, polling interval (seconds)
+                and next poll time (epoch seconds)
+        """
+        rows = []
+        for s in self.venues.values():
+            rows.append( { 'venue_id': s.venue.id, 'name': s.venue.name, 'rate': s.rate( self.prior_hours ),
+                           'prior_rate': s.prior_rate, 'polls': s.polls, 'captured': s.captured,
+                           'interval': s.interval, 'next_poll': s.next_poll } )
+        rows.sort( key=lambda r: r['rate'], reverse=True )
+        return rows
+
+    def log_state( self, prefix, top=10 ):
+        polls, auth, captured = self.expected_per_hour()
+        logging.info( u'%s schedule: %d venues, %.0f polls/hour, %.0f authenticated calls/hour, %.1f expected checkins/hour (%.3f per poll)' % (
+                      prefix, len( self.venues ), polls, auth, captured, captured / polls if polls else 0.0 ) )
+        for row in self.state()[:top]:
+            logging.info( u'%s   %-30s rate %.2f/h, every %.0f min, %d polls, %d captured' % (
+                          prefix, row['name'], row['rate'], row['interval'] / 60.0, row['polls'], row['captured'] ) )
+
+
+def statistics_rate( venue ):
+    """
+    Checkins per hour of a venue from the growth of its checkin count between
+    its first and last statistics (VenueRecord activity columns), or 0.
+    """
+    if venue.first_stat_date is None or venue.last_stat_date is None:
+        return 0.0
+    if venue.first_checkins is None or venue.last_checkins is None:
+        return 0.0
+    hours = total_hours( venue.last_stat_date - venue.first_stat_date )
+    if hours <= 0:
+        return 0.0
+    return max( 0, venue.last_checkins - venue.first_checkins ) / hours
+
+def fair_shares( demands, total ):
+    """
+    Max-min fair division of `total` (e.g. polls per hour) between claimants
+    with the given demands: no claimant gets more than it asks for, and
+    what the others leave unused is shared equally by the rest. Anything
+    left once every demand is met is shared equally by everyone.
+
+    Input   `demands`: dict of claimant -> demand
+    Output  dict of claimant -> share
+    """
+    shares = {}
+    remaining = float( total )
+    pending = sorted( demands.items(), key=lambda item: item[1] )
+    while pending:
+        equal = remaining / len( pending )
+        claimant, demand = pending[0]
+        if demand > equal:
+            break
+        shares[claimant] = demand
+        remaining -= demand
+        pending.pop( 0 )
+    for claimant, demand in pending:
+        shares[claimant] = remaining / len( pending )
+    if not pending and demands:
+        extra = remaining / len( demands )
+        for claimant in shares:
+            shares[claimant] += extra
+    return shares
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+The set of checkins the monitor has already stored, so that the checkins
+found again by later polls of a venue are skipped without a database lookup.
+
+A checkin stays in a venue's herenow list for hours, so most of the items a
+poll returns were stored by an earlier poll. Only the checkins made in the
+last `window` are remembered: entries expire by their createdAt, so the set
+stays the size of a few hours of checkins. The set is exact (foursquare id
+-> createdAt), so a checkin it does not know is always looked up as before;
+a checkin older than the window is simply looked up in the database again.
+"""
+from datetime import timedelta
+import heapq
+import threading
+import time
+
+
+class SeenCheckins( object ):
+    """
+    A time-windowed set of checkin foursquare ids. Thread-safe; keeps
+    hit/miss counters so its effectiveness can be checked from the logs.
+    """
+
+    def __init__( self, window=timedelta( hours=12 ) ):
+        self.window = window.days * 86400 + window.seconds
+        self.hits = 0
+        self.misses = 0
+        self.__created = {}         # foursquare id -> createdAt
+        self.__expiry = []          # heap of ( createdAt, foursquare id )
+        self.__lock = threading.Lock()
+
+    def __len__( self ):
+        return len( self.__created )
+
+    def __contains__( self, foursq_id ):
+        return foursq_id in self.__created
+
+    def seen( self, checkin ):
+        """
+        Input   `checkin`: dict with the checkin's 'id'
+        Output  True if the checkin has been stored already
+        """
+        with self.__lock:
+            if checkin.get( 'id' ) in self.__created:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add( self, foursq_id, created_at, now=None ):
+        """
+        Remember a stored checkin, and forget those older than the window.
+        """
+        if foursq_id is None:
+            return
+        if now is None:
+            now = time.time()
+        with self.__lock:
+            if foursq_id not in self.__created:
+                self.__created[foursq_id] = created_at
+                heapq.heappush( self.__expiry, ( created_at, foursq_id ) )
+            self.__expire( now )
+
+    def warm( self, pairs, now=None ):
+        """
+        Fill the set from an iterable of ( foursquare id, createdAt ) pairs,
+        e.g. DBWrapper.get_recent_checkin_ids().
+        """
+        if now is None:
+            now = time.time()
+        with self.__lock:
+            for foursq_id, created_at in pairs:
+                if foursq_id is not None and foursq_id not in self.__created:
+                    self.__created[foursq_id] = created_at
+                    self.__expiry.append( ( created_at, foursq_id ) )
+            heapq.heapify( self.__expiry )
+            self.__expire( now )
+
+    def __expire( self, now ):
+        oldest = now - self.window
+        while self.__expiry and self.__expiry[0][0] < oldest:
+            created_at, foursq_id = heapq.heappop( self.__expiry )
+            del self.__created[foursq_id]
+
+    def hit_rate( self ):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float( self.hits ) / lookups
+
+    def __repr__( self ):
+        return u"<SeenCheckins(%d, hit rate %.3f)>" % ( len( self.__created ), self.hit_rate() )
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Connection settings for the SQLite databases.
+
+Several processes (one monitor per city, the statistics checker and the
+friend crawler) write to the same database file at once. With SQLite's
+default rollback journal every writer blocks every reader, and a writer that
+can't get the lock fails straight away with "database is locked". The profile
+below switches the database to write-ahead logging, relaxes fsync to once per
+checkpoint, enlarges the page cache and makes connections wait for locks
+rather than fail.
+
+The profile is applied to every new DBAPI connection; see `apply_profile`.
+Settings can be overridden per deployment with a `sqlite_profile` dict in
+_credentials.py, e.g. { 'synchronous': 'FULL' }. A value of None disables
+that pragma.
+"""
+
+SQLITE_PROFILE = {
+    'journal_mode': 'WAL',          # readers no longer block the writer (and vice versa)
+    'synchronous': 'NORMAL',        # safe with WAL; fsync only at checkpoints
+    'cache_size': -65536,           # negative means KiB, i.e. 64MB of page cache
+    'mmap_size': 268435456,         # map up to 256MB of the file
+    'temp_store': 'MEMORY',
+    'busy_timeout': 30000,          # ms to wait for a lock before giving up
+}
+
+# Order matters: journal_mode must be set before anything starts a transaction.
+PRAGMA_ORDER = [ 'busy_timeout', 'journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store' ]
+
+
+def get_profile( overrides=None ):
+    """
+    Return the default profile updated with `overrides` (a dict).
+    """
+    profile = dict( SQLITE_PROFILE )
+    if overrides:
+        profile.update( overrides )
+    return profile
+
+def apply_profile( dbapi_con, profile ):
+    """
+    Issue the PRAGMAs in `profile` on a raw sqlite3 connection.
+    """
+    cursor = dbapi_con.cursor()
+    for name in PRAGMA_ORDER:
+        value = profile.get( name )
+        if value is not None:
+            cursor.execute( 'PRAGMA %s=%s' % ( name, value ) )
+    cursor.close()
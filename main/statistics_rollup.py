@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Retention and rollup of venue statistics.
+
+Statistics are kept at full resolution while they are recent. Once older than
+the age given for a tier they are folded into that tier's buckets, keeping the
+first, last and maximum values seen in each bucket, and deleted from the level
+below. With the default tiers:
+
+    raw statistics older than 7 days    -> hourly buckets
+    hourly buckets older than 90 days   -> daily buckets
+    daily buckets older than 365 days   -> weekly buckets
+
+so the amount of statistics kept per venue stays roughly constant however long
+the crawlers run. The tiers can be changed with a `statistics_rollup_tiers`
+list in _credentials.py, in the same format as TIERS below.
+
+The rollup works one venue at a time and commits after every few venues, so
+it never holds the write lock for long. The row holding a venue's current
+statistics (venues.last_statistic_id) is never rolled up.
+
+DBWrapper.get_statistics_series() reads raw rows and rollups together.
+
+Run once with:      manage_database.py rollup-stats
+Run continuously:   statistics_rollup.py [interval_hours]
+"""
+from datetime import datetime, timedelta
+from database import Statistic, StatisticRollup, Venue
+from sqlalchemy.sql.expression import bindparam
+import calendar
+import logging
+import time
+import sys
+
+# (tier name, bucket width, age after which the level below is folded into this tier)
+TIERS = [
+    ( 'hourly', timedelta( hours=1 ), timedelta( days=7 ) ),
+    ( 'daily', timedelta( days=1 ), timedelta( days=90 ) ),
+    ( 'weekly', timedelta( weeks=1 ), timedelta( days=365 ) ),
+]
+
+# Buckets are aligned to this date (a Monday, so weekly buckets start on Mondays).
+EPOCH = datetime( 2011, 1, 3 )
+
+def total_seconds( delta ):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+def epoch( date ):
+    """
+    Whole Unix epoch seconds of a naive datetime read as UTC, as SQLite's
+    strftime('%s') reads it.
+    """
+    return calendar.timegm( date.timetuple() )
+
+def local_epoch( date ):
+    """
+    Whole Unix epoch seconds of a naive datetime in local time, such as the
+    statistics dates (taken with datetime.now()).
+    """
+    return int( time.mktime( date.timetuple() ) )
+
+def bucket_start( date, width ):
+    """
+    Start of the bucket of length `width` (a timedelta) containing `date`.
+    """
+    width_s = total_seconds( width )
+    n = int( total_seconds( date - EPOCH ) // width_s )
+    return EPOCH + timedelta( seconds=n * width_s )
+
+
+class Summary( object ):
+    """
+    First/last/max summary of some statistics; a rollup row, a raw
+    statistic (as a summary of one sample) or a bucket being built.
+    """
+    __slots__ = [ 'first_date', 'last_date', 'first_checkins', 'last_checkins', 'max_checkins',
+                  'first_users', 'last_users', 'max_users', 'samples' ]
+
+    def __init__( self ):
+        self.samples = 0
+
+    @classmethod
+    def from_statistic( cls, date, confirmed_at, checkins, users ):
+        s = cls()
+        s.first_date = date
+        s.last_date = confirmed_at or date
+        s.first_checkins = s.last_checkins = s.max_checkins = checkins
+        s.first_users = s.last_users = s.max_users = users
+        s.samples = 1
+        return s
+
+    @classmethod
+    def from_rollup( cls, rollup ):
+        s = cls()
+        for name in cls.__slots__:
+            setattr( s, name, getattr( rollup, name ) )
+        return s
+
+    def add( self, other ):
+        if self.samples == 0 or other.first_date < self.first_date:
+            self.first_date = other.first_date
+            self.first_checkins = other.first_checkins
+            self.first_users = other.first_users
+        if self.samples == 0 or other.last_date >= self.last_date:
+            self.last_date = other.last_date
+            self.last_checkins = other.last_checkins
+            self.last_users = other.last_users
+        if self.samples == 0:
+            self.max_checkins = other.max_checkins
+            self.max_users = other.max_users
+        else:
+            self.max_checkins = max( self.max_checkins, other.max_checkins )
+            self.max_users = max( self.max_users, other.max_users )
+        self.samples += other.samples
+
+    def store( self, rollup ):
+        for name in self.__slots__:
+            setattr( rollup, name, getattr( self, name ) )
+
+
+class StatisticsRollup( object ):
+    """
+    Folds old statistics into the rollup tiers. See the module docstring.
+    """
+    def __init__( self, dbw, tiers=TIERS, venues_per_commit=100, pause=0.0 ):
+        """
+        `venues_per_commit` venues are rolled up per transaction, sleeping
+        `pause` seconds between transactions to let other writers in.
+        """
+        self.dbw = dbw
+        self.tiers = tiers
+        self.venues_per_commit = venues_per_commit
+        self.pause = pause
+
+    @property
+    def session( self ):
+        return self.dbw.session
+
+    def run( self, now=None ):
+        """
+        Roll up everything that is due at `now` (default: the current time).
+
+        Output  dict of tier name -> number of source rows folded into it
+        """
+        if now is None:
+            now = datetime.now()
+        folded = {}
+        for index, ( tier, width, age ) in enumerate( self.tiers ):
+            folded[tier] = self.run_tier( index, now - age )
+            logging.info( u'ROLLUP %s: %d rows folded' % ( tier, folded[tier] ) )
+        return folded
+
+    def run_tier( self, index, cutoff ):
+        """
+        Fold every source row of tier `index` that is older than `cutoff`.
+        """
+        venue_ids = [ row[0] for row in self.session.query( Venue.id ).order_by( Venue.id ).all() ]
+        folded = 0
+        for i, venue_id in enumerate( venue_ids ):
+            folded += self.roll_venue( index, venue_id, cutoff )
+            if ( i + 1 ) % self.venues_per_commit == 0:
+                self.session.commit()
+                if self.pause:
+                    time.sleep( self.pause )
+        self.session.commit()
+        return folded
+
+    def roll_venue( self, index, venue_id, cutoff ):
+        tier, width, age = self.tiers[index]
+        sources, delete = self.__sources( index, venue_id, cutoff )
+        if not sources:
+            return 0
+
+        buckets = {}
+        for s in sources:
+            key = bucket_start( s.first_date, width )
+            buckets.setdefault( key, Summary() ).add( s )
+
+        existing = self.session.query( StatisticRollup ).filter( StatisticRollup.venue_id == venue_id
+                        ).filter( StatisticRollup.tier == tier ).filter( StatisticRollup.bucket_start.in_( buckets.keys() ) ).all()
+        existing = dict( ( r.bucket_start, r ) for r in existing )
+        for key, summary in buckets.items():
+            rollup = existing.get( key )
+            if rollup is None:
+                rollup = StatisticRollup( venue_id, tier, key )
+                self.session.add( rollup )
+            else:
+                summary.add( Summary.from_rollup( rollup ) )
+            summary.store( rollup )
+        self.session.flush()
+        delete()
+        return len( sources )
+
+    def __sources( self, index, venue_id, cutoff ):
+        """
+        The rows to fold into tier `index` for a venue, as Summaries, and a
+        function that deletes them.
+        """
+        if index == 0:
+            current = self.session.query( Venue.last_statistic_id ).filter( Venue.id == venue_id ).scalar()
+            rows = self.session.query( Statistic.id, Statistic.date, Statistic.confirmed_at, Statistic.checkins, Statistic.users
+                        ).filter( Statistic.venue_id == venue_id ).filter( Statistic.date < cutoff ).all()
+            rows = [ r for r in rows if r[0] != current ]
+            table = Statistic.__table__
+            id_column = Statistic.id
+            sources = [ Summary.from_statistic( *r[1:] ) for r in rows ]
+            ids = [ r[0] for r in rows ]
+            # raw statistics rows are counted in the activity counters
+            city_code = self.session.query( Venue.city_code ).filter( Venue.id == venue_id ).scalar()
+            hours = {}
+            for r in rows:
+                hour = epoch( r[1] )
+                hours[hour] = hours.get( hour, 0 ) + 1
+        else:
+            source_tier = self.tiers[index - 1][0]
+            rows = self.session.query( StatisticRollup ).filter( StatisticRollup.venue_id == venue_id
+                        ).filter( StatisticRollup.tier == source_tier ).filter( StatisticRollup.bucket_start < cutoff ).all()
+            table = StatisticRollup.__table__
+            id_column = StatisticRollup.id
+            sources = [ Summary.from_rollup( r ) for r in rows ]
+            ids = [ r.id for r in rows ]
+            for r in rows:
+                self.session.expunge( r )
+            hours = {}
+
+        def delete():
+            if ids:
+                self.session.execute( table.delete().where( id_column == bindparam( 'row_id' ) ), [ { 'row_id': i } for i in ids ] )
+            for hour, n in hours.items():
+                self.dbw.bump_activity_counters( city_code, hour, statistics=-n )
+        return sources, delete
+
+
+if __name__ == "__main__":
+    import _credentials
+    from database_wrapper import DBWrapper
+    from setproctitle import setproctitle
+
+    args = sys.argv
+    interval = float( args[1] ) if len( args ) > 1 else 1.0
+    setproctitle( 'ROLLUP' )
+    dbw = DBWrapper( warm_caches=False, ingest_address=None )
+    tiers = getattr( _credentials, 'statistics_rollup_tiers', TIERS )
+    rollup = StatisticsRollup( dbw, tiers, pause=0.5 )
+    while True:
+        logging.info( u'ROLLUP starting rollup of statistics' )
+        rollup.run()
+        time.sleep( interval * 60 * 60 )
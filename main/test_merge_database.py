@@ -0,0 +1,170 @@
+"""
+Tests for merge_database: run with  python -m unittest test_merge_database
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from sqlite3 import dbapi2 as sqlite
+
+import database_wrapper
+import merge_database
+
+
+def make_database( path ):
+    """
+    Create an empty database with the current schema (and triggers) at `path`.
+    """
+    database_wrapper.DATABASE = 'sqlite:///%s' % path
+    dbw = database_wrapper.DBWrapper( warm_caches=False, ingest_address=None )
+    dbw.upgrade_tables( )
+    dbw.session.close( )
+
+def add_venues( path, venues ):
+    """
+    Add `venues`, ( foursq_id, name ) pairs, each with its own location.
+    """
+    con = sqlite.connect( path )
+    for i, ( foursq_id, name ) in enumerate( venues ):
+        cursor = con.execute( 'INSERT INTO locations ( latitude, longitude, geokey ) VALUES ( ?, ?, ? )',
+                              ( 51.48 + i * 0.001, -3.18, 1000 + i ) )
+        con.execute( 'INSERT INTO venues ( foursq_id, name, city_code, location_id, active ) VALUES ( ?, ?, ?, ?, 0 )',
+                     ( foursq_id, name, 'CDF', cursor.lastrowid ) )
+    con.commit( )
+    con.close( )
+
+def add_statistics( path, statistics ):
+    """
+    Add `statistics`, ( venue foursq_id, date, confirmed_at, checkins, users ) tuples.
+    """
+    con = sqlite.connect( path )
+    con.executemany( """INSERT INTO statistics ( venue_id, date, confirmed_at, checkins, users )
+                        SELECT id, ?, ?, ?, ? FROM venues WHERE foursq_id = ?""",
+                     [ ( date, confirmed_at, checkins, users, venue ) for venue, date, confirmed_at, checkins, users in statistics ] )
+    con.commit( )
+    con.close( )
+
+def add_checkins( path, checkins ):
+    """
+    Add `checkins`, ( foursq_id, user foursq_id, venue foursq_id, created_at ) tuples, and their users.
+    """
+    con = sqlite.connect( path )
+    for foursq_id, user, venue, created_at in checkins:
+        if con.execute( 'SELECT 1 FROM users WHERE foursq_id = ?', ( user, ) ).fetchone() is None:
+            con.execute( 'INSERT INTO users ( foursq_id, first_name ) VALUES ( ?, ? )', ( user, user ) )
+        con.execute( """INSERT INTO checkins ( foursq_id, user_id, venue_id, created_at )
+                        SELECT ?, u.id, v.id, ? FROM users u, venues v WHERE u.foursq_id = ? AND v.foursq_id = ?""",
+                     ( foursq_id, created_at, user, venue ) )
+    con.commit( )
+    con.close( )
+
+def venue_summaries( path ):
+    """
+    Output  ( activity columns of every venue by foursq_id, capture rates by venue foursq_id and day )
+    """
+    con = sqlite.connect( path )
+    venues = dict( ( row[0], row[1:] ) for row in con.execute(
+        """SELECT foursq_id, active, first_checkins, first_stat_date, last_checkins, last_users, last_stat_date,
+                  last_checkin_at, ( SELECT date FROM statistics s WHERE s.id = venues.last_statistic_id )
+           FROM venues""" ) )
+    rates = dict( ( ( venue, day ), ( round( expected, 6 ), covered, captured ) ) for venue, day, expected, covered, captured in con.execute(
+        """SELECT v.foursq_id, c.day, c.expected, c.covered, c.captured FROM capture_rates c JOIN venues v ON v.id = c.venue_id""" ) )
+    con.close( )
+    return venues, rates
+
+def rebuild( path ):
+    """
+    Rebuild the activity summaries and capture rates of the database at `path`.
+
+    Output  venue_summaries after the rebuild
+    """
+    database_wrapper.DATABASE = 'sqlite:///%s' % path
+    dbw = database_wrapper.DBWrapper( warm_caches=False, ingest_address=None )
+    dbw.rebuild_venue_activity( )
+    dbw.rebuild_capture_rates( )
+    dbw.session.close( )
+    return venue_summaries( path )
+
+
+class MergeTestCase( unittest.TestCase ):
+
+    def setUp( self ):
+        self.database = database_wrapper.DATABASE
+        self.dir = tempfile.mkdtemp( )
+        self.joint = os.path.join( self.dir, 'joint.db' )
+
+    def tearDown( self ):
+        database_wrapper.DATABASE = self.database
+        shutil.rmtree( self.dir )
+
+    def source( self, name ):
+        path = os.path.join( self.dir, name )
+        make_database( path )
+        return path
+
+    def counts( self, report, table ):
+        return [ ( total, inserted, updated ) for source, name, total, inserted, updated in report if name == table ]
+
+    def test_counts_leave_out_trigger_writes( self ):
+        a = self.source( 'a.db' )
+        add_venues( a, [ ( 'v%d' % i, 'Venue %d' % i ) for i in range( 6 ) ] )
+        report = merge_database.merge( self.joint, [ ( a, 'CDF' ) ] )
+        # the new venues' summaries are computed
+        self.assertEqual( self.counts( report, 'venues' ), [ ( 6, 6, 6 ) ] )
+        self.assertEqual( self.counts( report, 'locations' ), [ ( 6, 6, 0 ) ] )
+        con = sqlite.connect( self.joint )
+        # the venue_changes triggers did fire for the merged venues
+        self.assertEqual( con.execute( 'SELECT COUNT(*) FROM venue_changes' ).fetchone()[0], 6 )
+        con.close( )
+
+        # nothing new: the watermarks leave no rows to count
+        report = merge_database.merge( self.joint, [ ( a, 'CDF' ) ] )
+        self.assertEqual( self.counts( report, 'venues' ), [ ( 0, 0, 0 ) ] )
+
+        # a second source with the same venues and two new ones
+        b = self.source( 'b.db' )
+        add_venues( b, [ ( 'v%d' % i, 'Venue %d' % i ) for i in range( 4, 8 ) ] )
+        report = merge_database.merge( self.joint, [ ( b, 'BRS' ) ] )
+        self.assertEqual( self.counts( report, 'venues' ), [ ( 4, 2, 2 ) ] )
+
+    def test_overlapping_sources_match_a_rebuild( self ):
+        a = self.source( 'a.db' )
+        b = self.source( 'b.db' )
+        venues = [ ( 'v%d' % i, 'Venue %d' % i ) for i in range( 4 ) ]
+        add_venues( a, venues[:3] )
+        add_venues( b, venues[1:] )
+        # v1 and v2 are in both: interleaved statistics, one (v1 on the 3rd) taken by both
+        add_statistics( a, [ ( 'v0', '2011-03-01 10:00:00.000000', '2011-03-01 22:00:00.000000', 5, 2 ),
+                             ( 'v0', '2011-03-02 10:00:00.000000', None, 9, 3 ),
+                             ( 'v1', '2011-03-01 09:00:00.000000', None, 10, 4 ),
+                             ( 'v1', '2011-03-03 09:00:00.000000', '2011-03-03 18:00:00.000000', 14, 5 ),
+                             ( 'v2', '2011-03-02 12:00:00.000000', None, 20, 7 ) ] )
+        add_statistics( b, [ ( 'v1', '2011-03-02 09:00:00.000000', None, 12, 4 ),
+                             ( 'v1', '2011-03-03 09:00:00.000000', '2011-03-04 06:00:00.000000', 14, 5 ),
+                             ( 'v1', '2011-03-05 09:00:00.000000', None, 21, 6 ),
+                             ( 'v2', '2011-03-01 12:00:00.000000', None, 18, 7 ),
+                             ( 'v3', '2011-03-01 08:00:00.000000', None, 1, 1 ) ] )
+        add_checkins( a, [ ( 'c1', 'u1', 'v1', 1299000000 ), ( 'c2', 'u2', 'v2', 1299100000 ) ] )
+        add_checkins( b, [ ( 'c1', 'u1', 'v1', 1299000000 ), ( 'c3', 'u1', 'v1', 1299200000 ), ( 'c4', 'u3', 'v3', 1299300000 ) ] )
+
+        sources = [ ( a, 'CDF' ), ( b, 'BRS' ) ]
+        merge_database.merge( self.joint, sources )
+        merged = venue_summaries( self.joint )
+        self.assertEqual( merged, rebuild( self.joint ) )
+
+        # more rows in both, merged incrementally and into a new joint database
+        add_statistics( a, [ ( 'v1', '2011-03-04 09:00:00.000000', None, 17, 5 ),
+                             ( 'v2', '2011-03-06 12:00:00.000000', None, 25, 8 ) ] )
+        add_statistics( b, [ ( 'v2', '2011-03-03 12:00:00.000000', None, 22, 7 ) ] )
+        add_checkins( b, [ ( 'c5', 'u2', 'v2', 1299400000 ) ] )
+        merge_database.merge( self.joint, sources )
+        merged = venue_summaries( self.joint )
+        self.assertEqual( merged, rebuild( self.joint ) )
+
+        again = os.path.join( self.dir, 'again.db' )
+        merge_database.merge( again, sources )
+        self.assertEqual( venue_summaries( again ), merged )
+
+
+if __name__ == '__main__':
+    unittest.main( )
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Martin J Chorley & Matthew J Williams
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""
+Compact, read-only copies of the venues of a city, for long-running loops
+such as the checkin monitor.
+
+Walking ORM Venue objects costs a lazy load for each of venue.location,
+venue.statistics and venue.checkins, and every object loaded stays in the
+session. A VenueWorkingSet instead holds one small VenueRecord per venue,
+filled by a couple of bulk queries, and can be refreshed incrementally.
+
+A refresh reads only the city's venues changed since the last one, from the
+change log kept by triggers on the venues table (see VenueChange), so venues
+found by venues_search.py, or moved, renamed or re-activated, are picked up
+by a running monitor without a restart or a reload of the whole city. The
+activity columns of a record are as of its last load, logged change or
+reload_activity: the activity summaries are updated too often to be logged,
+so they are re-read in bulk instead.
+
+Records can be passed to the DBWrapper methods that take a venue and only
+need its id (e.g. add_checkin_to_database).
+
+A working set can be given a geofence (see geofence.py). Venues are tested
+against it once, in bulk, when they are loaded, and the result is kept as a
+boolean mask alongside the records, so no geometry is done per cycle.
+"""
+import numpy as np
+
+
+class VenueRecord( object ):
+    """
+    The parts of a venue needed by the crawlers. Plain attributes only.
+    """
+    __slots__ = [ 'id', 'foursq_id', 'name', 'city_code', 'latitude', 'longitude',
+                  'active', 'first_checkins', 'first_stat_date', 'last_checkins', 'last_users', 'last_stat_date',
+                  'last_checkin_at' ]
+
+    def __init__( self, row ):
+        self.update( row )
+
+    def update( self, row ):
+        for name, value in zip( self.__slots__, row ):
+            setattr( self, name, value )
+
+    def __repr__( self ):
+        return u"<VenueRecord('%s', '%s', '%s')>" % ( self.name, self.foursq_id, self.city_code )
+
+
+class VenueWorkingSet( object ):
+    """
+    All venues of one city as VenueRecords, in the order they were loaded.
+
+    Built by DBWrapper.get_venue_working_set(). `refresh` applies the venue
+    changes logged since the set was loaded or last refreshed.
+
+    `inside[i]` is True if records[i] is inside the fence (all True without one).
+    """
+    def __init__( self, dbw, city_code, fence=None ):
+        self.dbw = dbw
+        self.city_code = city_code
+        self.fence = fence
+        self.load()
+
+    def __len__( self ):
+        return len( self.records )
+
+    def __iter__( self ):
+        return iter( self.records )
+
+    def load( self ):
+        self.records = []
+        self.inside = np.zeros( 0, dtype=bool )
+        self.by_id = {}
+        self.positions = {}
+        # taken before reading the venues, so nothing changed meanwhile is missed
+        self.change_seq = self.dbw.get_venue_change_seq()
+        self.__append( [ VenueRecord( row ) for row in self.dbw.get_venue_record_rows( self.city_code ) ] )
+
+    def refresh( self ):
+        """
+        Update the working set with the venues changed in the database since
+        the last refresh.
+
+        Output  ( list of VenueRecords added, list of VenueRecords changed )
+        """
+        added = []
+        changed = []
+        removed = set()
+        # the other cities' changes up to here need not be read again
+        latest_seq = self.dbw.get_venue_change_seq()
+        for row in self.dbw.get_changed_venue_rows( self.change_seq, self.city_code ):
+            row, self.change_seq = row[:-1], row[-1]
+            record = self.by_id.get( row[0] )
+            if row[3] != self.city_code:
+                # moved to another city
+                if record is not None:
+                    removed.add( record.id )
+            elif record is None:
+                added.append( VenueRecord( row ) )
+            else:
+                record.update( row )
+                changed.append( record )
+        if removed:
+            keep = [ i for i, r in enumerate( self.records ) if r.id not in removed ]
+            self.records = [ self.records[i] for i in keep ]
+            self.inside = self.inside[keep]
+            self.by_id = dict( ( r.id, r ) for r in self.records )
+            self.positions = dict( ( r.id, i ) for i, r in enumerate( self.records ) )
+            changed = [ r for r in changed if r.id not in removed ]
+        self.change_seq = max( self.change_seq, latest_seq )
+        if changed:
+            # locations can change too
+            self.inside[[ self.positions[r.id] for r in changed ]] = self.__test( changed )
+        self.__append( added )
+        return added, changed
+
+    def reload_activity( self ):
+        """
+        Re-read the activity columns (active, first and last statistics, last
+        checkin) of every record, which refresh does not pick up.
+        """
+        for row in self.dbw.get_venue_activity_rows( self.city_code ):
+            record = self.by_id.get( row[0] )
+            if record is not None:
+                ( record.active, record.first_checkins, record.first_stat_date, record.last_checkins,
+                  record.last_users, record.last_stat_date, record.last_checkin_at ) = row[1:]
+
+    def active( self ):
+        """
+        Output  list of the active VenueRecords inside the fence
+        """
+        return [ r for r, inside in zip( self.records, self.inside ) if inside and r.active ]
+
+    def set_fence( self, fence ):
+        """
+        Use a different fence (None for none) and re-test every record against it.
+        """
+        self.fence = fence
+        self.inside = self.__test( self.records )
+
+    def get( self, venue_id ):
+        return self.by_id.get( venue_id )
+
+    def __append( self, records ):
+        for record in records:
+            self.positions[record.id] = len( self.records )
+            self.records.append( record )
+            self.by_id[record.id] = record
+        if records:
+            self.inside = np.concatenate( [ self.inside, self.__test( records ) ] )
+
+    def __test( self, records ):
+        if self.fence is None:
+            return np.ones( len( records ), dtype=bool )
+        return self.fence.contains( [ r.latitude for r in records ], [ r.longitude for r in records ] )
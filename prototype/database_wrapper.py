@@ -1,5 +1,5 @@
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func
 from sqlalchemy.sql.expression import and_
 from sqlite3 import dbapi2 as sqlite
 from datetime import datetime as now
@@ -166,7 +166,7 @@ class DBWrapper( object ):
         """
         Count all the venues in the database
         """
-        return len( self.session.query( Venue ).all( ) )
+        return self.session.query( func.count( Venue.id ) ).scalar( )
     
     def get_venues_by_category( self, category ):
         """
@@ -176,13 +176,7 @@ class DBWrapper( object ):
 
         Output  list of all venues matching that category.
         """
-        venues = self.session.query(Venue).all()
-        v = []
-        for venue in venues:
-            if venue.category:
-                if venue.category.foursq_id == category.foursq_id:
-                    v.append(venue)
-        return v
+        return self.session.query( Venue ).join( Venue.category ).filter( Category.foursq_id == category.foursq_id ).all( )
     
     def add_venue_to_database( self, venue ):
         """
@@ -287,7 +281,7 @@ class DBWrapper( object ):
     #### checkins ####
 
     def count_checkins_in_database( self ):
-        return len( self.session.query( Venue ).all( ) )
+        return self.session.query( func.count( Checkin.id ) ).scalar( )
 
     def add_checkin_to_database( self, checkin, venue ):
         """